@@ -1,4 +1,5 @@
 import sqlite3
+from import_dati import calcola_impronta
 
 DATABASE = 'spese.db'
 
@@ -20,12 +21,205 @@ def aggiungi_colonna(tabella, colonna, tipo):
             # Se l'errore è diverso, lo solleva per non nascondere altri problemi
             raise e
 
+# Funzione per creare un indice solo se non esiste già
+def crea_indice(nome, tabella, colonne, unico=False):
+    print(f"Creo indice '{nome}' su {tabella} ({colonne})...")
+    cur.execute(f"CREATE {'UNIQUE ' if unico else ''}INDEX IF NOT EXISTS {nome} ON {tabella} ({colonne})")
+
+# Converte la colonna 'importo' (REAL, in euro) nella colonna 'importo_cent' (INTEGER, in centesimi)
+def converti_importi_in_centesimi(tabella):
+    colonne = [riga[1] for riga in cur.execute(f"PRAGMA table_info({tabella})")]
+    if 'importo' not in colonne:
+        print(f"La tabella '{tabella}' usa già gli importi in centesimi. Nessuna modifica apportata.")
+        return
+    print(f"Converto gli importi della tabella '{tabella}' in centesimi...")
+    # I vecchi trigger del riepilogo usano 'importo' e impedirebbero di eliminare la colonna: vengono ricreati più avanti
+    for evento in ('insert', 'delete', 'update'):
+        cur.execute(f"DROP TRIGGER IF EXISTS trg_{tabella}_riepilogo_{evento}")
+    cur.execute(f"ALTER TABLE {tabella} ADD COLUMN importo_cent INTEGER NOT NULL DEFAULT 0")
+    cur.execute(f"UPDATE {tabella} SET importo_cent = CAST(ROUND(importo * 100) AS INTEGER)")
+    cur.execute(f"ALTER TABLE {tabella} DROP COLUMN importo")
+    print(f"Righe convertite: {cur.execute(f'SELECT COUNT(*) FROM {tabella}').fetchone()[0]}")
+
+# Crea da zero la tabella 'riepilogo_mensile' e i trigger che la mantengono allineata
+# (il contenuto viene poi ricalcolato da ricostruisci_riepilogo_mensile)
+def crea_riepilogo_mensile():
+    print("Creo la tabella 'riepilogo_mensile' e i relativi trigger...")
+    cur.execute("DROP TABLE IF EXISTS riepilogo_mensile")
+    cur.execute("""
+        CREATE TABLE riepilogo_mensile (
+            tabella TEXT NOT NULL,
+            anno INTEGER NOT NULL,
+            mese INTEGER NOT NULL,
+            voce TEXT NOT NULL,
+            persona TEXT NOT NULL,
+            totale_cent INTEGER NOT NULL DEFAULT 0,
+            num_transazioni INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (tabella, anno, mese, voce, persona)
+        ) WITHOUT ROWID""")
+    for tabella, colonna_voce, colonna_persona in [('spese', 'categoria', 'pagato_da'), ('entrate', 'tipo_entrata', 'ricevuto_da')]:
+        chiave_old = (f"tabella = '{tabella}' AND anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND mese = CAST(substr(OLD.data, 6, 2) AS INTEGER) "
+                      f"AND voce = OLD.{colonna_voce} AND persona = OLD.{colonna_persona}")
+        togli_old = (f"UPDATE riepilogo_mensile SET totale_cent = totale_cent - OLD.importo_cent, num_transazioni = num_transazioni - 1 WHERE {chiave_old}; "
+                     f"DELETE FROM riepilogo_mensile WHERE {chiave_old} AND num_transazioni <= 0;")
+        aggiungi_new = (f"INSERT INTO riepilogo_mensile (tabella, anno, mese, voce, persona, totale_cent, num_transazioni) "
+                        f"VALUES ('{tabella}', CAST(substr(NEW.data, 1, 4) AS INTEGER), CAST(substr(NEW.data, 6, 2) AS INTEGER), NEW.{colonna_voce}, NEW.{colonna_persona}, NEW.importo_cent, 1) "
+                        f"ON CONFLICT (tabella, anno, mese, voce, persona) DO UPDATE SET totale_cent = totale_cent + excluded.totale_cent, num_transazioni = num_transazioni + 1;")
+        for evento in ('insert', 'delete', 'update'):
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_{tabella}_riepilogo_{evento}")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_riepilogo_insert AFTER INSERT ON {tabella} BEGIN {aggiungi_new} END")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_riepilogo_delete AFTER DELETE ON {tabella} BEGIN {togli_old} END")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_riepilogo_update AFTER UPDATE OF data, {colonna_voce}, importo_cent, {colonna_persona} ON {tabella} BEGIN {togli_old} {aggiungi_new} END")
+
+# Ricalcola da zero il contenuto di 'riepilogo_mensile' a partire dai dati esistenti
+def ricostruisci_riepilogo_mensile():
+    print("Ricalcolo il riepilogo mensile dai dati esistenti...")
+    cur.execute("DELETE FROM riepilogo_mensile")
+    for tabella, colonna_voce, colonna_persona in [('spese', 'categoria', 'pagato_da'), ('entrate', 'tipo_entrata', 'ricevuto_da')]:
+        cur.execute(f"""
+            INSERT INTO riepilogo_mensile (tabella, anno, mese, voce, persona, totale_cent, num_transazioni)
+            SELECT '{tabella}', CAST(substr(data, 1, 4) AS INTEGER), CAST(substr(data, 6, 2) AS INTEGER), {colonna_voce}, {colonna_persona}, SUM(importo_cent), COUNT(*)
+            FROM {tabella} GROUP BY 2, 3, 4, 5""")
+    print(f"Righe di riepilogo create: {cur.execute('SELECT COUNT(*) FROM riepilogo_mensile').fetchone()[0]}")
+
+# Crea (se manca) la tabella 'versioni_mese' e i trigger che incrementano la versione del mese a ogni scrittura
+def crea_versioni_mese():
+    print("Creo la tabella 'versioni_mese' e i relativi trigger...")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS versioni_mese (
+            anno INTEGER NOT NULL,
+            mese INTEGER NOT NULL,
+            versione INTEGER NOT NULL DEFAULT 0,
+            modificato_il TEXT NOT NULL,
+            PRIMARY KEY (anno, mese)
+        ) WITHOUT ROWID""")
+    def incrementa(riga):
+        return (f"INSERT INTO versioni_mese (anno, mese, versione, modificato_il) VALUES (CAST(substr({riga}.data, 1, 4) AS INTEGER), CAST(substr({riga}.data, 6, 2) AS INTEGER), 1, datetime('now')) "
+                f"ON CONFLICT (anno, mese) DO UPDATE SET versione = versione + 1, modificato_il = excluded.modificato_il;")
+    for tabella in ('spese', 'entrate'):
+        for evento in ('insert', 'delete', 'update'):
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_{tabella}_versione_{evento}")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_versione_insert AFTER INSERT ON {tabella} BEGIN {incrementa('NEW')} END")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_versione_delete AFTER DELETE ON {tabella} BEGIN {incrementa('OLD')} END")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_versione_update AFTER UPDATE ON {tabella} BEGIN {incrementa('OLD')} {incrementa('NEW')} END")
+    # I mesi già presenti partono dalla versione 1 (le versioni non tornano mai indietro)
+    cur.execute("INSERT OR IGNORE INTO versioni_mese (anno, mese, versione, modificato_il) SELECT DISTINCT anno, mese, 1, datetime('now') FROM riepilogo_mensile")
+
+# Calcola l'impronta delle righe che non ce l'hanno ancora, con la stessa regola di import_dati.py
+def calcola_impronte_mancanti(tabella, colonna_voce, colonna_persona):
+    print(f"Calcolo le impronte mancanti nella tabella '{tabella}'...")
+    righe = cur.execute(f"SELECT id, data, importo_cent, {colonna_voce}, COALESCE(descrizione, ''), {colonna_persona}, impronta FROM {tabella} ORDER BY id").fetchall()
+    # Impronte già presenti: una riga inserita dall'app e poi importata di nuovo da un CSV ha già una copia
+    # con l'impronta della sua occorrenza, quindi si passa all'occorrenza successiva ancora libera
+    impronte_usate = {riga[6] for riga in righe if riga[6] is not None}
+    occorrenze = {}
+    aggiornamenti = []
+    for id_riga, data_str, importo_cent, voce, descrizione, persona, impronta in righe:
+        chiave = (data_str, importo_cent, voce, descrizione, persona)
+        occorrenze[chiave] = occorrenze.get(chiave, 0) + 1
+        if impronta is None:
+            impronta = calcola_impronta(*chiave, occorrenze[chiave])
+            while impronta in impronte_usate:
+                occorrenze[chiave] += 1
+                impronta = calcola_impronta(*chiave, occorrenze[chiave])
+            impronte_usate.add(impronta)
+            aggiornamenti.append((impronta, id_riga))
+    cur.executemany(f"UPDATE {tabella} SET impronta = ? WHERE id = ?", aggiornamenti)
+    print(f"Impronte calcolate: {len(aggiornamenti)}")
+
+def crea_anni_dati():
+    print("Creo la tabella 'anni_dati' e i relativi trigger...")
+    cur.execute("CREATE TABLE IF NOT EXISTS anni_dati (anno INTEGER PRIMARY KEY, num_transazioni INTEGER NOT NULL)")
+    def aggiungi(riga):
+        return (f"INSERT INTO anni_dati (anno, num_transazioni) VALUES (CAST(substr({riga}.data, 1, 4) AS INTEGER), 1) "
+                f"ON CONFLICT (anno) DO UPDATE SET num_transazioni = num_transazioni + 1;")
+    def togli(riga):
+        return (f"UPDATE anni_dati SET num_transazioni = num_transazioni - 1 WHERE anno = CAST(substr({riga}.data, 1, 4) AS INTEGER); "
+                f"DELETE FROM anni_dati WHERE anno = CAST(substr({riga}.data, 1, 4) AS INTEGER) AND num_transazioni <= 0;")
+    for tabella in ('spese', 'entrate'):
+        for evento in ('insert', 'delete', 'update'):
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_{tabella}_anni_{evento}")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_anni_insert AFTER INSERT ON {tabella} BEGIN {aggiungi('NEW')} END")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_anni_delete AFTER DELETE ON {tabella} BEGIN {togli('OLD')} END")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_anni_update AFTER UPDATE OF data ON {tabella} WHEN substr(OLD.data, 1, 4) <> substr(NEW.data, 1, 4) "
+                    f"BEGIN {togli('OLD')} {aggiungi('NEW')} END")
+    # Conteggi ricalcolati dal riepilogo mensile, già allineato con le tabelle
+    cur.execute("DELETE FROM anni_dati")
+    cur.execute("INSERT INTO anni_dati (anno, num_transazioni) SELECT anno, SUM(num_transazioni) FROM riepilogo_mensile GROUP BY anno")
+
+def crea_ricerca_fts():
+    print("Creo gli indici di ricerca FTS5 sulle descrizioni e i relativi trigger...")
+    for tabella in ('spese', 'entrate'):
+        fts = f"{tabella}_fts"
+        cur.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(descrizione, content='{tabella}', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+        togli_old = f"INSERT INTO {fts} ({fts}, rowid, descrizione) VALUES ('delete', OLD.id, OLD.descrizione);"
+        aggiungi_new = f"INSERT INTO {fts} (rowid, descrizione) VALUES (NEW.id, NEW.descrizione);"
+        for evento in ('insert', 'delete', 'update'):
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_{tabella}_fts_{evento}")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_fts_insert AFTER INSERT ON {tabella} BEGIN {aggiungi_new} END")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_fts_delete AFTER DELETE ON {tabella} BEGIN {togli_old} END")
+        cur.execute(f"CREATE TRIGGER trg_{tabella}_fts_update AFTER UPDATE OF descrizione ON {tabella} BEGIN {togli_old} {aggiungi_new} END")
+        # Indice ricostruito dal contenuto attuale della tabella
+        cur.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+def crea_transazioni_sincronizzate():
+    print("Creo la tabella 'transazioni_sincronizzate' per la coda offline...")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS transazioni_sincronizzate (
+            id_client TEXT PRIMARY KEY,
+            tabella TEXT NOT NULL,
+            id_transazione INTEGER NOT NULL,
+            ricevuta_il DATETIME DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID""")
+
 # Aggiorna la tabella 'spese'
 aggiungi_colonna('spese', 'pagato_da', 'TEXT')
 
 # Aggiorna la tabella 'entrate'
 aggiungi_colonna('entrate', 'ricevuto_da', 'TEXT')
 
+# Indici composti per le query mensili (filtri per intervallo su 'data')
+crea_indice('idx_spese_data_pagato_da', 'spese', 'data, pagato_da')
+crea_indice('idx_spese_data_categoria', 'spese', 'data, categoria')
+crea_indice('idx_entrate_data_ricevuto_da', 'entrate', 'data, ricevuto_da')
+crea_indice('idx_entrate_data_tipo_entrata', 'entrate', 'data, tipo_entrata')
+
+# Importi salvati come interi in centesimi (somme esatte, senza errori di arrotondamento dei float)
+converti_importi_in_centesimi('spese')
+converti_importi_in_centesimi('entrate')
+
+# Indice per la classifica del report Top Spender (dopo la conversione in centesimi)
+crea_indice('idx_spese_data_importo', 'spese', 'data, importo_cent, pagato_da')
+
+# Indici per le liste paginate per chiave (data DESC, id DESC)
+crea_indice('idx_spese_categoria_data', 'spese', 'categoria, data')
+crea_indice('idx_spese_pagato_da_data', 'spese', 'pagato_da, data')
+crea_indice('idx_entrate_tipo_entrata_data', 'entrate', 'tipo_entrata, data')
+
+# Impronta delle righe per evitare importazioni duplicate
+aggiungi_colonna('spese', 'impronta', 'TEXT')
+aggiungi_colonna('entrate', 'impronta', 'TEXT')
+calcola_impronte_mancanti('spese', 'categoria', 'pagato_da')
+calcola_impronte_mancanti('entrate', 'tipo_entrata', 'ricevuto_da')
+crea_indice('idx_spese_impronta', 'spese', 'impronta', unico=True)
+crea_indice('idx_entrate_impronta', 'entrate', 'impronta', unico=True)
+
+# Riepilogo mensile mantenuto dai trigger
+crea_riepilogo_mensile()
+ricostruisci_riepilogo_mensile()
+
+# Versioni per mese, per le risposte 304 delle pagine
+crea_versioni_mese()
+
+# Elenco degli anni con dati, per i menu di selezione
+crea_anni_dati()
+
+# Ricerca testuale nelle descrizioni
+crea_ricerca_fts()
+
+# ID delle transazioni già ricevute dalla coda offline del service worker
+crea_transazioni_sincronizzate()
+
 con.commit()
 con.close()
 
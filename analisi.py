@@ -0,0 +1,202 @@
+import calendar
+import threading
+from array import array
+from datetime import date
+
+# NumPy è facoltativo: senza, le stesse colonne restano array della libreria standard e i raggruppamenti
+# si fanno con un ciclo Python (più lento, ma con gli stessi risultati).
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+GIORNO_ZERO = date(1970, 1, 1).toordinal()
+CHIAVI_RAGGRUPPAMENTO = ('anno', 'mese', 'voce', 'persona')
+
+def data_a_giorno(data_str):
+    """Data 'AAAA-MM-GG' come numero di giorni dal 1970-01-01."""
+    return date.fromisoformat(data_str).toordinal() - GIORNO_ZERO
+
+def limite_a_giorno(data_str):
+    """Come data_a_giorno, per gli estremi degli intervalli: accetta anche giorni oltre la fine del mese
+    (es. '2025-02-30', usato come 'dopo l'ultimo giorno di febbraio') e li porta al primo giorno del mese dopo."""
+    anno, mese, giorno = int(data_str[:4]), int(data_str[5:7]), int(data_str[8:10])
+    giorno = min(giorno, calendar.monthrange(anno, mese)[1] + 1)
+    return date(anno, mese, 1).toordinal() + giorno - 1 - GIORNO_ZERO
+
+
+class ColonneTabella:
+    """Copia per colonne di 'spese' o 'entrate': una riga per transazione, nell'ordine degli id.
+    Le date sono giorni dal 1970 e mesi assoluti (anno * 12 + mese - 1), gli importi centesimi,
+    voce e persona codici interi con i dizionari 'voci' e 'persone' per tornare al testo."""
+
+    def __init__(self, tabella, colonna_voce, colonna_persona):
+        self.tabella = tabella
+        self.colonna_voce = colonna_voce
+        self.colonna_persona = colonna_persona
+        self.svuota()
+
+    def svuota(self):
+        self.ultimo_id = 0
+        self.voci, self._codici_voce = [], {}
+        self.persone, self._codici_persona = [], {}
+        self.giorni = array('i')
+        self.mesi = array('i')
+        self.importi = array('q')
+        self.codici_voce = array('i')
+        self.codici_persona = array('i')
+        self._colonne_numpy = None
+
+    def __len__(self):
+        return len(self.importi)
+
+    def _codice(self, valore, valori, codici):
+        codice = codici.get(valore)
+        if codice is None:
+            codice = codici[valore] = len(valori)
+            valori.append(valore)
+        return codice
+
+    def leggi_nuove(self, db_conn):
+        # Righe con id maggiore dell'ultimo già caricato (gli id con AUTOINCREMENT non vengono mai riusati)
+        return db_conn.execute(f'SELECT id, data, {self.colonna_voce}, {self.colonna_persona}, importo_cent FROM {self.tabella} WHERE id > ? ORDER BY id',
+                               (self.ultimo_id,)).fetchall()
+
+    def aggiungi(self, righe):
+        for id_riga, data_str, voce, persona, importo_cent in righe:
+            giorno = data_a_giorno(data_str)
+            self.giorni.append(giorno)
+            self.mesi.append(int(data_str[:4]) * 12 + int(data_str[5:7]) - 1)
+            self.importi.append(importo_cent)
+            self.codici_voce.append(self._codice(voce, self.voci, self._codici_voce))
+            self.codici_persona.append(self._codice(persona, self.persone, self._codici_persona))
+            self.ultimo_id = id_riga
+        if righe:
+            self._colonne_numpy = None
+
+    def colonne_numpy(self):
+        # Copie NumPy delle colonne, rifatte solo dopo un aggiornamento
+        if self._colonne_numpy is None:
+            self._colonne_numpy = {
+                'giorni': np.array(self.giorni, dtype=np.int32),
+                'mesi': np.array(self.mesi, dtype=np.int32),
+                'importi': np.array(self.importi, dtype=np.int64),
+                'voce': np.array(self.codici_voce, dtype=np.int32),
+                'persona': np.array(self.codici_persona, dtype=np.int32),
+            }
+        return self._colonne_numpy
+
+    def raggruppa(self, data_da, data_a, per=CHIAVI_RAGGRUPPAMENTO):
+        """Somma degli importi delle transazioni in [data_da, data_a), raggruppata per le chiavi 'per'
+        (tra 'anno', 'mese', 'voce', 'persona'; 'mese' porta con sé anche 'anno').
+        Restituisce una lista di dizionari con le chiavi richieste e 'totale', ordinata per chiave."""
+        giorno_da, giorno_a = limite_a_giorno(data_da), limite_a_giorno(data_a)
+        per = tuple(per)
+        if np is not None:
+            gruppi = self._raggruppa_numpy(giorno_da, giorno_a, per)
+        else:
+            gruppi = self._raggruppa_python(giorno_da, giorno_a, per)
+        righe = []
+        for chiave in sorted(gruppi):
+            riga = {}
+            for nome, valore in zip(per, chiave):
+                if nome == 'mese':
+                    riga['anno'], riga['mese'] = divmod(valore, 12)
+                    riga['mese'] += 1
+                elif nome == 'voce':
+                    riga['voce'] = self.voci[valore]
+                elif nome == 'persona':
+                    riga['persona'] = self.persone[valore]
+                else:
+                    riga[nome] = valore
+            riga['totale'] = gruppi[chiave]
+            righe.append(riga)
+        return righe
+
+    def _raggruppa_numpy(self, giorno_da, giorno_a, per):
+        colonne = self.colonne_numpy()
+        filtro = (colonne['giorni'] >= giorno_da) & (colonne['giorni'] < giorno_a)
+        if not filtro.any():
+            return {}
+        # Ogni combinazione di codici diventa un solo indice intero: una bincount somma tutti i gruppi insieme
+        codici, dimensioni, minimi = [], [], []
+        for nome in per:
+            if nome == 'anno':
+                colonna = colonne['mesi'][filtro] // 12
+            elif nome == 'mese':
+                colonna = colonne['mesi'][filtro]
+            else:
+                colonna = colonne[nome][filtro]
+            minimo = int(colonna.min())
+            codici.append(colonna - minimo)
+            dimensioni.append(int(colonna.max()) - minimo + 1)
+            minimi.append(minimo)
+        if per:
+            indice = np.ravel_multi_index(codici, dimensioni)
+        else:
+            indice = np.zeros(int(filtro.sum()), dtype=np.int64)
+        conteggi = np.bincount(indice, minlength=int(np.prod(dimensioni)) if per else 1)
+        # Somme in virgola mobile esatte fino a 2^53 centesimi, molto oltre qualunque totale reale
+        totali = np.bincount(indice, weights=colonne['importi'][filtro], minlength=len(conteggi))
+        presenti = np.flatnonzero(conteggi)
+        chiavi = np.unravel_index(presenti, dimensioni) if per else ()
+        return {tuple(int(codice[i]) + minimo for codice, minimo in zip(chiavi, minimi)): int(round(totali[presenti[i]]))
+                for i in range(len(presenti))}
+
+    def _raggruppa_python(self, giorno_da, giorno_a, per):
+        gruppi = {}
+        for giorno, mese, importo, voce, persona in zip(self.giorni, self.mesi, self.importi, self.codici_voce, self.codici_persona):
+            if giorno_da <= giorno < giorno_a:
+                valori = {'anno': mese // 12, 'mese': mese, 'voce': voce, 'persona': persona}
+                chiave = tuple(valori[nome] for nome in per)
+                gruppi[chiave] = gruppi.get(chiave, 0) + importo
+        return gruppi
+
+
+class AnalisiInMemoria:
+    """Colonne in memoria di più tabelle, aggiornate dal database quando cambiano.
+    La somma delle versioni in 'versioni_mese' cresce di 1 per ogni inserimento, di 1 per ogni
+    eliminazione e di 2 per ogni modifica: se è cresciuta esattamente del numero di righe nuove
+    ci sono stati solo inserimenti e basta aggiungere quelle righe, altrimenti si ricarica tutto."""
+
+    def __init__(self, colonne_per_tabella):
+        self.tabelle = {tabella: ColonneTabella(tabella, colonna_voce, colonna_persona)
+                        for tabella, (colonna_voce, colonna_persona) in colonne_per_tabella.items()}
+        self.somma_versioni = None
+        self.caricamenti_completi = 0
+        self.aggiornamenti_incrementali = 0
+        self._lock = threading.Lock()
+
+    def aggiorna(self, db_conn):
+        avviata_qui = not db_conn.in_transaction
+        if avviata_qui: db_conn.execute('BEGIN')  # versioni e righe dallo stesso istante del database
+        try:
+            somma_versioni = db_conn.execute('SELECT COALESCE(SUM(versione), 0) FROM versioni_mese').fetchone()[0]
+            if somma_versioni == self.somma_versioni:
+                return
+            nuove = {tabella: colonne.leggi_nuove(db_conn) for tabella, colonne in self.tabelle.items()}
+            if self.somma_versioni is not None and somma_versioni - self.somma_versioni == sum(len(righe) for righe in nuove.values()):
+                for tabella, righe in nuove.items():
+                    self.tabelle[tabella].aggiungi(righe)
+                self.aggiornamenti_incrementali += 1
+            else:
+                for colonne in self.tabelle.values():
+                    colonne.svuota()
+                    colonne.aggiungi(colonne.leggi_nuove(db_conn))
+                self.caricamenti_completi += 1
+            self.somma_versioni = somma_versioni
+        finally:
+            if avviata_qui: db_conn.commit()
+
+    def raggruppa(self, db_conn, tabella, data_da, data_a, per=CHIAVI_RAGGRUPPAMENTO):
+        """Aggiorna le colonne se il database è cambiato e raggruppa (vedi ColonneTabella.raggruppa)."""
+        with self._lock:
+            self.aggiorna(db_conn)
+            return self.tabelle[tabella].raggruppa(data_da, data_a, per)
+
+    def statistiche(self):
+        with self._lock:
+            return {'righe': {tabella: len(colonne) for tabella, colonne in self.tabelle.items()},
+                    'numpy': np is not None,
+                    'caricamenti_completi': self.caricamenti_completi,
+                    'aggiornamenti_incrementali': self.aggiornamenti_incrementali}
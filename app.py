@@ -1,8 +1,27 @@
 import sqlite3
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, g, session, make_response, Response
+from flask import before_render_template, template_rendered, has_request_context
 import os
-from datetime import datetime, timedelta
-from dateutil.rrule import rrule, MONTHLY # Assicurati che python-dateutil sia installato
+import csv
+import io
+import json
+import re
+import hashlib
+import threading
+import calendar
+import time
+import bisect
+import contextvars
+import logging
+import cProfile
+import pstats
+from logging.handlers import RotatingFileHandler
+from collections import OrderedDict
+from functools import wraps
+from datetime import datetime, timedelta, timezone
+from markupsafe import Markup
+import analisi
+from import_dati import euro_a_centesimi, centesimi_a_testo, PERSONE_VALIDE, TIPI_IMPORTAZIONE
 
 app = Flask(__name__)
 app.secret_key = 'LaTuaChiaveSegretaSuperSicura_CambialaAppenaPuoi_Definitiva!'
@@ -27,27 +46,338 @@ TIPI_REPORT_STATISTICHE = {
     "rapporto_entrate_spese": "Rapporto Entrate/Spese",
     "top_spender": "Report Top Spender"
 }
+# Numero di spese mostrate nelle classifiche del report Top Spender
+TOP_N_DISPONIBILI = (10, 50, 100)
 
 @app.template_filter('format_decimali_italiano')
-def format_decimali_italiano(valore, con_euro=True):
+def format_decimali_italiano(centesimi, con_euro=True):
+    # Gli importi girano nell'app come interi in centesimi: la conversione in euro avviene solo qui
     sufixo = " €" if con_euro else ""
-    if valore is None or str(valore).strip() == "": return "0" + sufixo
+    if centesimi is None or str(centesimi).strip() == "": return "0" + sufixo
     try:
-        valore_float = float(valore)
-        # Formatta con 2 decimali se ci sono decimali, altrimenti come intero
-        if valore_float == int(valore_float):
-            # Per interi, usa i punti come separatori delle migliaia (formato italiano)
-            return f"{int(valore_float):,}".replace(',', '.') + sufixo
-        else:
-            # Per i float, assicurati che il separatore decimale sia la virgola e migliaia il punto
-            return f"{valore_float:,.2f}".replace('.', '#').replace(',', '.').replace('#', ',') + sufixo
-    except (ValueError, TypeError): return str(valore) + sufixo
+        # Le medie possono avere una parte frazionaria di centesimo: si arrotonda al centesimo
+        centesimi = int(round(float(centesimi)))
+    except (ValueError, TypeError): return str(centesimi) + sufixo
+    segno = "-" if centesimi < 0 else ""
+    euro, resto = divmod(abs(centesimi), 100)
+    # Punti come separatori delle migliaia (formato italiano); i decimali solo se ci sono
+    euro_str = f"{euro:,}".replace(',', '.')
+    return f"{segno}{euro_str},{resto:02d}{sufixo}" if resto else f"{segno}{euro_str}{sufixo}"
+
+# --- Metriche delle richieste ---
+# Per ogni richiesta si misurano durata, numero e tempo delle query SQL, righe lette e tempo di resa dei
+# template; i valori finiscono in istogrammi per rotta (e per report_type nei report statistici),
+# esposti in formato testo Prometheus su /metrics. Si disattivano con app.config['METRICHE'] = False.
+# Le connessioni misurate si usano solo se servono (vedi misura_query()): con metriche e registro delle
+# query lente entrambi spenti le connessioni sono quelle di sqlite3, senza alcun costo aggiuntivo.
+app.config['METRICHE'] = True
+
+_misure_richiesta = contextvars.ContextVar('misure_richiesta', default=None)
+
+class CursoreMisurato(sqlite3.Cursor):
+    # Il tempo SQL comprende l'esecuzione e la lettura delle righe: SQLite lavora anche durante i fetch.
+    # Si misurano le chiamate, non le singole righe: iterare sul cursore legge tutte le righe con fetchall().
+    # Il tempo di ogni istruzione si accumula finché le righe non sono finite, il cursore non esegue
+    # un'altra istruzione o non viene chiuso: allora si confronta con la soglia delle query lente.
+    _sql = None
+    _secondi_istruzione = 0.0
+
+    def _misura(self, inizio, righe=0, query=0):
+        durata = time.perf_counter() - inizio
+        self._secondi_istruzione += durata
+        misure = _misure_richiesta.get()
+        if misure is not None:
+            misure['sql_secondi'] += durata
+            misure['righe'] += righe
+            misure['query'] += query
+
+    def _inizia(self, sql, parametri):
+        self._concludi()
+        self._sql, self._parametri, self._secondi_istruzione = sql, parametri, 0.0
+
+    def _concludi(self):
+        if self._sql is None: return
+        sql, self._sql = self._sql, None
+        soglia_ms = app.config.get('SOGLIA_QUERY_LENTA_MS')
+        if soglia_ms is not None and self._secondi_istruzione * 1000 >= soglia_ms:
+            registra_query_lenta(self.connection, sql, self._parametri, self._secondi_istruzione)
+
+    def execute(self, sql, parametri=()):
+        self._inizia(sql, parametri)
+        inizio = time.perf_counter()
+        try: return super().execute(sql, parametri)
+        finally:
+            self._misura(inizio, query=1)
+            if self.description is None: self._concludi()  # nessuna riga da leggere (INSERT, UPDATE, ...)
 
-def get_db():
-    db = sqlite3.connect(DATABASE)
+    def executemany(self, sql, sequenza_parametri):
+        self._inizia(sql, None)
+        inizio = time.perf_counter()
+        try: return super().executemany(sql, sequenza_parametri)
+        finally:
+            self._misura(inizio, query=1)
+            self._concludi()
+
+    def fetchone(self):
+        inizio = time.perf_counter()
+        riga = super().fetchone()
+        self._misura(inizio, 0 if riga is None else 1)
+        if riga is None: self._concludi()
+        return riga
+
+    def fetchmany(self, *argomenti):
+        inizio = time.perf_counter()
+        righe = super().fetchmany(*argomenti)
+        self._misura(inizio, len(righe))
+        if not righe: self._concludi()
+        return righe
+
+    def fetchall(self):
+        inizio = time.perf_counter()
+        righe = super().fetchall()
+        self._misura(inizio, len(righe))
+        self._concludi()
+        return righe
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._concludi()
+        super().close()
+
+    def __del__(self):
+        # Cursori lasciati a metà (es. db.execute(...).fetchone() su una sola riga)
+        self._concludi()
+
+class ConnessioneMisurata(sqlite3.Connection):
+    # Connection.execute() di sqlite3 non passa dal metodo execute del cursore: va ridefinito qui
+    def cursor(self, factory=CursoreMisurato):
+        return super().cursor(factory)
+
+    def execute(self, *argomenti):
+        return self.cursor().execute(*argomenti)
+
+    def executemany(self, *argomenti):
+        return self.cursor().executemany(*argomenti)
+
+def misura_query():
+    # Le connessioni misurate servono solo alle metriche e al registro delle query lente
+    return bool(app.config.get('METRICHE')) or app.config.get('SOGLIA_QUERY_LENTA_MS') is not None
+
+class Istogramma:
+    def __init__(self, limiti):
+        self.limiti = limiti
+        self.conteggi = [0] * (len(limiti) + 1)  # l'ultimo è +Inf
+        self.somma = 0
+        self.numero = 0
+
+    def osserva(self, valore):
+        self.conteggi[bisect.bisect_left(self.limiti, valore)] += 1
+        self.somma += valore
+        self.numero += 1
+
+LIMITI_SECONDI = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# Nome, descrizione, chiave in _misure_richiesta e limiti dei bucket di ogni istogramma
+METRICHE_RICHIESTA = (
+    ('gestione_spese_richiesta_secondi', 'Durata delle richieste', 'durata_secondi', LIMITI_SECONDI),
+    ('gestione_spese_richiesta_query_sql', 'Query SQL eseguite per richiesta', 'query', (1, 2, 5, 10, 20, 50, 100, 200, 500)),
+    ('gestione_spese_richiesta_sql_secondi', 'Tempo passato in SQLite per richiesta (esecuzione e lettura delle righe)', 'sql_secondi', LIMITI_SECONDI),
+    ('gestione_spese_richiesta_render_secondi', 'Tempo di resa dei template per richiesta', 'render_secondi', LIMITI_SECONDI),
+    ('gestione_spese_richiesta_righe_lette', 'Righe lette dal database per richiesta', 'righe', (1, 10, 100, 1000, 10000, 100000)),
+)
+
+_istogrammi = {}  # (rotta, report_type) -> {nome metrica: Istogramma}
+_lock_istogrammi = threading.Lock()
+
+@app.before_request
+def inizia_misure():
+    if app.config.get('METRICHE'):
+        _misure_richiesta.set({'inizio': time.perf_counter(), 'query': 0, 'sql_secondi': 0.0, 'righe': 0, 'render_secondi': 0.0, 'inizio_render': None})
+
+@before_render_template.connect_via(app)
+def inizia_misura_render(sender, template, context, **extra):
+    misure = _misure_richiesta.get()
+    if misure is not None: misure['inizio_render'] = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def chiudi_misura_render(sender, template, context, **extra):
+    misure = _misure_richiesta.get()
+    if misure is not None and misure['inizio_render'] is not None:
+        misure['render_secondi'] += time.perf_counter() - misure['inizio_render']
+        misure['inizio_render'] = None
+
+@app.teardown_request
+def registra_misure(exception):
+    misure = _misure_richiesta.get()
+    if misure is None: return
+    _misure_richiesta.set(None)
+    misure['durata_secondi'] = time.perf_counter() - misure['inizio']
+    # report_type distingue i report della pagina statistiche e dell'API (solo valori noti, per non creare serie a caso).
+    # request.values comprende anche i campi del form: la pagina statistiche invia i report in POST.
+    report_type = request.values.get('report_type') or (request.view_args or {}).get('report_type') or ''
+    chiave = (request.endpoint or 'sconosciuta', report_type if report_type in TIPI_REPORT_STATISTICHE else '')
+    with _lock_istogrammi:
+        istogrammi = _istogrammi.get(chiave)
+        if istogrammi is None:
+            istogrammi = _istogrammi[chiave] = {nome: Istogramma(limiti) for nome, _, _, limiti in METRICHE_RICHIESTA}
+        for nome, _, chiave_misura, _ in METRICHE_RICHIESTA:
+            istogrammi[nome].osserva(misure[chiave_misura])
+
+def testo_prometheus():
+    righe = []
+    with _lock_istogrammi:
+        for nome, descrizione, _, limiti in METRICHE_RICHIESTA:
+            righe.append(f"# HELP {nome} {descrizione}")
+            righe.append(f"# TYPE {nome} histogram")
+            for (rotta, report_type), istogrammi in sorted(_istogrammi.items()):
+                istogramma = istogrammi[nome]
+                etichette = f'route="{rotta}",report_type="{report_type}"'
+                cumulato = 0
+                for limite, conteggio in zip(limiti + ('+Inf',), istogramma.conteggi):
+                    cumulato += conteggio
+                    righe.append(f'{nome}_bucket{{{etichette},le="{limite}"}} {cumulato}')
+                righe.append(f"{nome}_sum{{{etichette}}} {istogramma.somma}")
+                righe.append(f"{nome}_count{{{etichette}}} {istogramma.numero}")
+    return '\n'.join(righe) + '\n'
+
+@app.route('/metrics')
+def metriche():
+    return Response(testo_prometheus(), mimetype='text/plain; version=0.0.4')
+
+# --- Query lente ---
+# Le istruzioni che superano app.config['SOGLIA_QUERY_LENTA_MS'] (None per disattivare) vengono scritte,
+# con parametri, durata, rotta e piano di esecuzione (EXPLAIN QUERY PLAN), in un file a rotazione in
+# formato JSON Lines; un riepilogo per istruzione resta in memoria per la pagina /admin/query_lente.
+# Un 'SCAN' nel piano indica una lettura dell'intera tabella.
+app.config['SOGLIA_QUERY_LENTA_MS'] = 100
+app.config['FILE_QUERY_LENTE'] = os.path.join(BASE_DIR, 'query_lente.log')
+DIMENSIONE_FILE_QUERY_LENTE = 1024 * 1024
+NUMERO_FILE_QUERY_LENTE = 3
+
+_log_query_lente = logging.getLogger('gestione_spese.query_lente')
+_log_query_lente.setLevel(logging.INFO)
+_log_query_lente.propagate = False
+_query_lente = {}  # testo SQL normalizzato -> riepilogo
+_lock_query_lente = threading.Lock()
+
+def piano_query(db_conn, sql, parametri):
+    # Cursore semplice: l'EXPLAIN non deve essere misurato né finire a sua volta tra le query lente
+    if parametri is None: return []
+    try:
+        return [riga[3] for riga in sqlite3.Cursor(db_conn).execute(f"EXPLAIN QUERY PLAN {sql}", parametri).fetchall()]
+    except sqlite3.Error as e:
+        return [f"EXPLAIN non riuscito: {e}"]
+
+def registra_query_lenta(db_conn, sql, parametri, secondi):
+    testo = ' '.join(sql.split())
+    rotta = (request.endpoint or 'sconosciuta') if has_request_context() else None
+    piano = piano_query(db_conn, sql, parametri)
+    voce = {'quando': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'rotta': rotta, 'durata_ms': round(secondi * 1000, 2),
+            'sql': testo, 'parametri': list(parametri) if isinstance(parametri, (list, tuple)) else parametri, 'piano': piano}
+    with _lock_query_lente:
+        if not _log_query_lente.handlers:
+            # Il file si crea alla prima query lenta, con il percorso configurato in quel momento
+            _log_query_lente.addHandler(RotatingFileHandler(app.config['FILE_QUERY_LENTE'], maxBytes=DIMENSIONE_FILE_QUERY_LENTE,
+                                                            backupCount=NUMERO_FILE_QUERY_LENTE, encoding='utf-8', delay=True))
+        riepilogo = _query_lente.setdefault(testo, {'sql': testo, 'volte': 0, 'totale_ms': 0.0, 'massimo_ms': 0.0, 'rotte': set()})
+        riepilogo['volte'] += 1
+        riepilogo['totale_ms'] += voce['durata_ms']
+        riepilogo['massimo_ms'] = max(riepilogo['massimo_ms'], voce['durata_ms'])
+        if rotta: riepilogo['rotte'].add(rotta)
+        riepilogo['piano'], riepilogo['ultima_volta'] = piano, voce['quando']
+    try:
+        _log_query_lente.info(json.dumps(voce, ensure_ascii=False, default=str))
+    except OSError as e:
+        print(f"Errore nella scrittura del log delle query lente: {e}")
+
+@app.route('/admin/query_lente')
+def query_lente():
+    with _lock_query_lente:
+        peggiori = sorted((dict(riepilogo, rotte=sorted(riepilogo['rotte'])) for riepilogo in _query_lente.values()),
+                          key=lambda riepilogo: riepilogo['totale_ms'], reverse=True)[:50]
+    return render_template('query_lente.html', titolo_pagina="Query lente", query_peggiori=peggiori,
+                           soglia_ms=app.config.get('SOGLIA_QUERY_LENTA_MS'), file_log=app.config.get('FILE_QUERY_LENTE'))
+
+# --- Profilazione su richiesta ---
+# Con app.config['PROFILAZIONE'] attiva, aggiungendo ?_profile=1 a una pagina la richiesta viene eseguita
+# sotto cProfile e il profilo salvato in CARTELLA_PROFILI (si apre con pstats o snakeviz);
+# con ?_profile=tabella al posto della pagina si vedono le funzioni ordinate per tempo cumulativo.
+# Senza il parametro i due hook leggono solo la configurazione.
+app.config['PROFILAZIONE'] = False
+app.config['CARTELLA_PROFILI'] = os.path.join(BASE_DIR, 'profili')
+RIGHE_TABELLA_PROFILO = 60
+
+@app.before_request
+def avvia_profilazione():
+    if app.config.get('PROFILAZIONE') and request.args.get('_profile') in ('1', 'tabella'):
+        g.profilo = cProfile.Profile()
+        g.profilo.enable()
+
+@app.after_request
+def salva_profilazione(risposta):
+    profilo = g.pop('profilo', None)
+    if profilo is None: return risposta
+    profilo.disable()
+    os.makedirs(app.config['CARTELLA_PROFILI'], exist_ok=True)
+    nome_file = f"{request.endpoint or 'sconosciuta'}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.prof"
+    percorso = os.path.join(app.config['CARTELLA_PROFILI'], nome_file)
+    statistiche = pstats.Stats(profilo)
+    statistiche.dump_stats(percorso)
+    if request.args.get('_profile') != 'tabella': return risposta
+
+    # pstats: (file, riga, funzione) -> (chiamate primitive, chiamate totali, tempo proprio, tempo cumulativo, chiamanti)
+    funzioni = sorted(statistiche.stats.items(), key=lambda voce: voce[1][3], reverse=True)[:RIGHE_TABELLA_PROFILO]
+    righe = [{'funzione': pstats.func_std_string(chiave), 'chiamate': f"{totali}/{primitive}" if totali != primitive else str(totali),
+              'tempo_proprio_ms': tempo_proprio * 1000, 'tempo_cumulativo_ms': tempo_cumulativo * 1000}
+             for chiave, (primitive, totali, tempo_proprio, tempo_cumulativo, _) in funzioni]
+    return make_response(render_template('profilo.html', titolo_pagina=f"Profilo di {request.path}", righe=righe,
+                                         percorso=percorso, tempo_totale_ms=statistiche.total_tt * 1000,
+                                         stato_pagina=risposta.status_code))
+
+@app.teardown_request
+def ferma_profilazione(exception):
+    # Se la vista ha sollevato un'eccezione after_request non viene chiamato: il profilo si ferma qui
+    profilo = g.pop('profilo', None)
+    if profilo is not None: profilo.disable()
+
+# --- Connessione al database ---
+# Pragma applicati a ogni nuova connessione; si possono modificare da app.config['SQLITE_PRAGMAS'].
+# Con il WAL le letture (es. la pagina statistiche) non bloccano le scritture di aggiungi_transazione e viceversa.
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000,       # in KiB (valore negativo), circa 16 MB
+    'mmap_size': 134217728,     # 128 MB
+    'temp_store': 'MEMORY',
+}
+
+def apri_connessione():
+    db = sqlite3.connect(DATABASE, factory=ConnessioneMisurata if misura_query() else sqlite3.Connection)
     db.row_factory = sqlite3.Row
+    for nome, valore in app.config.get('SQLITE_PRAGMAS', {}).items():
+        db.execute(f"PRAGMA {nome} = {valore}")
     return db
 
+def apri_connessione_lettura():
+    # Connessione per le sole letture: alla replica in memoria se attiva, altrimenti al file
+    if app.config.get('REPLICA_IN_MEMORIA'):
+        return replica_in_memoria.apri()
+    return apri_connessione()
+
+def get_db():
+    # Una sola connessione per richiesta, conservata nell'app context e chiusa da chiudi_db().
+    # Le rotte GET leggono soltanto: con la replica attiva vengono servite dalla copia in memoria.
+    if 'db' not in g:
+        g.db = apri_connessione_lettura() if request.method in ('GET', 'HEAD') else apri_connessione()
+    return g.db
+
+@app.teardown_appcontext
+def chiudi_db(exception):
+    db = g.pop('db', None)
+    if db is not None: db.close()
+
 def init_db():
     print(f"Tentativo di inizializzare il database usando lo schema: {SCHEMA_FILE}")
     print(f"Il database verrà creato/usato qui: {DATABASE}")
@@ -56,10 +386,12 @@ def init_db():
         return
     db_conn = None
     try:
-        db_conn = get_db()
+        db_conn = apri_connessione()
         with open(SCHEMA_FILE, mode='r') as f:
             db_conn.cursor().executescript(f.read())
         db_conn.commit()
+        cache_mesi.svuota()
+        cache_frammenti.svuota()
         print("Database inizializzato con successo.")
     except sqlite3.Error as e:
         print(f"Errore SQLite durante init_db: {e}")
@@ -68,18 +400,412 @@ def init_db():
     finally:
         if db_conn: db_conn.close()
 
+# --- Replica in memoria per le letture ---
+# Con app.config['REPLICA_IN_MEMORIA'] il database viene copiato in memoria con l'API di backup di sqlite3
+# e le rotte GET leggono dalla copia; le scritture vanno sempre sul file. Dopo ogni scrittura (invalida_mesi)
+# si prepara una copia nuova e la si sostituisce alla vecchia: le richieste già in corso finiscono sulla
+# copia che avevano aperto. Le scritture di altri processi (es. import_dati.py) arrivano nella replica
+# entro REPLICA_SECONDI_MASSIMI secondi.
+app.config['REPLICA_IN_MEMORIA'] = False
+app.config['REPLICA_SECONDI_MASSIMI'] = 60
+
+class ConnessioneReplica(sqlite3.Connection):
+    # Ricorda il contatore delle invalidazioni della cache dei mesi al momento dell'apertura:
+    # un risultato letto da una copia poi sostituita non deve finire in cache (vedi invalidazioni_lette())
+    invalidazioni_all_apertura = None
+
+class ConnessioneReplicaMisurata(ConnessioneReplica, ConnessioneMisurata):
+    pass
+
+class ReplicaInMemoria:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generazione = 0
+        self._uri = None
+        self._ancora = None  # tiene in vita la copia corrente finché non viene sostituita
+        self.aggiornata_il = None
+        self.copie = 0
+
+    def aggiorna(self):
+        with self._lock:
+            self._generazione += 1
+            uri = f"file:replica_spese_{os.getpid()}_{self._generazione}?mode=memory&cache=shared"
+            ancora = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            disco = apri_connessione()
+            try:
+                disco.backup(ancora)
+            finally:
+                disco.close()
+            vecchia, self._ancora, self._uri = self._ancora, ancora, uri
+            self.aggiornata_il = time.monotonic()
+            self.copie += 1
+        # La copia precedente sparisce quando si chiude l'ultima connessione che la sta leggendo
+        if vecchia is not None: vecchia.close()
+
+    def apri(self):
+        with self._lock:
+            da_aggiornare = self._uri is None or time.monotonic() - self.aggiornata_il > app.config['REPLICA_SECONDI_MASSIMI']
+        if da_aggiornare:
+            self.aggiorna()
+        # Il contatore va letto prima della copia: aggiorna() sostituisce la copia prima di invalidare la cache
+        invalidazioni = cache_mesi.invalidazioni
+        # URI e connessione sotto il lock: fuori, un aggiorna() concorrente potrebbe chiudere l'ancora della copia
+        # appena letta e la connessione aprirebbe un database in memoria nuovo e vuoto
+        with self._lock:
+            db = sqlite3.connect(self._uri, uri=True, factory=ConnessioneReplicaMisurata if misura_query() else ConnessioneReplica)
+        db.invalidazioni_all_apertura = invalidazioni
+        db.row_factory = sqlite3.Row
+        return db
+
+    def statistiche(self):
+        return {'attiva': bool(app.config.get('REPLICA_IN_MEMORIA')), 'copie': self.copie,
+                'eta_secondi': round(time.monotonic() - self.aggiornata_il, 1) if self.aggiornata_il is not None else None}
+
+replica_in_memoria = ReplicaInMemoria()
+
+# --- Intervalli di date ---
+# Le date sono salvate come testo 'YYYY-MM-DD': un confronto diretto su 'data' con un
+# intervallo semiaperto [inizio, fine) permette a SQLite di usare gli indici su 'data',
+# cosa impossibile filtrando con strftime("%Y-%m", data) = ?.
+def mese_successivo(anno, mese):
+    return (anno + 1, 1) if mese == 12 else (anno, mese + 1)
+
+def intervallo_mese(anno, mese):
+    anno_succ, mese_succ = mese_successivo(anno, mese)
+    return f"{anno:04d}-{mese:02d}-01", f"{anno_succ:04d}-{mese_succ:02d}-01"
+
+# --- Cache dei riepiloghi per mese ---
+# I mesi passati non cambiano quasi mai: i sommari e le tabelle di un mese vengono calcolati una volta
+# e tenuti in memoria finché una scrittura non tocca quel mese (vedi invalida_mesi()).
+# Ogni valore è salvato con la versione del mese (versioni_mese) letta prima di calcolarlo e viene riusato
+# solo se la versione è ancora quella: anche le scritture di altri processi (es. import_dati.py) lo scartano.
+DIMENSIONE_CACHE_MESI = 120
+
+class CacheMesiLRU:
+    # Per ogni (anno, mese) conserva un dizionario {nome funzione: (versione, risultato)}.
+    # La chiave (anno, 0) raccoglie i valori calcolati sull'intero anno, con la versione dell'anno
+    # (vedi leggi_versione_anno): si invalida con qualunque mese dell'anno.
+    # Oltre 'dimensione_massima' mesi scarta quello usato meno di recente.
+    def __init__(self, dimensione_massima):
+        self.dimensione_massima = dimensione_massima
+        self._mesi = OrderedDict()
+        self._lock = threading.Lock()
+        # Contatore delle invalidazioni: un risultato calcolato mentre un'altra richiesta scriveva
+        # potrebbe essere già vecchio, quindi non viene salvato (vedi memorizza_per_mese)
+        self.invalidazioni = 0
+
+    def leggi(self, anno, mese, nome, versione):
+        with self._lock:
+            valori_mese = self._mesi.get((anno, mese))
+            if valori_mese is None or nome not in valori_mese: return None
+            versione_salvata, valore = valori_mese[nome]
+            if versione_salvata != versione: return None
+            self._mesi.move_to_end((anno, mese))
+            return valore
+
+    def scrivi(self, anno, mese, nome, valore, versione, invalidazioni_lette):
+        with self._lock:
+            if invalidazioni_lette != self.invalidazioni: return
+            self._mesi.setdefault((anno, mese), {})[nome] = (versione, valore)
+            self._mesi.move_to_end((anno, mese))
+            while len(self._mesi) > self.dimensione_massima:
+                self._mesi.popitem(last=False)
+
+    def invalida(self, anno, mese):
+        with self._lock:
+            self.invalidazioni += 1
+            self._mesi.pop((anno, mese), None)
+            self._mesi.pop((anno, 0), None)
+
+    def svuota(self):
+        with self._lock:
+            self.invalidazioni += 1
+            self._mesi.clear()
+
+cache_mesi = CacheMesiLRU(DIMENSIONE_CACHE_MESI)
+
+def invalidazioni_lette(db_conn):
+    # Valore del contatore delle invalidazioni da passare a cache_mesi.scrivi() per i dati letti da db_conn
+    if isinstance(db_conn, ConnessioneReplica):
+        return db_conn.invalidazioni_all_apertura
+    return cache_mesi.invalidazioni
+
+def memorizza_per_mese(funzione):
+    # Per le funzioni con firma (db_conn, anno, mese): il risultato viene letto dalla cache se presente.
+    # I risultati sono condivisi tra le richieste e non vanno modificati da chi li riceve.
+    @wraps(funzione)
+    def funzione_con_cache(db_conn, anno, mese):
+        # La versione si legge prima dei dati: se nel frattempo qualcuno scrive, il valore salvato
+        # ha una versione già superata e alla lettura successiva viene ricalcolato
+        versione = leggi_versione_mese(db_conn, anno, mese)
+        valore = cache_mesi.leggi(anno, mese, funzione.__name__, versione)
+        if valore is None:
+            invalidazioni = invalidazioni_lette(db_conn)
+            valore = funzione(db_conn, anno, mese)
+            cache_mesi.scrivi(anno, mese, funzione.__name__, valore, versione, invalidazioni)
+        return valore
+    return funzione_con_cache
+
+def invalida_mesi(*date_str):
+    # Da chiamare dopo ogni scrittura con le date ('YYYY-MM-DD') delle righe toccate: per una modifica
+    # servono sia la data originale sia quella nuova, perché la transazione può cambiare mese.
+    # La replica in memoria si aggiorna prima di invalidare la cache (vedi ReplicaInMemoria.apri()).
+    if app.config.get('REPLICA_IN_MEMORIA'):
+        replica_in_memoria.aggiorna()
+    for data_str in date_str:
+        if data_str:
+            cache_mesi.invalida(int(data_str[:4]), int(data_str[5:7]))
+
+# --- GET condizionali (ETag) ---
+# I trigger di schema.sql incrementano la versione del mese (tabella versioni_mese) a ogni scrittura
+# su spese ed entrate. Le pagine in sola lettura calcolano un ETag dalle versioni dei mesi che mostrano:
+# se il browser ha già quella versione si risponde 304 con una sola lettura di versioni_mese,
+# senza ricalcolare né rendere la pagina. Modificare marzo non cambia l'ETag di gennaio.
+AVVIO_APP = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')  # cambia a ogni riavvio (es. dopo un aggiornamento dei template)
+
+def leggi_versione_dati(db_conn, intervallo=None):
+    # Somma delle versioni dei mesi in [da, a) (o di tutti i mesi se intervallo è None) e data dell'ultima modifica.
+    # Le versioni crescono soltanto, quindi la somma cambia a ogni scrittura in uno dei mesi.
+    if intervallo is None:
+        row = db_conn.execute('SELECT COALESCE(SUM(versione), 0) AS versione, MAX(modificato_il) AS modificato_il FROM versioni_mese').fetchone()
+    else:
+        (anno_da, mese_da), (anno_a, mese_a) = intervallo
+        row = db_conn.execute('SELECT COALESCE(SUM(versione), 0) AS versione, MAX(modificato_il) AS modificato_il FROM versioni_mese WHERE (anno, mese) >= (?, ?) AND (anno, mese) < (?, ?)',
+                              (anno_da, mese_da, anno_a, mese_a)).fetchone()
+    ultima_modifica = datetime.strptime(row['modificato_il'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc) if row['modificato_il'] else None
+    return row['versione'], ultima_modifica
+
+def con_etag(mesi_della_pagina):
+    # mesi_della_pagina(**argomenti_della_rotta) restituisce l'intervallo di mesi [da, a) mostrato dalla pagina,
+    # come ((anno, mese), (anno, mese)), oppure None se la pagina dipende da tutti i mesi.
+    # Se solleva ValueError (es. mese non valido) la pagina viene servita normalmente, senza ETag.
+    def decoratore(vista):
+        @wraps(vista)
+        def vista_condizionale(**kwargs):
+            # Le pagine con messaggi flash in sospeso vanno sempre rese
+            if request.method != 'GET' or session.get('_flashes'): return vista(**kwargs)
+            try: intervallo = mesi_della_pagina(**kwargs)
+            except ValueError: return vista(**kwargs)
+            versione, ultima_modifica = leggi_versione_dati(get_db(), intervallo)
+            # Anche la data di oggi entra nell'ETag: le pagine mostrano il mese corrente e la data proposta nel form
+            etag = hashlib.sha1(f"{AVVIO_APP}|{request.full_path}|{datetime.today().date()}|{versione}".encode()).hexdigest()
+            # Si considera solo If-None-Match: If-Modified-Since non sa nulla del cambio di giorno
+            if request.if_none_match.contains(etag):
+                risposta = app.response_class(status=304)
+            else:
+                risposta = make_response(vista(**kwargs))
+                if risposta.status_code != 200: return risposta
+            risposta.set_etag(etag)
+            if ultima_modifica: risposta.last_modified = ultima_modifica
+            # Il browser deve sempre chiedere conferma al server prima di riusare la pagina
+            risposta.headers['Cache-Control'] = 'no-cache'
+            return risposta
+        return vista_condizionale
+    return decoratore
+
+def mesi_pagina_mese(anno=None, mese=None):
+    oggi = datetime.today()
+    anno, mese = anno or oggi.year, mese or oggi.month
+    datetime(anno, mese, 1)  # solleva ValueError per un mese non valido
+    return (anno, mese), mese_successivo(anno, mese)
+
+def mesi_pagina_statistiche():
+    if not request.args.get('anno_da'):
+        # Senza parametri la pagina mostra solo il form: nessun mese (intervallo vuoto)
+        return (0, 0), (0, 0)
+    oggi = datetime.today()
+    anno_da, mese_da = request.args.get('anno_da', default=oggi.year, type=int), request.args.get('mese_da', default=1, type=int)
+    anno_a, mese_a = request.args.get('anno_a', default=oggi.year, type=int), request.args.get('mese_a', default=oggi.month, type=int)
+    datetime(anno_da, mese_da, 1); datetime(anno_a, mese_a, 1)
+    return (anno_da, mese_da), mese_successivo(anno_a, mese_a)
+
+def mesi_pagina_delta(anno=None):
+    # Il confronto annuale mostra anche l'elenco degli anni disponibili: dipende da tutti i mesi
+    return None
+
+# --- Cache dei frammenti HTML ---
+# Le righe e i piedi delle tabelle del mese (template _righe_tbody_* e _righe_tfoot_*) già resi vengono
+# conservati con chiave (anno, mese, template, versione del mese): una scrittura cambia la versione
+# (trigger di versioni_mese) e il frammento vecchio non viene più letto, finché l'LRU non lo scarta.
+# Anche le scritture fatte da altri processi (es. import_dati.py) cambiano la versione.
+DIMENSIONE_CACHE_FRAMMENTI = 480
+
+class CacheFrammentiLRU:
+    def __init__(self, dimensione_massima):
+        self.dimensione_massima = dimensione_massima
+        self._frammenti = OrderedDict()
+        self._lock = threading.Lock()
+        self.colpi = 0
+        self.mancati = 0
+
+    def leggi(self, chiave):
+        with self._lock:
+            html = self._frammenti.get(chiave)
+            if html is None:
+                self.mancati += 1
+                return None
+            self.colpi += 1
+            self._frammenti.move_to_end(chiave)
+            return html
+
+    def scrivi(self, chiave, html):
+        with self._lock:
+            self._frammenti[chiave] = html
+            self._frammenti.move_to_end(chiave)
+            while len(self._frammenti) > self.dimensione_massima:
+                self._frammenti.popitem(last=False)
+
+    def svuota(self):
+        with self._lock:
+            self._frammenti.clear()
+
+    def statistiche(self):
+        with self._lock:
+            return {'frammenti': len(self._frammenti), 'dimensione_massima': self.dimensione_massima, 'colpi': self.colpi, 'mancati': self.mancati}
+
+cache_frammenti = CacheFrammentiLRU(DIMENSIONE_CACHE_FRAMMENTI)
+
+def leggi_versione_mese(db_conn, anno, mese):
+    row = db_conn.execute('SELECT versione FROM versioni_mese WHERE anno = ? AND mese = ?', (anno, mese)).fetchone()
+    return row['versione'] if row else 0
+
+def leggi_versione_anno(db_conn, anno):
+    # Somma delle versioni dei mesi dell'anno: cambia a ogni scrittura in uno qualunque dei mesi
+    return db_conn.execute('SELECT COALESCE(SUM(versione), 0) FROM versioni_mese WHERE anno = ?', (anno,)).fetchone()[0]
+
+def contesto_frammento_mese(db_conn, template, anno, mese):
+    # Dati di un frammento letti direttamente dal database (senza la cache dei mesi, che potrebbe non essere
+    # ancora stata invalidata): chi li chiama li legge nella stessa transazione della versione.
+    if template in ('_righe_tbody_spese.html', '_righe_tbody_entrate.html'):
+        tabella = 'spese' if template == '_righe_tbody_spese.html' else 'entrate'
+        righe = (_get_dati_tabella_spese if tabella == 'spese' else _get_dati_tabella_entrate).__wrapped__(db_conn, anno, mese)
+        return {f'{tabella}_mese_dettagliate': righe}
+    sommari = calcola_sommari_mese_numerici.__wrapped__(db_conn, anno, mese)
+    tabella = 'spese' if template == '_righe_tfoot_spese.html' else 'entrate'
+    return {f'{tabella}_giacomo_tf': sommari[f'{tabella}_giacomo'], f'{tabella}_erica_tf': sommari[f'{tabella}_erica'],
+            f'totale_{tabella}_mese_tf': sommari[f'totale_{tabella}_mese']}
+
+def frammento_mese(db_conn, template, anno, mese):
+    # Con il frammento in cache costa una lettura di versioni_mese per chiave primaria e una ricerca nel dizionario
+    html = cache_frammenti.leggi((anno, mese, template, leggi_versione_mese(db_conn, anno, mese)))
+    if html is not None: return html
+    avviata_qui = not db_conn.in_transaction
+    if avviata_qui: db_conn.execute('BEGIN')  # versione e dati dallo stesso istante del database
+    try:
+        versione = leggi_versione_mese(db_conn, anno, mese)
+        contesto = contesto_frammento_mese(db_conn, template, anno, mese)
+    finally:
+        if avviata_qui: db_conn.commit()
+    html = Markup(render_template(template, current_anno=anno, current_mese=mese, **contesto))
+    cache_frammenti.scrivi((anno, mese, template, versione), html)
+    return html
+
+@app.route('/stato_cache')
+def stato_cache():
+    return jsonify(frammenti=cache_frammenti.statistiche(), analisi=analisi_in_memoria.statistiche(), replica=replica_in_memoria.statistiche())
+
+# --- Riepilogo mensile ---
+# La tabella 'riepilogo_mensile' (mantenuta dai trigger definiti in schema.sql) contiene i totali per
+# (anno, mese, voce, persona): voce è la categoria per le spese e il tipo_entrata per le entrate.
+# Tutti i totali sono interi in centesimi (colonne importo_cent e totale_cent).
+COLONNE_RIEPILOGO = {'spese': ('categoria', 'pagato_da'), 'entrate': ('tipo_entrata', 'ricevuto_da')}
+
+def leggi_riepilogo_periodo(db_conn, tabella, data_da, data_a):
+    # Restituisce le righe (anno, mese, voce, persona, totale) dell'intervallo [data_da, data_a).
+    # I mesi interi si leggono dal riepilogo; gli eventuali mesi parziali agli estremi dalla tabella originale.
+    colonna_voce, colonna_persona = COLONNE_RIEPILOGO[tabella]
+    inizio = datetime.strptime(data_da, '%Y-%m-%d')
+    fine = datetime.strptime(data_a, '%Y-%m-%d')
+    primo_mese_intero = (inizio.year, inizio.month) if inizio.day == 1 else mese_successivo(inizio.year, inizio.month)
+    mese_fine = (fine.year, fine.month)
+    righe = []
+    if primo_mese_intero < mese_fine:
+        righe += db_conn.execute('SELECT anno, mese, voce, persona, totale_cent AS totale FROM riepilogo_mensile WHERE tabella = ? AND (anno, mese) >= (?, ?) AND (anno, mese) < (?, ?)',
+                                 (tabella, *primo_mese_intero, *mese_fine)).fetchall()
+    segmenti_parziali = []
+    if inizio.day != 1:
+        segmenti_parziali.append((data_da, min(data_a, intervallo_mese(inizio.year, inizio.month)[1])))
+    if fine.day != 1 and mese_fine >= primo_mese_intero:
+        segmenti_parziali.append((max(data_da, intervallo_mese(*mese_fine)[0]), data_a))
+    for segmento_da, segmento_a in segmenti_parziali:
+        righe += db_conn.execute(f'''SELECT CAST(substr(data, 1, 4) AS INTEGER) AS anno, CAST(substr(data, 6, 2) AS INTEGER) AS mese, {colonna_voce} AS voce, {colonna_persona} AS persona, SUM(importo_cent) AS totale
+                                    FROM {tabella} WHERE data >= ? AND data < ? GROUP BY anno, mese, voce, persona''', (segmento_da, segmento_a)).fetchall()
+    return righe
+
+def leggi_riepilogo_anno_chiuso(db_conn, tabella, anno, data_a):
+    # Come leggi_riepilogo_periodo su [1 gennaio di 'anno', data_a), per un anno già concluso:
+    # le righe restano in cache (chiave (anno, 0)) finché una scrittura non tocca un mese di quell'anno.
+    nome = f"riepilogo_{tabella}_{data_a}"
+    versione = leggi_versione_anno(db_conn, anno)
+    righe = cache_mesi.leggi(anno, 0, nome, versione)
+    if righe is None:
+        invalidazioni = invalidazioni_lette(db_conn)
+        righe = leggi_riepilogo_periodo(db_conn, tabella, f"{anno:04d}-01-01", data_a)
+        cache_mesi.scrivi(anno, 0, nome, righe, versione, invalidazioni)
+    return righe
+
+def leggi_anni_disponibili(db_conn):
+    # Anni con almeno una spesa o entrata, dal più recente (tabella anni_dati, mantenuta dai trigger)
+    return [row['anno'] for row in db_conn.execute('SELECT anno FROM anni_dati ORDER BY anno DESC')]
+
+def leggi_totali_per_anno(db_conn, tabella, limiti_anni):
+    # Totali (anno, voce, persona) di più anni con due sole letture, qualunque sia il numero di anni:
+    # limiti_anni è {anno: data di fine esclusa} e ogni anno va dal 1° gennaio a quella data.
+    # I mesi interi vengono dal riepilogo mensile, il mese parziale di ogni anno dalla tabella originale.
+    colonna_voce, colonna_persona = COLONNE_RIEPILOGO[tabella]
+    mesi_interi = {anno: (12 if data_a[:4] != f"{anno:04d}" else int(data_a[5:7]) - 1) for anno, data_a in limiti_anni.items()}
+    righe = [row for row in db_conn.execute('SELECT anno, mese, voce, persona, totale_cent AS totale FROM riepilogo_mensile WHERE tabella = ? AND anno >= ? AND anno <= ?',
+                                            (tabella, min(limiti_anni), max(limiti_anni)))
+             if row['anno'] in mesi_interi and row['mese'] <= mesi_interi[row['anno']]]
+    segmenti_parziali = [(f"{data_a[:7]}-01", data_a) for data_a in limiti_anni.values() if not data_a.endswith('-01')]
+    if segmenti_parziali:
+        condizioni = ' OR '.join(['(data >= ? AND data < ?)'] * len(segmenti_parziali))
+        righe += db_conn.execute(f'''SELECT CAST(substr(data, 1, 4) AS INTEGER) AS anno, CAST(substr(data, 6, 2) AS INTEGER) AS mese, {colonna_voce} AS voce, {colonna_persona} AS persona, SUM(importo_cent) AS totale
+                                    FROM {tabella} WHERE {condizioni} GROUP BY anno, mese, voce, persona''',
+                                 [data for segmento in segmenti_parziali for data in segmento]).fetchall()
+    return righe
+
+# --- Analisi in memoria ---
+# Con app.config['ANALISI_IN_MEMORIA'] i report statistici raggruppano le transazioni da una copia per colonne
+# di spese ed entrate (modulo analisi), che dopo un inserimento legge solo le righe nuove.
+# Attiva di default se NumPy è installato; senza, i totali vengono dal riepilogo mensile.
+app.config['ANALISI_IN_MEMORIA'] = analisi.np is not None
+analisi_in_memoria = analisi.AnalisiInMemoria(COLONNE_RIEPILOGO)
+
+def leggi_totali_periodo(db_conn, tabella, data_da, data_a, per=analisi.CHIAVI_RAGGRUPPAMENTO):
+    # Totali di [data_da, data_a) raggruppati per le chiavi 'per' (righe con 'totale').
+    # Dal riepilogo le righe restano per (anno, mese, voce, persona): chi le usa somma comunque per le sue chiavi.
+    if app.config.get('ANALISI_IN_MEMORIA'):
+        return analisi_in_memoria.raggruppa(db_conn, tabella, data_da, data_a, per)
+    return leggi_riepilogo_periodo(db_conn, tabella, data_da, data_a)
+
+def calcola_delta(corrente, precedente):
+    delta_abs = corrente - precedente
+    delta_perc = (delta_abs / precedente * 100) if precedente != 0 else 0
+    return {'abs': delta_abs, 'perc': delta_perc}
+
+def totali_per_persona(righe_riepilogo):
+    totali = {'Giacomo': 0, 'Erica': 0, 'Totale': 0}
+    for row in righe_riepilogo:
+        if row['persona'] in totali: totali[row['persona']] += row['totale']
+        totali['Totale'] += row['totale']
+    return totali
+
+@memorizza_per_mese
 def calcola_sommari_mese_numerici(db_conn, anno, mese):
-    anno_mese_str = f"{anno:04d}-{mese:02d}"
-    s_entrate_giacomo, s_entrate_erica = 0.0, 0.0
-    s_spese_giacomo, s_spese_erica = 0.0, 0.0
-    cursore_entrate_persona = db_conn.execute('SELECT ricevuto_da, SUM(importo) as totale FROM entrate WHERE strftime("%Y-%m", data) = ? GROUP BY ricevuto_da', (anno_mese_str,))
-    for row in cursore_entrate_persona:
-        if row['ricevuto_da'] == 'Giacomo': s_entrate_giacomo = row['totale'] or 0.0
-        elif row['ricevuto_da'] == 'Erica': s_entrate_erica = row['totale'] or 0.0
-    cursore_spese_persona = db_conn.execute('SELECT pagato_da, SUM(importo) as totale FROM spese WHERE strftime("%Y-%m", data) = ? GROUP BY pagato_da', (anno_mese_str,))
-    for row in cursore_spese_persona:
-        if row['pagato_da'] == 'Giacomo': s_spese_giacomo = row['totale'] or 0.0
-        elif row['pagato_da'] == 'Erica': s_spese_erica = row['totale'] or 0.0
+    s_entrate_giacomo, s_entrate_erica = 0, 0
+    s_spese_giacomo, s_spese_erica = 0, 0
+    cursore_persona = db_conn.execute("SELECT tabella, persona, SUM(totale_cent) as totale FROM riepilogo_mensile WHERE tabella IN ('entrate', 'spese') AND anno = ? AND mese = ? GROUP BY tabella, persona", (anno, mese))
+    for row in cursore_persona:
+        if row['tabella'] == 'entrate':
+            if row['persona'] == 'Giacomo': s_entrate_giacomo = row['totale'] or 0
+            elif row['persona'] == 'Erica': s_entrate_erica = row['totale'] or 0
+        else:
+            if row['persona'] == 'Giacomo': s_spese_giacomo = row['totale'] or 0
+            elif row['persona'] == 'Erica': s_spese_erica = row['totale'] or 0
+    return _componi_sommari(s_entrate_giacomo, s_entrate_erica, s_spese_giacomo, s_spese_erica)
+
+def _componi_sommari(s_entrate_giacomo, s_entrate_erica, s_spese_giacomo, s_spese_erica):
     return {
         "entrate_giacomo": s_entrate_giacomo, "entrate_erica": s_entrate_erica,
         "totale_entrate_mese": s_entrate_giacomo + s_entrate_erica,
@@ -90,13 +816,33 @@ def calcola_sommari_mese_numerici(db_conn, anno, mese):
         "totale_risparmio_mese": (s_entrate_giacomo + s_entrate_erica) - (s_spese_giacomo + s_spese_erica)
     }
 
+def calcola_sommari_periodo(db_conn, anno_da, mese_da, anno_a, mese_a):
+    # Sommari mese per mese (stesse chiavi di calcola_sommari_mese_numerici) dal mese (anno_da, mese_da)
+    # incluso al mese (anno_a, mese_a) escluso, con una sola query raggruppata per tabella.
+    # I mesi senza movimenti vengono riempiti con zero.
+    totali = {}
+    for tabella in ('entrate', 'spese'):
+        cursore = db_conn.execute('SELECT anno, mese, persona, SUM(totale_cent) as totale FROM riepilogo_mensile WHERE tabella = ? AND (anno, mese) >= (?, ?) AND (anno, mese) < (?, ?) GROUP BY anno, mese, persona',
+                                  (tabella, anno_da, mese_da, anno_a, mese_a))
+        for row in cursore:
+            totali[(tabella, row['anno'], row['mese'], row['persona'])] = row['totale'] or 0
+    sommari_periodo = []
+    anno_iter, mese_iter = anno_da, mese_da
+    while (anno_iter, mese_iter) < (anno_a, mese_a):
+        sommari_mese = _componi_sommari(totali.get(('entrate', anno_iter, mese_iter, 'Giacomo'), 0), totali.get(('entrate', anno_iter, mese_iter, 'Erica'), 0),
+                                        totali.get(('spese', anno_iter, mese_iter, 'Giacomo'), 0), totali.get(('spese', anno_iter, mese_iter, 'Erica'), 0))
+        sommari_mese.update({'anno': anno_iter, 'mese': mese_iter})
+        sommari_periodo.append(sommari_mese)
+        anno_iter, mese_iter = mese_successivo(anno_iter, mese_iter)
+    return sommari_periodo
+
+@memorizza_per_mese
 def _get_dati_tabella_entrate(db_conn, anno, mese):
-    anno_mese_str = f"{anno:04d}-{mese:02d}"
-    raw_entrate = db_conn.execute('SELECT tipo_entrata, ricevuto_da, SUM(importo) as totale_parziale FROM entrate WHERE strftime("%Y-%m", data) = ? GROUP BY tipo_entrata, ricevuto_da ORDER BY LOWER(tipo_entrata), ricevuto_da', (anno_mese_str,)).fetchall()
+    raw_entrate = db_conn.execute("SELECT voce as tipo_entrata, persona as ricevuto_da, totale_cent as totale_parziale FROM riepilogo_mensile WHERE tabella = 'entrate' AND anno = ? AND mese = ? ORDER BY LOWER(voce), persona", (anno, mese)).fetchall()
     entrate_pivot = {}
     for row in raw_entrate:
-        tipo, ricevente, totale = row['tipo_entrata'], row['ricevuto_da'], row['totale_parziale'] or 0.0
-        if tipo not in entrate_pivot: entrate_pivot[tipo] = {'Giacomo': 0.0, 'Erica': 0.0, 'Totale': 0.0}
+        tipo, ricevente, totale = row['tipo_entrata'], row['ricevuto_da'], row['totale_parziale'] or 0
+        if tipo not in entrate_pivot: entrate_pivot[tipo] = {'Giacomo': 0, 'Erica': 0, 'Totale': 0}
         if ricevente == 'Giacomo': entrate_pivot[tipo]['Giacomo'] += totale
         elif ricevente == 'Erica': entrate_pivot[tipo]['Erica'] += totale
         entrate_pivot[tipo]['Totale'] += totale
@@ -104,13 +850,13 @@ def _get_dati_tabella_entrate(db_conn, anno, mese):
     display_list.sort(key=lambda x: x['tipo_entrata'].lower())
     return display_list
 
+@memorizza_per_mese
 def _get_dati_tabella_spese(db_conn, anno, mese):
-    anno_mese_str = f"{anno:04d}-{mese:02d}"
-    raw_spese = db_conn.execute('SELECT categoria, pagato_da, SUM(importo) as totale_parziale FROM spese WHERE strftime("%Y-%m", data) = ? GROUP BY categoria, pagato_da ORDER BY LOWER(categoria), pagato_da', (anno_mese_str,)).fetchall()
+    raw_spese = db_conn.execute("SELECT voce as categoria, persona as pagato_da, totale_cent as totale_parziale FROM riepilogo_mensile WHERE tabella = 'spese' AND anno = ? AND mese = ? ORDER BY LOWER(voce), persona", (anno, mese)).fetchall()
     spese_pivot = {}
     for row in raw_spese:
-        cat, pagante, totale = row['categoria'], row['pagato_da'], row['totale_parziale'] or 0.0
-        if cat not in spese_pivot: spese_pivot[cat] = {'Giacomo': 0.0, 'Erica': 0.0, 'Totale': 0.0}
+        cat, pagante, totale = row['categoria'], row['pagato_da'], row['totale_parziale'] or 0
+        if cat not in spese_pivot: spese_pivot[cat] = {'Giacomo': 0, 'Erica': 0, 'Totale': 0}
         if pagante == 'Giacomo': spese_pivot[cat]['Giacomo'] += totale
         elif pagante == 'Erica': spese_pivot[cat]['Erica'] += totale
         spese_pivot[cat]['Totale'] += totale
@@ -118,8 +864,28 @@ def _get_dati_tabella_spese(db_conn, anno, mese):
     display_list.sort(key=lambda x: x['categoria'].lower())
     return display_list
 
+# Per ogni tabella: chiave della voce e del totale nelle righe di _get_dati_tabella_entrate/_spese
+CHIAVI_RIGA_TABELLA = {'entrate': ('tipo_entrata', 'importo_totale'), 'spese': ('categoria', 'importo_totale_categoria')}
+
+def leggi_riga_tabella_mese(db_conn, tabella, anno, mese, voce):
+    # Una sola riga della tabella del mese (stesse chiavi di _get_dati_tabella_*): dalla cache se il mese
+    # è già stato calcolato, altrimenti dal riepilogo mensile per la sola voce richiesta
+    chiave_voce, chiave_totale = CHIAVI_RIGA_TABELLA[tabella]
+    righe_mese = cache_mesi.leggi(anno, mese, f'_get_dati_tabella_{tabella}', leggi_versione_mese(db_conn, anno, mese))
+    if righe_mese is not None:
+        for riga in righe_mese:
+            if riga[chiave_voce] == voce: return dict(riga)
+        return {chiave_voce: voce, 'importo_giacomo': 0, 'importo_erica': 0, chiave_totale: 0}
+    riga = {chiave_voce: voce, 'importo_giacomo': 0, 'importo_erica': 0, chiave_totale: 0}
+    for row in db_conn.execute('SELECT persona, totale_cent FROM riepilogo_mensile WHERE tabella = ? AND anno = ? AND mese = ? AND voce = ?', (tabella, anno, mese, voce)):
+        if row['persona'] == 'Giacomo': riga['importo_giacomo'] += row['totale_cent']
+        elif row['persona'] == 'Erica': riga['importo_erica'] += row['totale_cent']
+        riga[chiave_totale] += row['totale_cent']
+    return riga
+
 @app.route('/')
 @app.route('/<int:anno>/<int:mese>')
+@con_etag(mesi_pagina_mese)
 def index(anno=None, mese=None):
     oggi = datetime.today()
     if anno is None: anno = oggi.year
@@ -135,127 +901,189 @@ def index(anno=None, mese=None):
     anno_succ, mese_succ = primo_giorno_mese_successivo_dt.year, primo_giorno_mese_successivo_dt.month
 
     sommari_numerici_mese = {}
-    entrate_per_tabella = []
-    spese_per_tabella = []
+    frammenti = {}
     # Le variabili 'ultime_spese' sono state rimosse perché non più necessarie
     db = None
     try:
         db = get_db()
         sommari_numerici_mese = calcola_sommari_mese_numerici(db, anno, mese)
-        entrate_per_tabella = _get_dati_tabella_entrate(db, anno, mese)
-        spese_per_tabella = _get_dati_tabella_spese(db, anno, mese)
+        # Righe e piedi delle tabelle dalla cache dei frammenti
+        for template in ('_righe_tbody_entrate.html', '_righe_tfoot_entrate.html', '_righe_tbody_spese.html', '_righe_tfoot_spese.html'):
+            frammenti[template] = frammento_mese(db, template, anno, mese)
         # Le query per le ultime spese sono state rimosse
     except Exception as e:
         print(f"Errore nel caricamento dati per index: {e}"); flash("Errore caricamento dati.", "danger")
-    finally:
-        if db: db.close()
 
     return render_template('index.html',
                            titolo="Bilancio Mensile", nome_mese_corrente=nome_mese_corrente,
                            anno_prec=anno_prec, mese_prec=mese_prec, anno_succ=anno_succ, mese_succ=mese_succ,
                            current_anno=anno, current_mese=mese,
-                           entrate_giacomo=format_decimali_italiano(sommari_numerici_mese.get('entrate_giacomo', 0.0)),
-                           entrate_erica=format_decimali_italiano(sommari_numerici_mese.get('entrate_erica', 0.0)),
-                           spese_giacomo=format_decimali_italiano(sommari_numerici_mese.get('spese_giacomo', 0.0)),
-                           spese_erica=format_decimali_italiano(sommari_numerici_mese.get('spese_erica', 0.0)),
-                           risparmio_giacomo=format_decimali_italiano(sommari_numerici_mese.get('risparmio_giacomo', 0.0)),
-                           risparmio_erica=format_decimali_italiano(sommari_numerici_mese.get('risparmio_erica', 0.0)),
-                           totale_entrate_mese=format_decimali_italiano(sommari_numerici_mese.get('totale_entrate_mese', 0.0)),
-                           totale_spese_mese=format_decimali_italiano(sommari_numerici_mese.get('totale_spese_mese', 0.0)),
-                           risparmio_mese=format_decimali_italiano(sommari_numerici_mese.get('totale_risparmio_mese', 0.0)),
-                           val_entrate_giacomo_tf=sommari_numerici_mese.get('entrate_giacomo', 0.0),
-                           val_entrate_erica_tf=sommari_numerici_mese.get('entrate_erica', 0.0),
-                           val_totale_entrate_mese_tf=sommari_numerici_mese.get('totale_entrate_mese', 0.0),
-                           val_spese_giacomo_tf=sommari_numerici_mese.get('spese_giacomo', 0.0),
-                           val_spese_erica_tf=sommari_numerici_mese.get('spese_erica', 0.0),
-                           val_totale_spese_mese_tf=sommari_numerici_mese.get('totale_spese_mese', 0.0),
-                           entrate_mese_dettagliate=entrate_per_tabella,
-                           spese_mese_dettagliate=spese_per_tabella,
+                           entrate_giacomo=format_decimali_italiano(sommari_numerici_mese.get('entrate_giacomo', 0)),
+                           entrate_erica=format_decimali_italiano(sommari_numerici_mese.get('entrate_erica', 0)),
+                           spese_giacomo=format_decimali_italiano(sommari_numerici_mese.get('spese_giacomo', 0)),
+                           spese_erica=format_decimali_italiano(sommari_numerici_mese.get('spese_erica', 0)),
+                           risparmio_giacomo=format_decimali_italiano(sommari_numerici_mese.get('risparmio_giacomo', 0)),
+                           risparmio_erica=format_decimali_italiano(sommari_numerici_mese.get('risparmio_erica', 0)),
+                           totale_entrate_mese=format_decimali_italiano(sommari_numerici_mese.get('totale_entrate_mese', 0)),
+                           totale_spese_mese=format_decimali_italiano(sommari_numerici_mese.get('totale_spese_mese', 0)),
+                           risparmio_mese=format_decimali_italiano(sommari_numerici_mese.get('totale_risparmio_mese', 0)),
+                           html_tbody_entrate=frammenti.get('_righe_tbody_entrate.html', ''),
+                           html_tfoot_entrate=frammenti.get('_righe_tfoot_entrate.html', ''),
+                           html_tbody_spese=frammenti.get('_righe_tbody_spese.html', ''),
+                           html_tfoot_spese=frammenti.get('_righe_tfoot_spese.html', ''),
                            categorie_spesa_disponibili=CATEGORIE_SPESA, datetime=datetime)
 
+def _risposta_incrementale(tabella, voce, persona, importo_cent, sommari_precedenti, riga_precedente, anno, mese, messaggio):
+    # Aggiunge l'importo inserito ai valori precedenti del mese e rende solo la riga e il piede toccati
+    componenti = {chiave: sommari_precedenti[chiave] for chiave in ('entrate_giacomo', 'entrate_erica', 'spese_giacomo', 'spese_erica')}
+    componenti[f"{tabella}_{persona.lower()}"] += importo_cent
+    sommari = _componi_sommari(componenti['entrate_giacomo'], componenti['entrate_erica'], componenti['spese_giacomo'], componenti['spese_erica'])
+
+    chiave_voce, chiave_totale = CHIAVI_RIGA_TABELLA[tabella]
+    riga = dict(riga_precedente)
+    riga[f"importo_{persona.lower()}"] += importo_cent
+    riga[chiave_totale] += importo_cent
+
+    if tabella == 'spese':
+        html_riga = render_template('_riga_tbody_spese.html', spesa_agg=riga, current_anno=anno, current_mese=mese)
+        html_tfoot = render_template('_righe_tfoot_spese.html', spese_giacomo_tf=sommari['spese_giacomo'], spese_erica_tf=sommari['spese_erica'],
+                                     totale_spese_mese_tf=sommari['totale_spese_mese'])
+    else:
+        html_riga = render_template('_riga_tbody_entrate.html', entrata_agg=riga, current_anno=anno, current_mese=mese)
+        html_tfoot = render_template('_righe_tfoot_entrate.html', entrate_giacomo_tf=sommari['entrate_giacomo'], entrate_erica_tf=sommari['entrate_erica'],
+                                     totale_entrate_mese_tf=sommari['totale_entrate_mese'])
+
+    p = persona.lower()
+    return {
+        'status': 'successo', 'messaggio': messaggio,
+        'anno': anno, 'mese': mese, 'tabella': tabella, 'voce': voce,
+        'sommario_aggiornato': {
+            f"{tabella}_{p}_str": format_decimali_italiano(sommari[f"{tabella}_{p}"], con_euro=True),
+            f"totale_{tabella}_str": format_decimali_italiano(sommari[f"totale_{tabella}_mese"], con_euro=True),
+            f"risparmio_{p}_str": format_decimali_italiano(sommari[f"risparmio_{p}"], con_euro=True),
+            "totale_risparmio_str": format_decimali_italiano(sommari['totale_risparmio_mese'], con_euro=True)
+        },
+        'html_riga': html_riga,
+        'html_tfoot': html_tfoot
+    }
+
+def sommari_per_riquadri(sommari_numerici):
+    # Testi dei nove riquadri del sommario mensile, come li aggiorna la pagina
+    return {
+        "entrate_giacomo_str": format_decimali_italiano(sommari_numerici.get('entrate_giacomo', 0), con_euro=True),
+        "entrate_erica_str": format_decimali_italiano(sommari_numerici.get('entrate_erica', 0), con_euro=True),
+        "totale_entrate_str": format_decimali_italiano(sommari_numerici.get('totale_entrate_mese', 0), con_euro=True),
+        "spese_giacomo_str": format_decimali_italiano(sommari_numerici.get('spese_giacomo', 0), con_euro=True),
+        "spese_erica_str": format_decimali_italiano(sommari_numerici.get('spese_erica', 0), con_euro=True),
+        "totale_spese_str": format_decimali_italiano(sommari_numerici.get('totale_spese_mese', 0), con_euro=True),
+        "risparmio_giacomo_str": format_decimali_italiano(sommari_numerici.get('risparmio_giacomo', 0), con_euro=True),
+        "risparmio_erica_str": format_decimali_italiano(sommari_numerici.get('risparmio_erica', 0), con_euro=True),
+        "totale_risparmio_str": format_decimali_italiano(sommari_numerici.get('totale_risparmio_mese', 0), con_euro=True)
+    }
+
+def leggi_transazione(campi):
+    """Valida i campi del form 'Aggiungi transazione' (un dizionario o request.form) e restituisce
+    la tupla (tabella, data, descrizione, voce, importo_cent, persona). Le regole sono quelle di
+    valida_riga in import_dati.py: data AAAA-MM-GG, importo positivo, voce non vuota, persona valida.
+    Solleva ValueError con il messaggio da mostrare se un campo non è valido."""
+    tipo_transazione = campi.get('tipo_transazione')
+    data_str = campi.get('data')
+    importo_str = campi.get('importo')
+
+    if not all([tipo_transazione, data_str, importo_str]):
+        raise ValueError('Tipo transazione, data e importo sono obbligatori!')
+
+    messaggio_non_validi = "L'importo o la data inseriti non sono validi."
+    try:
+        importo_cent = euro_a_centesimi(importo_str)
+    except ValueError:
+        raise ValueError(messaggio_non_validi)
+    if importo_cent <= 0:
+        raise ValueError("L'importo deve essere un numero positivo.")
+    try:
+        datetime.strptime(data_str, '%Y-%m-%d')
+    except (ValueError, TypeError):
+        raise ValueError(messaggio_non_validi)
+
+    if tipo_transazione == 'spesa':
+        tabella = 'spese'
+        voce = campi.get('categoria_spesa_select')
+        descrizione = campi.get('descrizione_spesa')
+        persona = campi.get('pagato_da')
+        if not all([voce, persona]) or not str(voce).strip():
+            raise ValueError("Categoria e 'pagato da' sono obbligatori per una spesa!")
+    elif tipo_transazione == 'entrata':
+        tabella = 'entrate'
+        voce = campi.get('tipo_entrata_val')
+        descrizione = campi.get('descrizione_entrata')
+        persona = campi.get('ricevuto_da')
+        if not all([voce, persona]) or not str(voce).strip():
+            raise ValueError("Tipo entrata e 'ricevuto da' sono obbligatori!")
+    else:
+        raise ValueError('Tipo di transazione non valido.')
+    # Dal JSON di /sincronizza_transazioni possono arrivare numeri, liste o oggetti al posto del testo
+    if not all(isinstance(valore, str) for valore in (data_str, voce, persona)) or not isinstance(descrizione, (str, type(None))):
+        raise ValueError('Data, voce, descrizione e persona devono essere testo.')
+    if persona not in PERSONE_VALIDE:
+        raise ValueError(f"Persona non valida: '{persona}'.")
+
+    return (tabella, data_str, descrizione if descrizione else "", voce, importo_cent, persona)
+
+def inserisci_transazione(db_conn, tabella, data_str, descrizione, voce, importo_cent, persona):
+    colonna_voce, colonna_persona = COLONNE_RIEPILOGO[tabella]
+    cursore = db_conn.execute(f'INSERT INTO {tabella} (data, descrizione, {colonna_voce}, importo_cent, {colonna_persona}) VALUES (?, ?, ?, ?, ?)',
+                              (data_str, descrizione, voce, importo_cent, persona))
+    return cursore.lastrowid
+
 @app.route('/aggiungi_transazione', methods=['POST'])
 def aggiungi_transazione():
     if request.method == 'POST':
-        tipo_transazione = request.form.get('tipo_transazione')
-        data_str = request.form.get('data')
-        importo_str = request.form.get('importo')
-
-        if not all([tipo_transazione, data_str, importo_str]):
-            return jsonify({'status': 'errore', 'messaggio': 'Tipo transazione, data e importo sono obbligatori!'}), 400
-
         try:
-            importo = float(importo_str)
-            if importo <= 0:
-                return jsonify({'status': 'errore', 'messaggio': "L'importo deve essere un numero positivo."}), 400
-            data_transazione_dt = datetime.strptime(data_str, '%Y-%m-%d')
-        except ValueError:
-            return jsonify({'status': 'errore', 'messaggio': "L'importo o la data inseriti non sono validi."}), 400
+            tabella, data_str, descrizione, voce, importo_cent, persona = leggi_transazione(request.form)
+        except ValueError as e:
+            return jsonify({'status': 'errore', 'messaggio': str(e)}), 400
 
-        db = None
-        messaggio_successo_specifico = ""
-        html_tbody_entrate, html_tfoot_entrate = "", ""
-        html_tbody_spese, html_tfoot_spese = "", ""
+        # Con risposta=incrementale si restituiscono solo le parti della pagina che cambiano: i riquadri
+        # della persona, la riga della voce e il piede della tabella. I nuovi valori sono quelli
+        # precedenti (dalla cache del mese, o letti prima dell'inserimento) più l'importo inserito.
+        incrementale = request.form.get('risposta') == 'incrementale'
+        current_anno = int(data_str[:4])
+        current_mese = int(data_str[5:7])
 
+        db = None
         try:
             db = get_db()
 
-            if tipo_transazione == 'spesa':
-                categoria = request.form.get('categoria_spesa_select')
-                descrizione = request.form.get('descrizione_spesa')
-                pagato_da = request.form.get('pagato_da')
-                if not all([categoria, pagato_da]):
-                    return jsonify({'status': 'errore', 'messaggio': "Categoria e 'pagato da' sono obbligatori per una spesa!"}), 400
-                db.execute('INSERT INTO spese (data, descrizione, categoria, importo, pagato_da) VALUES (?, ?, ?, ?, ?)',
-                           (data_str, descrizione if descrizione else "", categoria, importo, pagato_da))
-                messaggio_successo_specifico = f"Spesa '{categoria}{' - ' + descrizione if descrizione else ''}' aggiunta!"
-            elif tipo_transazione == 'entrata':
-                tipo_entrata_val = request.form.get('tipo_entrata_val')
-                descrizione_entrata = request.form.get('descrizione_entrata')
-                ricevuto_da = request.form.get('ricevuto_da')
-                if not all([tipo_entrata_val, ricevuto_da]):
-                     return jsonify({'status': 'errore', 'messaggio': "Tipo entrata e 'ricevuto da' sono obbligatori!"}), 400
-                db.execute('INSERT INTO entrate (data, tipo_entrata, descrizione, importo, ricevuto_da) VALUES (?, ?, ?, ?, ?)',
-                           (data_str, tipo_entrata_val, descrizione_entrata if descrizione_entrata else "", importo, ricevuto_da))
-                messaggio_successo_specifico = f"Entrata '{tipo_entrata_val}{' - ' + descrizione_entrata if descrizione_entrata else ''}' aggiunta!"
+            if incrementale:
+                # I valori precedenti si leggono nella stessa transazione dell'inserimento
+                db.execute('BEGIN IMMEDIATE')
+                sommari_precedenti = calcola_sommari_mese_numerici(db, current_anno, current_mese)
+                riga_precedente = leggi_riga_tabella_mese(db, tabella, current_anno, current_mese, voce)
+
+            inserisci_transazione(db, tabella, data_str, descrizione, voce, importo_cent, persona)
+            if tabella == 'spese':
+                messaggio_successo_specifico = f"Spesa '{voce}{' - ' + descrizione if descrizione else ''}' aggiunta!"
             else:
-                return jsonify({'status': 'errore', 'messaggio': 'Tipo di transazione non valido.'}), 400
+                messaggio_successo_specifico = f"Entrata '{voce}{' - ' + descrizione if descrizione else ''}' aggiunta!"
             db.commit()
+            invalida_mesi(data_str)
 
-            current_anno = data_transazione_dt.year
-            current_mese = data_transazione_dt.month
-
-            sommari_numerici_agg = calcola_sommari_mese_numerici(db, current_anno, current_mese)
-
-            sommari_per_riquadri_json = {
-                "entrate_giacomo_str": format_decimali_italiano(sommari_numerici_agg.get('entrate_giacomo', 0.0), con_euro=True),
-                "entrate_erica_str": format_decimali_italiano(sommari_numerici_agg.get('entrate_erica', 0.0), con_euro=True),
-                "totale_entrate_str": format_decimali_italiano(sommari_numerici_agg.get('totale_entrate_mese', 0.0), con_euro=True),
-                "spese_giacomo_str": format_decimali_italiano(sommari_numerici_agg.get('spese_giacomo', 0.0), con_euro=True),
-                "spese_erica_str": format_decimali_italiano(sommari_numerici_agg.get('spese_erica', 0.0), con_euro=True),
-                "totale_spese_str": format_decimali_italiano(sommari_numerici_agg.get('totale_spese_mese', 0.0), con_euro=True),
-                "risparmio_giacomo_str": format_decimali_italiano(sommari_numerici_agg.get('risparmio_giacomo', 0.0), con_euro=True),
-                "risparmio_erica_str": format_decimali_italiano(sommari_numerici_agg.get('risparmio_erica', 0.0), con_euro=True),
-                "totale_risparmio_str": format_decimali_italiano(sommari_numerici_agg.get('totale_risparmio_mese', 0.0), con_euro=True)
-            }
+            if incrementale:
+                return jsonify(_risposta_incrementale(tabella, voce, persona, importo_cent, sommari_precedenti, riga_precedente,
+                                                      current_anno, current_mese, messaggio_successo_specifico))
 
-            entrate_per_tbody_aggiornate = _get_dati_tabella_entrate(db, current_anno, current_mese)
-            spese_per_tbody_aggiornate = _get_dati_tabella_spese(db, current_anno, current_mese)
+            sommari_per_riquadri_json = sommari_per_riquadri(calcola_sommari_mese_numerici(db, current_anno, current_mese))
 
-            html_tbody_entrate = render_template('_righe_tbody_entrate.html', entrate_mese_dettagliate=entrate_per_tbody_aggiornate, current_anno=current_anno, current_mese=current_mese)
-            html_tfoot_entrate = render_template('_righe_tfoot_entrate.html',
-                                                 entrate_giacomo_tf=sommari_numerici_agg.get('entrate_giacomo',0.0),
-                                                 entrate_erica_tf=sommari_numerici_agg.get('entrate_erica',0.0),
-                                                 totale_entrate_mese_tf=sommari_numerici_agg.get('totale_entrate_mese',0.0))
-
-            html_tbody_spese = render_template('_righe_tbody_spese.html', spese_mese_dettagliate=spese_per_tbody_aggiornate, current_anno=current_anno, current_mese=current_mese)
-            html_tfoot_spese = render_template('_righe_tfoot_spese.html',
-                                               spese_giacomo_tf=sommari_numerici_agg.get('spese_giacomo',0.0),
-                                               spese_erica_tf=sommari_numerici_agg.get('spese_erica',0.0),
-                                               totale_spese_mese_tf=sommari_numerici_agg.get('totale_spese_mese',0.0))
+            # Frammenti della nuova versione del mese: restano in cache anche per la prossima visita alla pagina
+            html_tbody_entrate = frammento_mese(db, '_righe_tbody_entrate.html', current_anno, current_mese)
+            html_tfoot_entrate = frammento_mese(db, '_righe_tfoot_entrate.html', current_anno, current_mese)
+            html_tbody_spese = frammento_mese(db, '_righe_tbody_spese.html', current_anno, current_mese)
+            html_tfoot_spese = frammento_mese(db, '_righe_tfoot_spese.html', current_anno, current_mese)
 
             return jsonify({
                 'status': 'successo',
                 'messaggio': messaggio_successo_specifico,
+                'anno': current_anno, 'mese': current_mese,
                 'sommario_aggiornato': sommari_per_riquadri_json,
                 'html_tbody_entrate': html_tbody_entrate,
                 'html_tfoot_entrate': html_tfoot_entrate,
@@ -264,17 +1092,303 @@ def aggiungi_transazione():
             })
 
         except sqlite3.Error as e:
+            if db is not None and db.in_transaction: db.rollback()
             print(f"Errore SQLite in aggiungi_transazione: {e}")
             return jsonify({'status': 'errore', 'messaggio': f"Errore database: {e}"}), 500
         except Exception as e_gen:
+            if db is not None and db.in_transaction: db.rollback()
             print(f"Errore generico in aggiungi_transazione: {e_gen}")
             return jsonify({'status': 'errore', 'messaggio': f"Errore generico: {e_gen}"}), 500
-        finally:
-            if db: db.close()
 
     return jsonify({'status': 'errore', 'messaggio': 'Richiesta non POST.'}), 405
 
+# --- Sincronizzazione delle transazioni inserite offline ---
+# Il service worker mette in coda le transazioni aggiunte senza rete e le invia tutte insieme alla
+# riconnessione: una richiesta e un solo commit per l'intera coda. Ogni transazione ha un id_client
+# generato dal browser; gli id già ricevuti sono in 'transazioni_sincronizzate', così un invio ripetuto
+# (es. risposta persa per strada) non crea doppioni.
+NUMERO_MASSIMO_TRANSAZIONI_PER_RICHIESTA = 500
+LUNGHEZZA_MASSIMA_ID_CLIENT = 64
+
+def leggi_lista_transazioni():
+    """Lista 'transazioni' dal corpo JSON della richiesta. Restituisce (transazioni, None),
+    oppure (None, risposta di errore) se il corpo non è valido o la lista è troppo lunga."""
+    dati = request.get_json(silent=True)
+    transazioni = dati.get('transazioni') if isinstance(dati, dict) else None
+    if not isinstance(transazioni, list):
+        return None, (jsonify({'status': 'errore', 'messaggio': "Il corpo deve essere un oggetto JSON con la lista 'transazioni'."}), 400)
+    if len(transazioni) > NUMERO_MASSIMO_TRANSAZIONI_PER_RICHIESTA:
+        return None, (jsonify({'status': 'errore', 'messaggio': f"Al massimo {NUMERO_MASSIMO_TRANSAZIONI_PER_RICHIESTA} transazioni per richiesta."}), 413)
+    return transazioni, None
+
+@app.route('/sincronizza_transazioni', methods=['POST'])
+def sincronizza_transazioni():
+    transazioni, errore = leggi_lista_transazioni()
+    if errore: return errore
+
+    # Le transazioni non valide non verranno mai accettate: tornano come errore e il client le toglie dalla coda
+    risultati = []
+    valide = []
+    id_visti = set()
+    for campi in transazioni:
+        id_client = campi.get('id_client') if isinstance(campi, dict) else None
+        if not isinstance(id_client, str) or not id_client or len(id_client) > LUNGHEZZA_MASSIMA_ID_CLIENT:
+            risultati.append({'id_client': None, 'esito': 'errore', 'messaggio': 'Identificativo client mancante o non valido.'})
+            continue
+        if id_client in id_visti:
+            risultati.append({'id_client': id_client, 'esito': 'duplicata'})
+            continue
+        id_visti.add(id_client)
+        try:
+            valide.append((id_client, leggi_transazione(campi)))
+        except ValueError as e:
+            risultati.append({'id_client': id_client, 'esito': 'errore', 'messaggio': str(e)})
+
+    db = None
+    date_inserite = []
+    try:
+        db = get_db()
+        db.execute('BEGIN IMMEDIATE')
+        for id_client, transazione in valide:
+            gia_ricevuta = db.execute('SELECT tabella, id_transazione FROM transazioni_sincronizzate WHERE id_client = ?', (id_client,)).fetchone()
+            if gia_ricevuta:
+                risultati.append({'id_client': id_client, 'esito': 'duplicata', 'tabella': gia_ricevuta['tabella'], 'id': gia_ricevuta['id_transazione']})
+                continue
+            id_transazione = inserisci_transazione(db, *transazione)
+            db.execute('INSERT INTO transazioni_sincronizzate (id_client, tabella, id_transazione) VALUES (?, ?, ?)',
+                       (id_client, transazione[0], id_transazione))
+            date_inserite.append(transazione[1])
+            risultati.append({'id_client': id_client, 'esito': 'inserita', 'tabella': transazione[0], 'id': id_transazione})
+        db.commit()
+    except sqlite3.Error as e:
+        if db is not None and db.in_transaction: db.rollback()
+        print(f"Errore SQLite in sincronizza_transazioni: {e}")
+        return jsonify({'status': 'errore', 'messaggio': f"Errore database: {e}"}), 500
+    invalida_mesi(*date_inserite)
+
+    return jsonify({'status': 'successo', 'inserite': len(date_inserite), 'risultati': risultati})
+
+# --- Inserimento di più transazioni ---
+# Per le voci ricorrenti (affitto, abbonamenti, rate): una richiesta con tutte le transazioni, campi come
+# nel form 'Aggiungi transazione'. Le valide vengono inserite con executemany in un'unica transazione,
+# quelle non valide tornano con il loro errore; i sommari si ricalcolano una volta per ogni mese toccato.
+@app.route('/aggiungi_transazioni', methods=['POST'])
+def aggiungi_transazioni():
+    transazioni, errore = leggi_lista_transazioni()
+    if errore: return errore
+
+    risultati = []
+    righe_per_tabella = {'spese': [], 'entrate': []}
+    for indice, campi in enumerate(transazioni):
+        try:
+            if not isinstance(campi, dict):
+                raise ValueError('Ogni transazione deve essere un oggetto JSON.')
+            tabella, data_str, descrizione, voce, importo_cent, persona = leggi_transazione(campi)
+        except ValueError as e:
+            risultati.append({'indice': indice, 'esito': 'errore', 'messaggio': str(e)})
+            continue
+        righe_per_tabella[tabella].append((data_str, descrizione, voce, importo_cent, persona))
+        risultati.append({'indice': indice, 'esito': 'inserita', 'tabella': tabella})
+
+    date_inserite = [riga[0] for righe in righe_per_tabella.values() for riga in righe]
+    db = None
+    try:
+        db = get_db()
+        if date_inserite:
+            db.execute('BEGIN IMMEDIATE')
+            for tabella, righe in righe_per_tabella.items():
+                if not righe: continue
+                colonna_voce, colonna_persona = COLONNE_RIEPILOGO[tabella]
+                db.executemany(f'INSERT INTO {tabella} (data, descrizione, {colonna_voce}, importo_cent, {colonna_persona}) VALUES (?, ?, ?, ?, ?)', righe)
+            db.commit()
+            invalida_mesi(*date_inserite)
+
+        mesi = sorted({(int(data_str[:4]), int(data_str[5:7])) for data_str in date_inserite})
+        sommari_mesi = [{'anno': anno, 'mese': mese, 'sommario_aggiornato': sommari_per_riquadri(calcola_sommari_mese_numerici(db, anno, mese))}
+                        for anno, mese in mesi]
+    except sqlite3.Error as e:
+        if db is not None and db.in_transaction: db.rollback()
+        print(f"Errore SQLite in aggiungi_transazioni: {e}")
+        return jsonify({'status': 'errore', 'messaggio': f"Errore database: {e}"}), 500
+
+    status = 'successo' if len(date_inserite) == len(transazioni) else ('parziale' if date_inserite else 'errore')
+    return jsonify({'status': status, 'inserite': len(date_inserite), 'risultati': risultati, 'mesi': sommari_mesi})
+
+def dati_report_vuoti(periodo_visualizzato_str):
+    # _# MODIFICA_: Aggiunte nuove chiavi per il report top_spender
+    return {
+        "periodo_visualizzato_str": periodo_visualizzato_str,
+        "messaggio_placeholder": "",
+        "lista_risparmi_mensili": [], "medie_risparmi": None,
+        "chart_labels": [], "chart_data_giacomo": [], "chart_data_erica": [], "chart_data_totale": [],
+        "dettaglio_spese_categoria": [], "chart_spese_giacomo": None, "chart_spese_erica": None,
+        "dettaglio_entrate_tipo": [], "medie_entrate": None,
+        "chart_entrate_labels": [], "chart_entrate_data_giacomo": [],
+        "chart_entrate_data_erica": [], "chart_entrate_data_totale": [],
+        "forecast_report": None,
+        "top_spese_totali": [], "top_spese_giacomo": [], "top_spese_erica": [],
+        "totale_entrate_periodo_str": "0 €", "totale_spese_periodo_str": "0 €",
+        # Valori in centesimi usati dall'API JSON (le pagine usano le versioni per i grafici e le stringhe)
+        "entrate_mensili": [], "totale_entrate_periodo": 0, "totale_spese_periodo": 0
+    }
+
+def calcola_dati_report(db, report_type, start_date, end_date_exclusive, top_n, dati_stat):
+    # Riempie dati_stat (vedi dati_report_vuoti) con i dati del report nel periodo [start_date, end_date_exclusive).
+    # Usata dalla pagina statistiche e dall'API JSON.
+    num_mesi_periodo = 0
+    temp_date_for_count = start_date
+    while temp_date_for_count < end_date_exclusive:
+        num_mesi_periodo += 1
+        if temp_date_for_count.month == 12:
+            temp_date_for_count = datetime(temp_date_for_count.year + 1, 1, 1)
+        else:
+            temp_date_for_count = datetime(temp_date_for_count.year, temp_date_for_count.month + 1, 1)
+    if num_mesi_periodo == 0: num_mesi_periodo = 1
+
+    sommari_periodo = []
+    if report_type in ('risparmi', 'entrate_tipo'):
+        sommari_periodo = calcola_sommari_periodo(db, start_date.year, start_date.month, end_date_exclusive.year, end_date_exclusive.month)
+
+    if report_type == 'risparmi':
+        for sommari_mese_iter in sommari_periodo:
+            anno_iter, mese_iter = sommari_mese_iter['anno'], sommari_mese_iter['mese']
+            nome_mese_display = f"{MESI_ITALIANI.get(mese_iter, '')} {anno_iter}"
+            dati_stat["lista_risparmi_mensili"].append({'periodo': nome_mese_display,'anno': anno_iter,'mese': mese_iter,'risparmio_giacomo': sommari_mese_iter.get('risparmio_giacomo', 0),'risparmio_erica': sommari_mese_iter.get('risparmio_erica', 0),'risparmio_totale': sommari_mese_iter.get('totale_risparmio_mese', 0)})
+            # I grafici ricevono i valori in euro, le tabelle in centesimi (li formatta il filtro)
+            dati_stat["chart_labels"].append(nome_mese_display)
+            dati_stat["chart_data_giacomo"].append(sommari_mese_iter.get('risparmio_giacomo', 0) / 100)
+            dati_stat["chart_data_erica"].append(sommari_mese_iter.get('risparmio_erica', 0) / 100)
+            dati_stat["chart_data_totale"].append(sommari_mese_iter.get('totale_risparmio_mese', 0) / 100)
+        if dati_stat["lista_risparmi_mensili"]:
+            num_items = len(dati_stat["lista_risparmi_mensili"])
+            dati_stat["medie_risparmi"] = {"giacomo": sum(item['risparmio_giacomo'] for item in dati_stat["lista_risparmi_mensili"]) / num_items,"erica": sum(item['risparmio_erica'] for item in dati_stat["lista_risparmi_mensili"]) / num_items,"totale": sum(item['risparmio_totale'] for item in dati_stat["lista_risparmi_mensili"]) / num_items}
+        if not dati_stat["lista_risparmi_mensili"]:
+             dati_stat["messaggio_placeholder"] = "Nessun dato di risparmio trovato per il periodo."
+
+    elif report_type == 'spese_categoria':
+        spese_cat_periodo_raw = {}
+        date_from_sql = start_date.strftime('%Y-%m-%d')
+        date_to_sql = end_date_exclusive.strftime('%Y-%m-%d')
+        for row in leggi_totali_periodo(db, 'spese', date_from_sql, date_to_sql, ('voce', 'persona')):
+            cat, pagante, totale = row['voce'], row['persona'], row['totale'] or 0
+            if cat not in spese_cat_periodo_raw: spese_cat_periodo_raw[cat] = {'Giacomo': 0, 'Erica': 0, 'Totale': 0}
+            if pagante in spese_cat_periodo_raw[cat]: spese_cat_periodo_raw[cat][pagante] += totale
+            spese_cat_periodo_raw[cat]['Totale'] += totale
+        chart_g_labels, chart_g_data = [], []
+        chart_e_labels, chart_e_data = [], []
+        for cat_key in sorted(spese_cat_periodo_raw.keys(), key=lambda x: x.lower()):
+            data_cat = spese_cat_periodo_raw[cat_key]
+            media_mensile = (data_cat['Totale'] / num_mesi_periodo) if num_mesi_periodo > 0 else 0
+            dati_stat['dettaglio_spese_categoria'].append({'categoria': cat_key,'spesa_giacomo': data_cat['Giacomo'],'spesa_erica': data_cat['Erica'],'spesa_totale': data_cat['Totale'],'media_mensile': media_mensile})
+            if data_cat['Giacomo'] > 0: chart_g_labels.append(cat_key); chart_g_data.append(data_cat['Giacomo'] / 100)
+            if data_cat['Erica'] > 0: chart_e_labels.append(cat_key); chart_e_data.append(data_cat['Erica'] / 100)
+        dati_stat['chart_spese_giacomo'] = {'labels': chart_g_labels, 'data': chart_g_data}
+        dati_stat['chart_spese_erica'] = {'labels': chart_e_labels, 'data': chart_e_data}
+        if not dati_stat['dettaglio_spese_categoria']:
+            dati_stat["messaggio_placeholder"] = "Nessuna spesa trovata per il periodo selezionato."
+
+    elif report_type == 'entrate_tipo':
+        entrate_tipo_periodo_raw = {}
+        date_from_sql = start_date.strftime('%Y-%m-%d')
+        date_to_sql = end_date_exclusive.strftime('%Y-%m-%d')
+        for row in leggi_totali_periodo(db, 'entrate', date_from_sql, date_to_sql, ('voce', 'persona')):
+            tipo, ricevente, totale = row['voce'], row['persona'], row['totale'] or 0
+            if tipo not in entrate_tipo_periodo_raw: entrate_tipo_periodo_raw[tipo] = {'Giacomo': 0, 'Erica': 0, 'Totale': 0}
+            if ricevente in entrate_tipo_periodo_raw[tipo]: entrate_tipo_periodo_raw[tipo][ricevente] += totale
+            entrate_tipo_periodo_raw[tipo]['Totale'] += totale
+        for tipo_key in sorted(entrate_tipo_periodo_raw.keys(), key=lambda x: x.lower()):
+            data_tipo = entrate_tipo_periodo_raw[tipo_key]
+            dati_stat['dettaglio_entrate_tipo'].append({'tipo': tipo_key,'entrata_giacomo': data_tipo['Giacomo'],'entrata_erica': data_tipo['Erica'],'entrata_totale': data_tipo['Totale']})
+        total_sum_entrate_giacomo_periodo, total_sum_entrate_erica_periodo = 0, 0
+        for sommari_mese in sommari_periodo:
+            anno_iter, mese_iter = sommari_mese['anno'], sommari_mese['mese']
+            entrate_g, entrate_e = sommari_mese.get('entrate_giacomo', 0), sommari_mese.get('entrate_erica', 0)
+            dati_stat["chart_entrate_labels"].append(f"{MESI_ITALIANI.get(mese_iter, '')[:3]} {anno_iter}")
+            dati_stat["chart_entrate_data_giacomo"].append(entrate_g / 100)
+            dati_stat["chart_entrate_data_erica"].append(entrate_e / 100)
+            dati_stat["chart_entrate_data_totale"].append((entrate_g + entrate_e) / 100)
+            dati_stat["entrate_mensili"].append((anno_iter, mese_iter, entrate_g, entrate_e, entrate_g + entrate_e))
+            total_sum_entrate_giacomo_periodo += entrate_g
+            total_sum_entrate_erica_periodo += entrate_e
+        avg_g = (total_sum_entrate_giacomo_periodo / num_mesi_periodo) if num_mesi_periodo > 0 else 0
+        avg_e = (total_sum_entrate_erica_periodo / num_mesi_periodo) if num_mesi_periodo > 0 else 0
+        dati_stat['medie_entrate'] = {'giacomo': avg_g, 'erica': avg_e, 'totale': avg_g + avg_e}
+        if not dati_stat['dettaglio_entrate_tipo'] and not dati_stat["chart_entrate_labels"]:
+             dati_stat["messaggio_placeholder"] = "Nessuna entrata trovata per il periodo selezionato."
+
+    elif report_type == 'rapporto_entrate_spese':
+        date_from_sql = start_date.strftime('%Y-%m-%d')
+        date_to_sql = end_date_exclusive.strftime('%Y-%m-%d')
+
+        totali_entrate = totali_per_persona(leggi_totali_periodo(db, 'entrate', date_from_sql, date_to_sql, ('persona',)))
+        totali_spese = totali_per_persona(leggi_totali_periodo(db, 'spese', date_from_sql, date_to_sql, ('persona',)))
+
+        def get_forecast_data(persona_filter=None):
+            totale_entrate = totali_entrate[persona_filter or 'Totale']
+            totale_spese = totali_spese[persona_filter or 'Totale']
+
+            media_e = totale_entrate / num_mesi_periodo
+            media_s = totale_spese / num_mesi_periodo
+            forecast_e = media_e * 12
+            forecast_s = media_s * 12
+
+            return {
+                'media_entrate': media_e, 'media_spese': media_s, 'media_risparmio': media_e - media_s,
+                'forecast_entrate': forecast_e, 'forecast_spese': forecast_s, 'forecast_risparmio': forecast_e - forecast_s,
+                'rapporto_percentuale': (forecast_s / forecast_e * 100) if forecast_e > 0 else 0
+            }
+
+        dati_stat['forecast_report'] = {
+            'periodo_mesi': num_mesi_periodo,
+            'totale': get_forecast_data(),
+            'giacomo': get_forecast_data('Giacomo'),
+            'erica': get_forecast_data('Erica')
+        }
+
+        if dati_stat['forecast_report']['totale']['media_entrate'] == 0 and dati_stat['forecast_report']['totale']['media_spese'] == 0:
+            dati_stat["messaggio_placeholder"] = "Nessun dato di entrata o spesa trovato per il periodo per generare il report."
+            dati_stat['forecast_report'] = None
+
+    # _# MODIFICA_: Logica per il nuovo report "Top Spender"
+    elif report_type == 'top_spender':
+        date_from_sql = start_date.strftime('%Y-%m-%d')
+        date_to_sql = end_date_exclusive.strftime('%Y-%m-%d')
+
+        totale_entrate_periodo = totali_per_persona(leggi_totali_periodo(db, 'entrate', date_from_sql, date_to_sql, ('persona',)))['Totale']
+        totale_spese_periodo = totali_per_persona(leggi_totali_periodo(db, 'spese', date_from_sql, date_to_sql, ('persona',)))['Totale']
+
+        dati_stat['totale_entrate_periodo'], dati_stat['totale_spese_periodo'] = totale_entrate_periodo, totale_spese_periodo
+        dati_stat['totale_entrate_periodo_str'] = format_decimali_italiano(totale_entrate_periodo)
+        dati_stat['totale_spese_periodo_str'] = format_decimali_italiano(totale_spese_periodo)
+
+        # Una sola query: le posizioni nella classifica totale e in quella della persona si calcolano
+        # con ROW_NUMBER() sulla sola coppia (importo_cent, pagato_da) letta dall'indice
+        # idx_spese_data_importo; il resto della riga si legge solo per le spese in classifica.
+        # Le percentuali arrivano già calcolate dalla query.
+        righe_classifica = db.execute('''
+            WITH classifica AS (
+                SELECT id,
+                       ROW_NUMBER() OVER (ORDER BY importo_cent DESC, id) AS posizione_totale,
+                       ROW_NUMBER() OVER (PARTITION BY pagato_da ORDER BY importo_cent DESC, id) AS posizione_persona
+                FROM spese WHERE data >= ? AND data < ?
+            )
+            SELECT s.data, s.categoria, s.descrizione, s.importo_cent, s.pagato_da, c.posizione_totale, c.posizione_persona,
+                   COALESCE(s.importo_cent * 100.0 / NULLIF(?, 0), 0) AS perc_su_entrate,
+                   COALESCE(s.importo_cent * 100.0 / NULLIF(?, 0), 0) AS perc_su_spese
+            FROM classifica c JOIN spese s ON s.id = c.id
+            WHERE c.posizione_totale <= ? OR c.posizione_persona <= ?
+            ORDER BY s.importo_cent DESC, s.id''',
+            (date_from_sql, date_to_sql, totale_entrate_periodo, totale_spese_periodo, top_n, top_n)).fetchall()
+
+        dati_stat['top_spese_totali'] = [riga for riga in righe_classifica if riga['posizione_totale'] <= top_n]
+        dati_stat['top_spese_giacomo'] = [riga for riga in righe_classifica if riga['pagato_da'] == 'Giacomo' and riga['posizione_persona'] <= top_n]
+        dati_stat['top_spese_erica'] = [riga for riga in righe_classifica if riga['pagato_da'] == 'Erica' and riga['posizione_persona'] <= top_n]
+
+        if not dati_stat['top_spese_totali']:
+            dati_stat["messaggio_placeholder"] = "Nessuna spesa trovata nel periodo selezionato per generare il report 'Top Spender'."
+
 @app.route('/statistiche', methods=['GET', 'POST'])
+@con_etag(mesi_pagina_statistiche)
 def statistiche():
     oggi = datetime.today()
     anni_disponibili = list(range(oggi.year - 5, oggi.year + 2))
@@ -286,6 +1400,8 @@ def statistiche():
     selected_anno_a = form_data.get('anno_a', default=oggi.year, type=int)
     selected_mese_a = form_data.get('mese_a', default=oggi.month, type=int)
     selected_report_type = form_data.get('report_type', default='risparmi')
+    selected_top_n = form_data.get('top_n', default=TOP_N_DISPONIBILI[0], type=int)
+    if selected_top_n not in TOP_N_DISPONIBILI: selected_top_n = TOP_N_DISPONIBILI[0]
 
     form_submitted = bool(request.form) or bool(request.args.get('anno_da'))
 
@@ -293,20 +1409,7 @@ def statistiche():
     nome_mese_a_str = MESI_ITALIANI.get(selected_mese_a, '')
     periodo_visualizzato_str = f"Da {nome_mese_da_str} {selected_anno_da} a {nome_mese_a_str} {selected_anno_a}"
 
-    # _# MODIFICA_: Aggiunte nuove chiavi per il report top_spender
-    dati_stat = {
-        "periodo_visualizzato_str": periodo_visualizzato_str,
-        "messaggio_placeholder": "",
-        "lista_risparmi_mensili": [], "medie_risparmi": None,
-        "chart_labels": [], "chart_data_giacomo": [], "chart_data_erica": [], "chart_data_totale": [],
-        "dettaglio_spese_categoria": [], "chart_spese_giacomo": None, "chart_spese_erica": None,
-        "dettaglio_entrate_tipo": [], "medie_entrate": None,
-        "chart_entrate_labels": [], "chart_entrate_data_giacomo": [],
-        "chart_entrate_data_erica": [], "chart_entrate_data_totale": [],
-        "forecast_report": None,
-        "top_spese_totali": [], "top_spese_giacomo": [], "top_spese_erica": [],
-        "totale_entrate_periodo_str": "0 €", "totale_spese_periodo_str": "0 €"
-    }
+    dati_stat = dati_report_vuoti(periodo_visualizzato_str)
 
     if form_submitted:
         db = None
@@ -322,168 +1425,7 @@ def statistiche():
                 flash("Il periodo 'Da' deve essere precedente al periodo 'A'.", "warning")
                 dati_stat["messaggio_placeholder"] = "Periodo non valido: 'Da' deve precedere 'A'."
             else:
-                num_mesi_periodo = 0
-                temp_date_for_count = start_date
-                while temp_date_for_count < end_date_exclusive:
-                    num_mesi_periodo += 1
-                    if temp_date_for_count.month == 12:
-                        temp_date_for_count = datetime(temp_date_for_count.year + 1, 1, 1)
-                    else:
-                        temp_date_for_count = datetime(temp_date_for_count.year, temp_date_for_count.month + 1, 1)
-                if num_mesi_periodo == 0: num_mesi_periodo = 1
-
-                if selected_report_type == 'risparmi':
-                    current_date_iter = start_date
-                    while current_date_iter < end_date_exclusive:
-                        anno_iter, mese_iter = current_date_iter.year, current_date_iter.month
-                        sommari_mese_iter = calcola_sommari_mese_numerici(db, anno_iter, mese_iter)
-                        nome_mese_display = f"{MESI_ITALIANI.get(mese_iter, '')} {anno_iter}"
-                        dati_stat["lista_risparmi_mensili"].append({'periodo': nome_mese_display,'risparmio_giacomo': sommari_mese_iter.get('risparmio_giacomo', 0.0),'risparmio_erica': sommari_mese_iter.get('risparmio_erica', 0.0),'risparmio_totale': sommari_mese_iter.get('totale_risparmio_mese', 0.0)})
-                        dati_stat["chart_labels"].append(nome_mese_display)
-                        dati_stat["chart_data_giacomo"].append(sommari_mese_iter.get('risparmio_giacomo', 0.0))
-                        dati_stat["chart_data_erica"].append(sommari_mese_iter.get('risparmio_erica', 0.0))
-                        dati_stat["chart_data_totale"].append(sommari_mese_iter.get('totale_risparmio_mese', 0.0))
-                        if current_date_iter.month == 12: current_date_iter = datetime(current_date_iter.year + 1, 1, 1)
-                        else: current_date_iter = datetime(current_date_iter.year, current_date_iter.month + 1, 1)
-                    if dati_stat["lista_risparmi_mensili"]:
-                        num_items = len(dati_stat["lista_risparmi_mensili"])
-                        dati_stat["medie_risparmi"] = {"giacomo": sum(item['risparmio_giacomo'] for item in dati_stat["lista_risparmi_mensili"]) / num_items,"erica": sum(item['risparmio_erica'] for item in dati_stat["lista_risparmi_mensili"]) / num_items,"totale": sum(item['risparmio_totale'] for item in dati_stat["lista_risparmi_mensili"]) / num_items}
-                    if not dati_stat["lista_risparmi_mensili"]:
-                         dati_stat["messaggio_placeholder"] = "Nessun dato di risparmio trovato per il periodo."
-
-                elif selected_report_type == 'spese_categoria':
-                    spese_cat_periodo_raw = {}
-                    date_from_sql = start_date.strftime('%Y-%m-%d')
-                    date_to_sql = end_date_exclusive.strftime('%Y-%m-%d')
-                    query_spese = """SELECT categoria, pagato_da, SUM(importo) as totale_cat_persona FROM spese WHERE data >= ? AND data < ? GROUP BY categoria, pagato_da ORDER BY LOWER(categoria), pagato_da"""
-                    cursor_spese = db.execute(query_spese, (date_from_sql, date_to_sql))
-                    for row in cursor_spese.fetchall():
-                        cat, pagante, totale = row['categoria'], row['pagato_da'], row['totale_cat_persona'] or 0.0
-                        if cat not in spese_cat_periodo_raw: spese_cat_periodo_raw[cat] = {'Giacomo': 0.0, 'Erica': 0.0, 'Totale': 0.0}
-                        if pagante in spese_cat_periodo_raw[cat]: spese_cat_periodo_raw[cat][pagante] += totale
-                        spese_cat_periodo_raw[cat]['Totale'] += totale
-                    chart_g_labels, chart_g_data = [], []
-                    chart_e_labels, chart_e_data = [], []
-                    for cat_key in sorted(spese_cat_periodo_raw.keys(), key=lambda x: x.lower()):
-                        data_cat = spese_cat_periodo_raw[cat_key]
-                        media_mensile = (data_cat['Totale'] / num_mesi_periodo) if num_mesi_periodo > 0 else 0.0
-                        dati_stat['dettaglio_spese_categoria'].append({'categoria': cat_key,'spesa_giacomo': data_cat['Giacomo'],'spesa_erica': data_cat['Erica'],'spesa_totale': data_cat['Totale'],'media_mensile': media_mensile})
-                        if data_cat['Giacomo'] > 0: chart_g_labels.append(cat_key); chart_g_data.append(data_cat['Giacomo'])
-                        if data_cat['Erica'] > 0: chart_e_labels.append(cat_key); chart_e_data.append(data_cat['Erica'])
-                    dati_stat['chart_spese_giacomo'] = {'labels': chart_g_labels, 'data': chart_g_data}
-                    dati_stat['chart_spese_erica'] = {'labels': chart_e_labels, 'data': chart_e_data}
-                    if not dati_stat['dettaglio_spese_categoria']:
-                        dati_stat["messaggio_placeholder"] = "Nessuna spesa trovata per il periodo selezionato."
-
-                elif selected_report_type == 'entrate_tipo':
-                    entrate_tipo_periodo_raw = {}
-                    date_from_sql = start_date.strftime('%Y-%m-%d')
-                    date_to_sql = end_date_exclusive.strftime('%Y-%m-%d')
-                    query_entrate = """SELECT tipo_entrata, ricevuto_da, SUM(importo) as totale_tipo_persona FROM entrate WHERE data >= ? AND data < ? GROUP BY tipo_entrata, ricevuto_da ORDER BY LOWER(tipo_entrata), ricevuto_da"""
-                    cursor_entrate = db.execute(query_entrate, (date_from_sql, date_to_sql))
-                    for row in cursor_entrate.fetchall():
-                        tipo, ricevente, totale = row['tipo_entrata'], row['ricevuto_da'], row['totale_tipo_persona'] or 0.0
-                        if tipo not in entrate_tipo_periodo_raw: entrate_tipo_periodo_raw[tipo] = {'Giacomo': 0.0, 'Erica': 0.0, 'Totale': 0.0}
-                        if ricevente in entrate_tipo_periodo_raw[tipo]: entrate_tipo_periodo_raw[tipo][ricevente] += totale
-                        entrate_tipo_periodo_raw[tipo]['Totale'] += totale
-                    for tipo_key in sorted(entrate_tipo_periodo_raw.keys(), key=lambda x: x.lower()):
-                        data_tipo = entrate_tipo_periodo_raw[tipo_key]
-                        dati_stat['dettaglio_entrate_tipo'].append({'tipo': tipo_key,'entrata_giacomo': data_tipo['Giacomo'],'entrata_erica': data_tipo['Erica'],'entrata_totale': data_tipo['Totale']})
-                    total_sum_entrate_giacomo_periodo, total_sum_entrate_erica_periodo = 0, 0
-                    current_date_iter = start_date
-                    while current_date_iter < end_date_exclusive:
-                        anno_iter, mese_iter = current_date_iter.year, current_date_iter.month
-                        sommari_mese = calcola_sommari_mese_numerici(db, anno_iter, mese_iter)
-                        entrate_g, entrate_e = sommari_mese.get('entrate_giacomo', 0.0), sommari_mese.get('entrate_erica', 0.0)
-                        dati_stat["chart_entrate_labels"].append(f"{MESI_ITALIANI.get(mese_iter, '')[:3]} {anno_iter}")
-                        dati_stat["chart_entrate_data_giacomo"].append(entrate_g)
-                        dati_stat["chart_entrate_data_erica"].append(entrate_e)
-                        dati_stat["chart_entrate_data_totale"].append(entrate_g + entrate_e)
-                        total_sum_entrate_giacomo_periodo += entrate_g
-                        total_sum_entrate_erica_periodo += entrate_e
-                        if current_date_iter.month == 12: current_date_iter = datetime(current_date_iter.year + 1, 1, 1)
-                        else: current_date_iter = datetime(current_date_iter.year, current_date_iter.month + 1, 1)
-                    avg_g = (total_sum_entrate_giacomo_periodo / num_mesi_periodo) if num_mesi_periodo > 0 else 0.0
-                    avg_e = (total_sum_entrate_erica_periodo / num_mesi_periodo) if num_mesi_periodo > 0 else 0.0
-                    dati_stat['medie_entrate'] = {'giacomo': avg_g, 'erica': avg_e, 'totale': avg_g + avg_e}
-                    if not dati_stat['dettaglio_entrate_tipo'] and not dati_stat["chart_entrate_labels"]:
-                         dati_stat["messaggio_placeholder"] = "Nessuna entrata trovata per il periodo selezionato."
-
-                elif selected_report_type == 'rapporto_entrate_spese':
-                    date_from_sql = start_date.strftime('%Y-%m-%d')
-                    date_to_sql = end_date_exclusive.strftime('%Y-%m-%d')
-
-                    def get_forecast_data(persona_filter=None):
-                        params_e = [date_from_sql, date_to_sql]
-                        params_s = [date_from_sql, date_to_sql]
-                        query_filter_entrate = ""
-                        query_filter_spese = ""
-                        if persona_filter:
-                            query_filter_entrate = f" AND ricevuto_da = ?"
-                            query_filter_spese = f" AND pagato_da = ?"
-                            params_e.append(persona_filter)
-                            params_s.append(persona_filter)
-
-                        totale_entrate = db.execute(f'SELECT SUM(importo) as totale FROM entrate WHERE data >= ? AND data < ?{query_filter_entrate}', params_e).fetchone()['totale'] or 0.0
-                        totale_spese = db.execute(f'SELECT SUM(importo) as totale FROM spese WHERE data >= ? AND data < ?{query_filter_spese}', params_s).fetchone()['totale'] or 0.0
-
-                        media_e = totale_entrate / num_mesi_periodo
-                        media_s = totale_spese / num_mesi_periodo
-                        forecast_e = media_e * 12
-                        forecast_s = media_s * 12
-
-                        return {
-                            'media_entrate': media_e, 'media_spese': media_s, 'media_risparmio': media_e - media_s,
-                            'forecast_entrate': forecast_e, 'forecast_spese': forecast_s, 'forecast_risparmio': forecast_e - forecast_s,
-                            'rapporto_percentuale': (forecast_s / forecast_e * 100) if forecast_e > 0 else 0
-                        }
-
-                    dati_stat['forecast_report'] = {
-                        'periodo_mesi': num_mesi_periodo,
-                        'totale': get_forecast_data(),
-                        'giacomo': get_forecast_data('Giacomo'),
-                        'erica': get_forecast_data('Erica')
-                    }
-
-                    if dati_stat['forecast_report']['totale']['media_entrate'] == 0 and dati_stat['forecast_report']['totale']['media_spese'] == 0:
-                        dati_stat["messaggio_placeholder"] = "Nessun dato di entrata o spesa trovato per il periodo per generare il report."
-                        dati_stat['forecast_report'] = None
-                
-                # _# MODIFICA_: Logica per il nuovo report "Top Spender"
-                elif selected_report_type == 'top_spender':
-                    date_from_sql = start_date.strftime('%Y-%m-%d')
-                    date_to_sql = end_date_exclusive.strftime('%Y-%m-%d')
-
-                    totale_entrate_periodo = db.execute('SELECT SUM(importo) as totale FROM entrate WHERE data >= ? AND data < ?', (date_from_sql, date_to_sql)).fetchone()['totale'] or 0.0
-                    totale_spese_periodo = db.execute('SELECT SUM(importo) as totale FROM spese WHERE data >= ? AND data < ?', (date_from_sql, date_to_sql)).fetchone()['totale'] or 0.0
-
-                    dati_stat['totale_entrate_periodo_str'] = format_decimali_italiano(totale_entrate_periodo)
-                    dati_stat['totale_spese_periodo_str'] = format_decimali_italiano(totale_spese_periodo)
-
-                    def processa_lista_spese(lista_spese_raw):
-                        lista_elaborata = []
-                        for spesa_row in lista_spese_raw:
-                            spesa_dict = dict(spesa_row)
-                            importo = spesa_dict['importo']
-                            spesa_dict['perc_su_entrate'] = (importo / totale_entrate_periodo * 100) if totale_entrate_periodo > 0 else 0
-                            spesa_dict['perc_su_spese'] = (importo / totale_spese_periodo * 100) if totale_spese_periodo > 0 else 0
-                            lista_elaborata.append(spesa_dict)
-                        return lista_elaborata
-
-                    query_base = "SELECT data, categoria, descrizione, importo, pagato_da FROM spese WHERE data >= ? AND data < ? {extra_where} ORDER BY importo DESC LIMIT 10"
-                    
-                    cursor_totali = db.execute(query_base.format(extra_where=""), (date_from_sql, date_to_sql))
-                    dati_stat['top_spese_totali'] = processa_lista_spese(cursor_totali.fetchall())
-
-                    cursor_giacomo = db.execute(query_base.format(extra_where="AND pagato_da = ?"), (date_from_sql, date_to_sql, 'Giacomo'))
-                    dati_stat['top_spese_giacomo'] = processa_lista_spese(cursor_giacomo.fetchall())
-
-                    cursor_erica = db.execute(query_base.format(extra_where="AND pagato_da = ?"), (date_from_sql, date_to_sql, 'Erica'))
-                    dati_stat['top_spese_erica'] = processa_lista_spese(cursor_erica.fetchall())
-                    
-                    if not dati_stat['top_spese_totali']:
-                        dati_stat["messaggio_placeholder"] = "Nessuna spesa trovata nel periodo selezionato per generare il report 'Top Spender'."
-
+                calcola_dati_report(db, selected_report_type, start_date, end_date_exclusive, selected_top_n, dati_stat)
 
         except Exception as e_stat:
             print(f"ERRORE GRAVE nel calcolo delle statistiche: {e_stat}")
@@ -494,8 +1436,6 @@ def statistiche():
                 "forecast_report": None,
                 "messaggio_placeholder": "Si è verificato un errore nel calcolo delle statistiche."
             })
-        finally:
-            if db: db.close()
 
     return render_template('statistiche.html',
                            titolo_pagina="Statistiche e Report",
@@ -508,67 +1448,107 @@ def statistiche():
                            current_selected_anno_a=selected_anno_a,
                            current_selected_mese_a=selected_mese_a,
                            current_selected_report_type=selected_report_type,
+                           top_n_disponibili=TOP_N_DISPONIBILI,
+                           current_selected_top_n=selected_top_n,
                            form_submitted=form_submitted,
                            datetime=datetime)
 
+# --- Paginazione a chiave (keyset) ---
+# Le liste di transazioni sono ordinate per (data DESC, id DESC) e divise in pagine: invece di un OFFSET,
+# la pagina successiva riparte dall'ultima riga mostrata (parametro 'dopo' = 'AAAA-MM-GG_id'), con una
+# condizione (data, id) < (?, ?) che l'indice risolve direttamente. Con formato=frammento la rotta
+# restituisce solo le righe HTML della pagina e l'URL della successiva ("Carica altre").
+DIMENSIONE_PAGINA_TRANSAZIONI = 50
+DIMENSIONE_MASSIMA_PAGINA_TRANSAZIONI = 200
+
+def leggi_cursore(valore):
+    if not valore: return None
+    try:
+        data_str, id_str = valore.rsplit('_', 1)
+        datetime.strptime(data_str, '%Y-%m-%d')
+        return data_str, int(id_str)
+    except ValueError:
+        return None
+
+def leggi_parametri_pagina():
+    dimensione = request.args.get('n', default=DIMENSIONE_PAGINA_TRANSAZIONI, type=int)
+    dimensione = min(max(dimensione, 1), DIMENSIONE_MASSIMA_PAGINA_TRANSAZIONI)
+    return dimensione, leggi_cursore(request.args.get('dopo'))
+
+def dividi_pagina(righe, dimensione):
+    # Le query leggono una riga in più del necessario: se c'è, la pagina successiva parte dall'ultima riga mostrata
+    pagina = righe[:dimensione]
+    return pagina, (f"{pagina[-1]['data']}_{pagina[-1]['id']}" if len(righe) > dimensione else None)
+
+def leggi_pagina_voce_mese(db_conn, tabella, anno, mese, voce, dimensione, dopo):
+    colonna_voce, colonna_persona = COLONNE_RIEPILOGO[tabella]
+    data_da, data_a = intervallo_mese(anno, mese)
+    condizione_cursore = 'AND (data, id) < (?, ?)' if dopo else ''
+    righe = db_conn.execute(f'''SELECT id, data, {colonna_voce}, descrizione, importo_cent, {colonna_persona} FROM {tabella}
+                                WHERE {colonna_voce} = ? AND data >= ? AND data < ? {condizione_cursore} ORDER BY data DESC, id DESC LIMIT ?''',
+                            (voce, data_da, data_a, *(dopo or ()), dimensione + 1)).fetchall()
+    return dividi_pagina(righe, dimensione)
+
+def leggi_totale_voce_mese(db_conn, tabella, anno, mese, voce):
+    # Il totale del mese viene dal riepilogo: la pagina può mostrare solo una parte delle righe
+    return db_conn.execute('SELECT COALESCE(SUM(totale_cent), 0) FROM riepilogo_mensile WHERE tabella = ? AND anno = ? AND mese = ? AND voce = ?',
+                           (tabella, anno, mese, voce)).fetchone()[0]
+
+def risposta_frammento(template, prossima_pagina, **contesto):
+    return jsonify(html_righe=render_template(template, **contesto), prossima_pagina=prossima_pagina)
+
 # --- Rotte CRUD Spese ---
 @app.route('/dettagli_spese/<int:anno>/<int:mese>/<path:nome_categoria>')
 def dettagli_categoria_mese(anno, mese, nome_categoria):
-    transazioni_dettaglio = []; nome_mese_format = f"{MESI_ITALIANI.get(mese, '')} {anno}"; totale_categoria = 0.0; db = None
+    transazioni_dettaglio = []; nome_mese_format = f"{MESI_ITALIANI.get(mese, '')} {anno}"; totale_categoria = 0; prossima_pagina = None
+    dimensione, dopo = leggi_parametri_pagina()
     try:
         db = get_db()
-        anno_mese_str = f"{anno:04d}-{mese:02d}"
-        cursore = db.execute('SELECT id, data, descrizione, importo, pagato_da FROM spese WHERE strftime("%Y-%m", data) = ? AND categoria = ? ORDER BY data DESC, id DESC', (anno_mese_str, nome_categoria))
-        transazioni_dettaglio = cursore.fetchall()
-        for transazione in transazioni_dettaglio: totale_categoria += transazione['importo']
+        transazioni_dettaglio, cursore_successivo = leggi_pagina_voce_mese(db, 'spese', anno, mese, nome_categoria, dimensione, dopo)
+        if cursore_successivo:
+            prossima_pagina = url_for('dettagli_categoria_mese', anno=anno, mese=mese, nome_categoria=nome_categoria, n=dimensione, dopo=cursore_successivo, formato='frammento')
+        if request.args.get('formato') == 'frammento':
+            return risposta_frammento('_righe_dettagli_spese.html', prossima_pagina, transazioni=transazioni_dettaglio)
+        totale_categoria = leggi_totale_voce_mese(db, 'spese', anno, mese, nome_categoria)
     except sqlite3.Error as e: flash(f"Errore caricamento dettagli per '{nome_categoria}': {e}", "danger"); return redirect(url_for('index', anno=anno, mese=mese))
-    finally:
-        if db: db.close()
-    return render_template('dettagli_categoria_mese.html', titolo_pagina=f"Dettaglio Spese: {nome_categoria}", nome_categoria=nome_categoria, nome_mese=nome_mese_format, transazioni=transazioni_dettaglio, totale_categoria_mese=totale_categoria, current_anno=anno, current_mese=mese, datetime=datetime)
+    return render_template('dettagli_categoria_mese.html', titolo_pagina=f"Dettaglio Spese: {nome_categoria}", nome_categoria=nome_categoria, nome_mese=nome_mese_format, transazioni=transazioni_dettaglio, totale_categoria_mese=totale_categoria, prossima_pagina=prossima_pagina, current_anno=anno, current_mese=mese, datetime=datetime)
 
 @app.route('/modifica_spesa/<int:spesa_id>', methods=['GET'])
 def modifica_spesa_form(spesa_id):
-    spesa = None; db = None
+    spesa = None
     try:
         db = get_db()
-        spesa = db.execute('SELECT id, data, descrizione, categoria, importo, pagato_da FROM spese WHERE id = ?', (spesa_id,)).fetchone()
+        spesa = db.execute('SELECT id, data, descrizione, categoria, importo_cent, pagato_da FROM spese WHERE id = ?', (spesa_id,)).fetchone()
     except sqlite3.Error as e: flash("Errore caricamento spesa.", "danger"); return redirect(url_for('index'))
-    finally:
-        if db: db.close()
     if spesa is None: flash(f"Spesa ID {spesa_id} non trovata.", "danger"); return redirect(url_for('index'))
     return render_template('modifica_spesa.html', spesa=spesa, titolo_pagina="Modifica Spesa", categorie_spesa_disponibili=CATEGORIE_SPESA, datetime=datetime)
 
 @app.route('/modifica_spesa/<int:spesa_id>/salva', methods=['POST'])
 def processa_modifica_spesa(spesa_id):
-    anno_redirect, mese_redirect = datetime.today().year, datetime.today().month; db_temp = None
-    try:
-        db_temp = get_db()
-        data_record_orig = db_temp.execute('SELECT data FROM spese WHERE id = ?', (spesa_id,)).fetchone()
-        if data_record_orig: dt_orig = datetime.strptime(data_record_orig['data'], '%Y-%m-%d'); anno_redirect, mese_redirect = dt_orig.year, dt_orig.month
-    finally:
-        if db_temp: db_temp.close()
+    anno_redirect, mese_redirect = datetime.today().year, datetime.today().month
+    db = get_db()
+    data_record_orig = db.execute('SELECT data FROM spese WHERE id = ?', (spesa_id,)).fetchone()
+    if data_record_orig: dt_orig = datetime.strptime(data_record_orig['data'], '%Y-%m-%d'); anno_redirect, mese_redirect = dt_orig.year, dt_orig.month
     if request.method == 'POST':
         data_nuova, categoria, descrizione, importo_str, pagato_da = request.form.get('data'), request.form.get('categoria_spesa_select'), request.form.get('descrizione_spesa'), request.form.get('importo'), request.form.get('pagato_da')
         if not all([data_nuova, categoria, importo_str, pagato_da]): flash("Errore: Campi obbligatori mancanti!", "danger"); return redirect(url_for('modifica_spesa_form', spesa_id=spesa_id))
+        if pagato_da not in PERSONE_VALIDE: flash(f"Errore: persona non valida: '{pagato_da}'.", "danger"); return redirect(url_for('modifica_spesa_form', spesa_id=spesa_id))
         try:
-            importo = float(importo_str)
-            if importo <=0: raise ValueError("Importo non positivo")
+            importo_cent = euro_a_centesimi(importo_str)
+            if importo_cent <= 0: raise ValueError("Importo non positivo")
             dt_nuova = datetime.strptime(data_nuova, '%Y-%m-%d'); anno_redirect, mese_redirect = dt_nuova.year, dt_nuova.month
         except ValueError: flash("Errore: importo o data non validi.", "danger"); return redirect(url_for('modifica_spesa_form', spesa_id=spesa_id))
-        db = None
         try:
-            db = get_db()
-            db.execute('UPDATE spese SET data = ?, descrizione = ?, categoria = ?, importo = ?, pagato_da = ? WHERE id = ?', (data_nuova, descrizione if descrizione else "", categoria, importo, pagato_da, spesa_id))
-            db.commit(); flash(f"Spesa '{categoria}{' - ' + descrizione if descrizione else ''}' aggiornata!", "success")
+            db.execute('UPDATE spese SET data = ?, descrizione = ?, categoria = ?, importo_cent = ?, pagato_da = ? WHERE id = ?', (data_nuova, descrizione if descrizione else "", categoria, importo_cent, pagato_da, spesa_id))
+            db.commit(); invalida_mesi(data_record_orig['data'] if data_record_orig else None, data_nuova)
+            flash(f"Spesa '{categoria}{' - ' + descrizione if descrizione else ''}' aggiornata!", "success")
         except sqlite3.Error as e: flash(f"Errore aggiornamento spesa: {e}", "danger")
-        finally:
-            if db: db.close()
         return redirect(url_for('index', anno=anno_redirect, mese=mese_redirect))
     return redirect(url_for('index', anno=anno_redirect, mese=mese_redirect))
 
 @app.route('/elimina_spesa/<int:spesa_id>', methods=['POST'])
 def elimina_spesa(spesa_id):
-    anno_redirect, mese_redirect = datetime.today().year, datetime.today().month; db = None
+    anno_redirect, mese_redirect = datetime.today().year, datetime.today().month
     try:
         db = get_db()
         spesa_info = db.execute('SELECT data, descrizione, categoria FROM spese WHERE id = ?', (spesa_id,)).fetchone()
@@ -577,71 +1557,64 @@ def elimina_spesa(spesa_id):
             desc_spesa_eliminata = f"{spesa_info['categoria']}{' - ' + spesa_info['descrizione'] if spesa_info['descrizione'] else ''}"
         else: flash(f"Spesa ID {spesa_id} non trovata.", "warning"); return redirect(url_for('index'))
         db.execute('DELETE FROM spese WHERE id = ?', (spesa_id,)); db.commit()
+        invalida_mesi(spesa_info['data'])
         flash(f"Spesa '{desc_spesa_eliminata}' eliminata!", "success")
     except sqlite3.Error as e: flash(f"Errore eliminazione spesa: {e}", "danger")
-    finally:
-        if db: db.close()
     return redirect(url_for('index', anno=anno_redirect, mese=mese_redirect))
 
 # --- Rotte CRUD Entrate ---
 @app.route('/dettagli_entrate/<int:anno>/<int:mese>/<path:nome_tipo_entrata>')
 def dettagli_tipo_entrata_mese(anno, mese, nome_tipo_entrata):
-    transazioni_dettaglio = []; nome_mese_format = f"{MESI_ITALIANI.get(mese, '')} {anno}"; totale_tipo_entrata = 0.0; db = None
+    transazioni_dettaglio = []; nome_mese_format = f"{MESI_ITALIANI.get(mese, '')} {anno}"; totale_tipo_entrata = 0; prossima_pagina = None
+    dimensione, dopo = leggi_parametri_pagina()
     try:
         db = get_db()
-        anno_mese_str = f"{anno:04d}-{mese:02d}"
-        cursore = db.execute('SELECT id, data, tipo_entrata, descrizione, importo, ricevuto_da FROM entrate WHERE strftime("%Y-%m", data) = ? AND tipo_entrata = ? ORDER BY data DESC, id DESC', (anno_mese_str, nome_tipo_entrata))
-        transazioni_dettaglio = cursore.fetchall()
-        for transazione in transazioni_dettaglio: totale_tipo_entrata += transazione['importo']
+        transazioni_dettaglio, cursore_successivo = leggi_pagina_voce_mese(db, 'entrate', anno, mese, nome_tipo_entrata, dimensione, dopo)
+        if cursore_successivo:
+            prossima_pagina = url_for('dettagli_tipo_entrata_mese', anno=anno, mese=mese, nome_tipo_entrata=nome_tipo_entrata, n=dimensione, dopo=cursore_successivo, formato='frammento')
+        if request.args.get('formato') == 'frammento':
+            return risposta_frammento('_righe_dettagli_entrate.html', prossima_pagina, transazioni=transazioni_dettaglio)
+        totale_tipo_entrata = leggi_totale_voce_mese(db, 'entrate', anno, mese, nome_tipo_entrata)
     except sqlite3.Error as e: flash(f"Errore caricamento dettagli per '{nome_tipo_entrata}': {e}", "danger"); return redirect(url_for('index', anno=anno, mese=mese))
-    finally:
-        if db: db.close()
-    return render_template('dettagli_tipo_entrata_mese.html', titolo_pagina=f"Dettaglio Entrate: {nome_tipo_entrata}", nome_tipo_entrata=nome_tipo_entrata, nome_mese=nome_mese_format, transazioni=transazioni_dettaglio, totale_tipo_entrata_mese=totale_tipo_entrata, current_anno=anno, current_mese=mese, datetime=datetime)
+    return render_template('dettagli_tipo_entrata_mese.html', titolo_pagina=f"Dettaglio Entrate: {nome_tipo_entrata}", nome_tipo_entrata=nome_tipo_entrata, nome_mese=nome_mese_format, transazioni=transazioni_dettaglio, totale_tipo_entrata_mese=totale_tipo_entrata, prossima_pagina=prossima_pagina, current_anno=anno, current_mese=mese, datetime=datetime)
 
 @app.route('/modifica_entrata/<int:entrata_id>', methods=['GET'])
 def modifica_entrata_form(entrata_id):
-    entrata = None; db = None
+    entrata = None
     try:
         db = get_db()
-        entrata = db.execute('SELECT id, data, tipo_entrata, descrizione, importo, ricevuto_da FROM entrate WHERE id = ?', (entrata_id,)).fetchone()
+        entrata = db.execute('SELECT id, data, tipo_entrata, descrizione, importo_cent, ricevuto_da FROM entrate WHERE id = ?', (entrata_id,)).fetchone()
     except sqlite3.Error as e: flash("Errore caricamento entrata.", "danger"); return redirect(url_for('index'))
-    finally:
-        if db: db.close()
     if entrata is None: flash(f"Entrata ID {entrata_id} non trovata.", "danger"); return redirect(url_for('index'))
     tipi_entrata_disponibili = ["Stipendio", "Bonus", "Regalo", "Vendita", "Extra", "Altro"]
     return render_template('modifica_entrata.html', entrata=entrata, tipi_entrata=tipi_entrata_disponibili, titolo_pagina="Modifica Entrata", datetime=datetime)
 
 @app.route('/modifica_entrata/<int:entrata_id>/salva', methods=['POST'])
 def processa_modifica_entrata(entrata_id):
-    anno_redirect, mese_redirect = datetime.today().year, datetime.today().month; db_temp = None
-    try:
-        db_temp = get_db()
-        data_record_orig = db_temp.execute('SELECT data FROM entrate WHERE id = ?', (entrata_id,)).fetchone()
-        if data_record_orig: dt_orig = datetime.strptime(data_record_orig['data'], '%Y-%m-%d'); anno_redirect, mese_redirect = dt_orig.year, dt_orig.month
-    finally:
-        if db_temp: db_temp.close()
+    anno_redirect, mese_redirect = datetime.today().year, datetime.today().month
+    db = get_db()
+    data_record_orig = db.execute('SELECT data FROM entrate WHERE id = ?', (entrata_id,)).fetchone()
+    if data_record_orig: dt_orig = datetime.strptime(data_record_orig['data'], '%Y-%m-%d'); anno_redirect, mese_redirect = dt_orig.year, dt_orig.month
     if request.method == 'POST':
         data_nuova, tipo_entrata, descrizione, importo_str, ricevuto_da = request.form.get('data'), request.form.get('tipo_entrata_val'), request.form.get('descrizione_entrata'), request.form.get('importo'), request.form.get('ricevuto_da')
         if not all([data_nuova, tipo_entrata, importo_str, ricevuto_da]): flash("Errore: Campi obbligatori mancanti!", "danger"); return redirect(url_for('modifica_entrata_form', entrata_id=entrata_id))
+        if ricevuto_da not in PERSONE_VALIDE: flash(f"Errore: persona non valida: '{ricevuto_da}'.", "danger"); return redirect(url_for('modifica_entrata_form', entrata_id=entrata_id))
         try:
-            importo = float(importo_str)
-            if importo <= 0: raise ValueError("Importo non positivo")
+            importo_cent = euro_a_centesimi(importo_str)
+            if importo_cent <= 0: raise ValueError("Importo non positivo")
             dt_nuova = datetime.strptime(data_nuova, '%Y-%m-%d'); anno_redirect, mese_redirect = dt_nuova.year, dt_nuova.month
         except ValueError: flash("Errore: Importo o Data non validi.", "danger"); return redirect(url_for('modifica_entrata_form', entrata_id=entrata_id))
-        db = None
         try:
-            db = get_db()
-            db.execute('UPDATE entrate SET data = ?, tipo_entrata = ?, descrizione = ?, importo = ?, ricevuto_da = ? WHERE id = ?', (data_nuova, tipo_entrata, descrizione if descrizione else "", importo, ricevuto_da, entrata_id))
-            db.commit(); flash(f"Entrata '{tipo_entrata}{' - ' + descrizione if descrizione else ''}' aggiornata!", "success")
+            db.execute('UPDATE entrate SET data = ?, tipo_entrata = ?, descrizione = ?, importo_cent = ?, ricevuto_da = ? WHERE id = ?', (data_nuova, tipo_entrata, descrizione if descrizione else "", importo_cent, ricevuto_da, entrata_id))
+            db.commit(); invalida_mesi(data_record_orig['data'] if data_record_orig else None, data_nuova)
+            flash(f"Entrata '{tipo_entrata}{' - ' + descrizione if descrizione else ''}' aggiornata!", "success")
         except sqlite3.Error as e: flash(f"Errore aggiornamento entrata: {e}", "danger")
-        finally:
-            if db: db.close()
         return redirect(url_for('index', anno=anno_redirect, mese=mese_redirect))
     return redirect(url_for('index', anno=anno_redirect, mese=mese_redirect))
 
 @app.route('/elimina_entrata/<int:entrata_id>', methods=['POST'])
 def elimina_entrata(entrata_id):
-    anno_redirect, mese_redirect = datetime.today().year, datetime.today().month; db = None
+    anno_redirect, mese_redirect = datetime.today().year, datetime.today().month
     try:
         db = get_db()
         entrata_info = db.execute('SELECT data, tipo_entrata, descrizione FROM entrate WHERE id = ?', (entrata_id,)).fetchone()
@@ -650,12 +1623,27 @@ def elimina_entrata(entrata_id):
             desc_entrata_eliminata = f"{entrata_info['tipo_entrata']}{' - ' + entrata_info['descrizione'] if entrata_info['descrizione'] else ''}"
         else: flash(f"Entrata ID {entrata_id} non trovata.", "warning"); return redirect(url_for('index'))
         db.execute('DELETE FROM entrate WHERE id = ?', (entrata_id,)); db.commit()
+        invalida_mesi(entrata_info['data'])
         flash(f"Entrata '{desc_entrata_eliminata}' eliminata!", "success")
     except sqlite3.Error as e: flash(f"Errore eliminazione entrata: {e}", "danger")
-    finally:
-        if db: db.close()
     return redirect(url_for('index', anno=anno_redirect, mese=mese_redirect))
+def leggi_pagina_registro(db_conn, data_da, data_a, cursori, dimensione):
+    # Una sola query per tutte le persone di 'cursori' ({persona: cursore o None}): ROW_NUMBER() per persona
+    # tiene al massimo dimensione + 1 righe di ciascuna. Restituisce {persona: (righe, cursore successivo)}.
+    condizioni, parametri = [], []
+    for persona, cursore in cursori.items():
+        if cursore: condizioni.append('(pagato_da = ? AND (data, id) < (?, ?))'); parametri += [persona, *cursore]
+        else: condizioni.append('pagato_da = ?'); parametri.append(persona)
+    righe = db_conn.execute(f'''SELECT id, data, categoria, descrizione, importo_cent, pagato_da FROM (
+                                    SELECT id, data, categoria, descrizione, importo_cent, pagato_da,
+                                           ROW_NUMBER() OVER (PARTITION BY pagato_da ORDER BY data DESC, id DESC) AS posizione
+                                    FROM spese WHERE data >= ? AND data < ? AND ({' OR '.join(condizioni)}))
+                                WHERE posizione <= ? ORDER BY data DESC, id DESC''',
+                            (data_da, data_a, *parametri, dimensione + 1)).fetchall()
+    return {persona: dividi_pagina([row for row in righe if row['pagato_da'] == persona], dimensione) for persona in cursori}
+
 @app.route('/registro/<int:anno>/<int:mese>')
+@con_etag(mesi_pagina_mese)
 def registro_mese(anno, mese):
     db = get_db()
     
@@ -676,20 +1664,23 @@ def registro_mese(anno, mese):
         primo_giorno_mese_successivo_dt = datetime(data_corrente_dt.year, data_corrente_dt.month + 1, 1)
     anno_succ, mese_succ = primo_giorno_mese_successivo_dt.year, primo_giorno_mese_successivo_dt.month
 
-    anno_mese_str = f"{anno:04d}-{mese:02d}"
-    
-    spese_giacomo = db.execute(
-        'SELECT data, categoria, descrizione, importo FROM spese WHERE strftime("%Y-%m", data) = ? AND pagato_da = ? ORDER BY data DESC, id DESC',
-        (anno_mese_str, 'Giacomo')
-    ).fetchall()
-    
-    spese_erica = db.execute(
-        'SELECT data, categoria, descrizione, importo FROM spese WHERE strftime("%Y-%m", data) = ? AND pagato_da = ? ORDER BY data DESC, id DESC',
-        (anno_mese_str, 'Erica')
-    ).fetchall()
-    
-    db.close()
-    
+    data_da, data_a = intervallo_mese(anno, mese)
+    dimensione, dopo = leggi_parametri_pagina()
+
+    # "Carica altre" di una sola persona (?persona=...&dopo=...&formato=frammento)
+    if request.args.get('formato') == 'frammento':
+        persona = request.args.get('persona')
+        if persona not in PERSONE_VALIDE: return jsonify(html_righe='', prossima_pagina=None), 400
+        spese, cursore_successivo = leggi_pagina_registro(db, data_da, data_a, {persona: dopo}, dimensione)[persona]
+        prossima_pagina = url_for('registro_mese', anno=anno, mese=mese, persona=persona, n=dimensione, dopo=cursore_successivo, formato='frammento') if cursore_successivo else None
+        return risposta_frammento('_righe_registro.html', prossima_pagina, spese=spese)
+
+    pagine = leggi_pagina_registro(db, data_da, data_a, {'Giacomo': None, 'Erica': None}, dimensione)
+    spese_giacomo, cursore_giacomo = pagine['Giacomo']
+    spese_erica, cursore_erica = pagine['Erica']
+    prossime_pagine = {persona: url_for('registro_mese', anno=anno, mese=mese, persona=persona, n=dimensione, dopo=cursore, formato='frammento') if cursore else None
+                       for persona, cursore in (('Giacomo', cursore_giacomo), ('Erica', cursore_erica))}
+
     return render_template('registro_mese.html',
                            titolo_pagina=f"Registro Spese - {nome_mese_corrente}",
                            nome_mese_corrente=nome_mese_corrente,
@@ -699,10 +1690,133 @@ def registro_mese(anno, mese):
                            anno_succ=anno_succ, mese_succ=mese_succ,
                            # --- CORREZIONE QUI ---
                            current_anno=anno,
-                           current_mese=mese)
+                           current_mese=mese,
+                           prossime_pagine=prossime_pagine,
+                           data_da=data_da, data_a=data_a)
+
+# --- Esportazione ---
+# /esporta/spesa e /esporta/entrata (gli stessi tipi di import_dati.py), con i filtri facoltativi
+# da (incluso), a (escluso), persona e voce. Con formato=csv (predefinito) il file usa lo stesso
+# formato letto da import_dati.py (separatore ';', importo in euro con il punto) e si può reimportare;
+# con formato=jsonl c'è un oggetto JSON per riga, con l'importo in centesimi.
+# Le righe vengono lette a blocchi con fetchmany e inviate man mano: la memoria usata non dipende
+# dal numero di righe e il download parte subito.
+DIMENSIONE_BLOCCO_ESPORTAZIONE = 1000
+
+@app.route('/esporta/<tipo>')
+def esporta(tipo):
+    config = TIPI_IMPORTAZIONE.get(tipo)
+    formato = request.args.get('formato', 'csv')
+    if config is None or formato not in ('csv', 'jsonl'):
+        return "Tipo o formato di esportazione non valido.", 404
+    tabella, colonna_voce, colonna_persona = config['tabella'], config['colonna_voce'], config['colonna_persona']
+
+    condizioni, parametri = [], []
+    data_da, data_a = request.args.get('da'), request.args.get('a')
+    try:
+        if data_da: datetime.strptime(data_da, '%Y-%m-%d'); condizioni.append('data >= ?'); parametri.append(data_da)
+        if data_a: datetime.strptime(data_a, '%Y-%m-%d'); condizioni.append('data < ?'); parametri.append(data_a)
+    except ValueError:
+        return "Date non valide: usare il formato AAAA-MM-GG.", 400
+    persona, voce = request.args.get('persona'), request.args.get('voce')
+    if persona:
+        if persona not in PERSONE_VALIDE: return f"Valore non valido per persona: '{persona}'", 400
+        condizioni.append(f'{colonna_persona} = ?'); parametri.append(persona)
+    if voce:
+        condizioni.append(f'{colonna_voce} = ?'); parametri.append(voce)
+    query = f"SELECT id, data, descrizione, {colonna_voce} AS voce, importo_cent, {colonna_persona} AS persona FROM {tabella}"
+    if condizioni: query += ' WHERE ' + ' AND '.join(condizioni)
+    query += ' ORDER BY data, id'
+
+    def genera_righe():
+        # Connessione propria: il generatore continua dopo la fine della vista, quando get_db() è già chiusa
+        db_conn = apri_connessione_lettura()
+        try:
+            cursore = db_conn.execute(query, parametri)
+            if formato == 'csv':
+                buffer = io.StringIO()
+                scrittore = csv.writer(buffer, delimiter=';', lineterminator='\n')
+                scrittore.writerow(['data', 'importo', colonna_voce, 'descrizione', colonna_persona])
+                yield buffer.getvalue()
+            while True:
+                blocco = cursore.fetchmany(DIMENSIONE_BLOCCO_ESPORTAZIONE)
+                if not blocco: break
+                if formato == 'csv':
+                    buffer.seek(0); buffer.truncate(0)
+                    scrittore.writerows((row['data'], centesimi_a_testo(row['importo_cent']), row['voce'], row['descrizione'] or '', row['persona']) for row in blocco)
+                    yield buffer.getvalue()
+                else:
+                    yield ''.join(json.dumps({'id': row['id'], 'data': row['data'], 'importo_cent': row['importo_cent'], colonna_voce: row['voce'],
+                                              'descrizione': row['descrizione'] or '', colonna_persona: row['persona']}, ensure_ascii=False) + '\n' for row in blocco)
+        finally:
+            db_conn.close()
+
+    nome_file = f"{tabella}_{data_da or 'inizio'}_{data_a or 'fine'}.{formato}"
+    risposta = app.response_class(genera_righe(), mimetype='text/csv' if formato == 'csv' else 'application/x-ndjson')
+    risposta.headers['Content-Disposition'] = f'attachment; filename="{nome_file}"'
+    return risposta
+
+# --- Ricerca nelle descrizioni ---
+# Usa gli indici FTS5 spese_fts ed entrate_fts (schema.sql), tenuti allineati dai trigger.
+# I risultati sono ordinati per pertinenza (bm25) e, a parità, dal più recente.
+RISULTATI_PER_PAGINA_RICERCA = 25
+
+def testo_a_query_fts(testo):
+    # Ogni parola diventa un prefisso tra virgolette ("rom"* trova "Roma", "romana"...) e devono esserci tutte:
+    # così nessun carattere scritto dall'utente viene interpretato come sintassi FTS5.
+    return ' '.join(f'"{parola}"*' for parola in re.findall(r'\w+', testo))
+
+def mesi_pagina_ricerca():
+    # I risultati possono venire da qualunque mese
+    return None
+
+@app.route('/ricerca')
+@con_etag(mesi_pagina_ricerca)
+def ricerca():
+    testo = request.args.get('q', '').strip()
+    tipo = request.args.get('tipo', 'tutte')
+    data_dal, data_al = request.args.get('dal', ''), request.args.get('al', '')
+    voce, persona = request.args.get('voce', '').strip(), request.args.get('persona', '')
+    pagina = max(request.args.get('pagina', default=1, type=int), 1)
+    tabelle = {'spese': ['spese'], 'entrate': ['entrate']}.get(tipo, ['spese', 'entrate'])
+
+    risultati, pagina_successiva = [], False
+    query_fts = testo_a_query_fts(testo)
+    if query_fts:
+        try:
+            if data_dal: datetime.strptime(data_dal, '%Y-%m-%d')
+            if data_al: datetime.strptime(data_al, '%Y-%m-%d')
+        except ValueError:
+            flash("Date non valide: usare il formato AAAA-MM-GG.", "danger")
+            data_dal = data_al = ''
+        parti, parametri = [], []
+        for tabella in tabelle:
+            colonna_voce, colonna_persona = COLONNE_RIEPILOGO[tabella]
+            condizioni = [f'{tabella}_fts MATCH ?']; parametri.append(query_fts)
+            if data_dal: condizioni.append('t.data >= ?'); parametri.append(data_dal)
+            if data_al: condizioni.append('t.data <= ?'); parametri.append(data_al)
+            if voce: condizioni.append(f't.{colonna_voce} = ?'); parametri.append(voce)
+            if persona in PERSONE_VALIDE: condizioni.append(f't.{colonna_persona} = ?'); parametri.append(persona)
+            parti.append(f"""SELECT '{tabella}' AS tabella, t.id, t.data, t.{colonna_voce} AS voce, t.descrizione, t.importo_cent, t.{colonna_persona} AS persona, {tabella}_fts.rank AS punteggio
+                             FROM {tabella}_fts JOIN {tabella} t ON t.id = {tabella}_fts.rowid WHERE {' AND '.join(condizioni)}""")
+        # Si legge una riga in più per sapere se esiste la pagina successiva
+        righe = get_db().execute(' UNION ALL '.join(parti) + ' ORDER BY punteggio, data DESC, id DESC LIMIT ? OFFSET ?',
+                                 (*parametri, RISULTATI_PER_PAGINA_RICERCA + 1, (pagina - 1) * RISULTATI_PER_PAGINA_RICERCA)).fetchall()
+        risultati, pagina_successiva = righe[:RISULTATI_PER_PAGINA_RICERCA], len(righe) > RISULTATI_PER_PAGINA_RICERCA
+
+    parametri_ricerca = {'q': testo, 'tipo': tipo, 'dal': data_dal, 'al': data_al, 'voce': voce, 'persona': persona}
+    return render_template('ricerca.html',
+                           titolo_pagina="Cerca Transazioni",
+                           risultati=risultati,
+                           parametri_ricerca=parametri_ricerca,
+                           pagina=pagina,
+                           pagina_successiva=pagina_successiva,
+                           ricerca_eseguita=bool(query_fts),
+                           persone=PERSONE_VALIDE)
 
 @app.route('/delta')
 @app.route('/delta/<int:anno>')
+@con_etag(mesi_pagina_delta)
 def delta_annuale(anno=None):
     oggi = datetime.today()
     if anno is None:
@@ -734,36 +1848,44 @@ def delta_annuale(anno=None):
         if anno_corrente == oggi.year:
             giorno_fine, mese_fine = oggi.day, oggi.month
         
+        # Il 29 febbraio non esiste nell'anno precedente (non bisestile): lì il periodo finisce il 28
         start_date_curr = f"{anno_corrente:04d}-01-01"
-        end_date_curr = f"{anno_corrente:04d}-{mese_fine:02d}-{giorno_fine:02d}"
+        end_date_curr = f"{anno_corrente:04d}-{mese_fine:02d}-{min(giorno_fine, calendar.monthrange(anno_corrente, mese_fine)[1]):02d}"
         start_date_prev = f"{anno_precedente:04d}-01-01"
-        end_date_prev = f"{anno_precedente:04d}-{mese_fine:02d}-{giorno_fine:02d}"
+        end_date_prev = f"{anno_precedente:04d}-{mese_fine:02d}-{min(giorno_fine, calendar.monthrange(anno_precedente, mese_fine)[1]):02d}"
         periodo_str = f"fino al {giorno_fine} {MESI_ITALIANI[mese_fine]}"
 
     db = get_db()
 
     # --- 3. Logica di Calcolo ---
-    def calculate_delta(current, previous):
-        delta_abs = current - previous
-        delta_perc = (delta_abs / previous * 100) if previous != 0 else 0
-        return {'abs': delta_abs, 'perc': delta_perc}
+    # Righe del riepilogo mensile dei due periodi (le date di fine sono incluse)
+    def giorno_dopo(data_str):
+        return (datetime.strptime(data_str, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+    def get_righe_periodi(tabella):
+        righe_correnti = leggi_totali_periodo(db, tabella, start_date_curr, giorno_dopo(end_date_curr))
+        # L'anno precedente, se già concluso, non cambia più: si legge dalla cache (con l'analisi in memoria non serve)
+        if anno_precedente < oggi.year and not app.config.get('ANALISI_IN_MEMORIA'):
+            righe_precedenti = leggi_riepilogo_anno_chiuso(db, tabella, anno_precedente, giorno_dopo(end_date_prev))
+        else:
+            righe_precedenti = leggi_totali_periodo(db, tabella, start_date_prev, giorno_dopo(end_date_prev))
+        return righe_correnti + righe_precedenti
+
+    righe_spese = get_righe_periodi('spese')
+    righe_entrate = get_righe_periodi('entrate')
 
     # Funzione per i dati aggregati per Categoria/Tipo
-    def get_summary_data(tabella, colonna_cat, colonna_persona):
-        query = f"""
-            SELECT strftime('%Y', data) as anno, {colonna_cat} as categoria, {colonna_persona} as persona, SUM(importo) as totale
-            FROM {tabella} WHERE (data BETWEEN ? AND ?) OR (data BETWEEN ? AND ?) GROUP BY anno, categoria, persona """
-        cursor = db.execute(query, (start_date_curr, end_date_curr, start_date_prev, end_date_prev))
-        
+    def get_summary_data(righe):
         data_dict = {}
-        for row in cursor.fetchall():
-            anno_r, cat, persona, totale = int(row['anno']), row['categoria'], row['persona'], row['totale'] or 0.0
+        for row in righe:
+            anno_r, cat, persona, totale = row['anno'], row['voce'], row['persona'], row['totale'] or 0
             periodo = 'current' if anno_r == anno_corrente else 'previous'
             
             if cat not in data_dict:
-                data_dict[cat] = {'previous': {'Giacomo': 0.0, 'Erica': 0.0, 'Totale': 0.0}, 'current': {'Giacomo': 0.0, 'Erica': 0.0, 'Totale': 0.0}}
+                data_dict[cat] = {'previous': {'Giacomo': 0, 'Erica': 0, 'Totale': 0}, 'current': {'Giacomo': 0, 'Erica': 0, 'Totale': 0}}
             
-            data_dict[cat][periodo][persona] += totale
+            # Come in totali_per_persona: una persona non prevista conta solo nel totale
+            if persona in PERSONE_VALIDE: data_dict[cat][periodo][persona] += totale
             data_dict[cat][periodo]['Totale'] += totale
 
         if is_forecast_view and num_mesi_calcolo > 0:
@@ -775,12 +1897,12 @@ def delta_annuale(anno=None):
         for cat, data in data_dict.items():
             data['delta'] = {}
             for p in ['Giacomo', 'Erica', 'Totale']:
-                data['delta'][p] = calculate_delta(data['current'][p], data['previous'][p])
+                data['delta'][p] = calcola_delta(data['current'][p], data['previous'][p])
         
         return data_dict
 
-    spese_per_categoria = get_summary_data('spese', 'categoria', 'pagato_da')
-    entrate_per_tipo = get_summary_data('entrate', 'tipo_entrata', 'ricevuto_da')
+    spese_per_categoria = get_summary_data(righe_spese)
+    entrate_per_tipo = get_summary_data(righe_entrate)
 
     # Riepilogo per i box in alto
     riepilogo = {p: {'entrate': {}, 'spese': {}, 'risparmio': {}} for p in ['Giacomo', 'Erica', 'Totale']}
@@ -790,26 +1912,23 @@ def delta_annuale(anno=None):
         spese_curr = sum(d['current'][p] for d in spese_per_categoria.values())
         spese_prev = sum(d['previous'][p] for d in spese_per_categoria.values())
         
-        riepilogo[p]['entrate'] = {'current': entrate_curr, 'delta': calculate_delta(entrate_curr, entrate_prev)}
-        riepilogo[p]['spese'] = {'current': spese_curr, 'delta': calculate_delta(spese_curr, spese_prev)}
-        riepilogo[p]['risparmio'] = {'current': entrate_curr - spese_curr, 'delta': calculate_delta(entrate_curr - spese_curr, entrate_prev - spese_prev)}
+        riepilogo[p]['entrate'] = {'current': entrate_curr, 'delta': calcola_delta(entrate_curr, entrate_prev)}
+        riepilogo[p]['spese'] = {'current': spese_curr, 'delta': calcola_delta(spese_curr, spese_prev)}
+        riepilogo[p]['risparmio'] = {'current': entrate_curr - spese_curr, 'delta': calcola_delta(entrate_curr - spese_curr, entrate_prev - spese_prev)}
 
     # Dati mensili (vengono calcolati e mostrati solo in modalità 'reale')
-    dettaglio_mensile_lista = []
+    spese_mensili = []
+    entrate_mensili = []
     medie_spese = {}
     medie_entrate = {}
     if not is_forecast_view:
-        def get_monthly_breakdown(tabella, colonna_persona):
-            query = f"""
-                SELECT strftime('%Y', data) as anno, strftime('%m', data) as mese, {colonna_persona} as persona, SUM(importo) as totale
-                FROM {tabella} WHERE (data BETWEEN ? AND ?) OR (data BETWEEN ? AND ?) GROUP BY anno, mese, persona """
-            cursor = db.execute(query, (start_date_curr, end_date_curr, start_date_prev, end_date_prev))
-            dati_mensili = {i: {'mese_nome': MESI_ITALIANI[i], 'previous': {'Giacomo': 0.0, 'Erica': 0.0, 'Totale': 0.0}, 'current': {'Giacomo': 0.0, 'Erica': 0.0, 'Totale': 0.0}} for i in range(1, 13)}
+        def get_monthly_breakdown(righe):
+            dati_mensili = {i: {'mese_nome': MESI_ITALIANI[i], 'previous': {'Giacomo': 0, 'Erica': 0, 'Totale': 0}, 'current': {'Giacomo': 0, 'Erica': 0, 'Totale': 0}} for i in range(1, 13)}
             
-            for row in cursor.fetchall():
-                anno_r, mese_num, persona, totale = int(row['anno']), int(row['mese']), row['persona'], row['totale'] or 0.0
+            for row in righe:
+                anno_r, mese_num, persona, totale = row['anno'], row['mese'], row['persona'], row['totale'] or 0
                 periodo = 'current' if anno_r == anno_corrente else 'previous'
-                dati_mensili[mese_num][periodo][persona] = totale
+                if persona in PERSONE_VALIDE: dati_mensili[mese_num][periodo][persona] += totale
                 dati_mensili[mese_num][periodo]['Totale'] += totale
             
             lista_finale = []
@@ -817,7 +1936,7 @@ def delta_annuale(anno=None):
                 mese_data = dati_mensili[i]
                 mese_data['delta'] = {}
                 for p in ['Giacomo', 'Erica', 'Totale']:
-                    mese_data['delta'][p] = calculate_delta(mese_data['current'][p], mese_data['previous'][p])
+                    mese_data['delta'][p] = calcola_delta(mese_data['current'][p], mese_data['previous'][p])
                 lista_finale.append(mese_data)
 
             medie = {'previous': {}, 'current': {}, 'delta': {}}
@@ -826,15 +1945,13 @@ def delta_annuale(anno=None):
                 for p in ['Giacomo', 'Erica', 'Totale']:
                     medie['previous'][p] = sum(m['previous'][p] for m in lista_finale) / num_mesi_periodo
                     medie['current'][p] = sum(m['current'][p] for m in lista_finale) / num_mesi_periodo
-                    medie['delta'][p] = calculate_delta(medie['current'][p], medie['previous'][p])
+                    medie['delta'][p] = calcola_delta(medie['current'][p], medie['previous'][p])
             return lista_finale, medie
 
-        spese_mensili, medie_spese = get_monthly_breakdown('spese', 'pagato_da')
-        entrate_mensili, medie_entrate = get_monthly_breakdown('entrate', 'ricevuto_da')
+        spese_mensili, medie_spese = get_monthly_breakdown(righe_spese)
+        entrate_mensili, medie_entrate = get_monthly_breakdown(righe_entrate)
 
-    cursor_anni = db.execute("SELECT DISTINCT STRFTIME('%Y', data) as anno FROM spese UNION SELECT DISTINCT STRFTIME('%Y', data) as anno FROM entrate ORDER BY anno DESC")
-    anni_disponibili = [row['anno'] for row in cursor_anni.fetchall()]
-    db.close()
+    anni_disponibili = leggi_anni_disponibili(db)
     
     return render_template('delta_annuale.html',
                            titolo_pagina=f"Confronto Annuale {anno_corrente}",
@@ -851,6 +1968,168 @@ def delta_annuale(anno=None):
                            periodo_str=periodo_str,
                            is_forecast_view=is_forecast_view,
                            mode=mode)
+
+NUMERO_MASSIMO_ANNI_CONFRONTO = 10
+
+def mesi_pagina_confronto_anni():
+    # Come per il confronto annuale, la pagina mostra l'elenco degli anni disponibili: dipende da tutti i mesi
+    return None
+
+@app.route('/confronto_anni')
+@con_etag(mesi_pagina_confronto_anni)
+def confronto_anni():
+    # Matrice anni × voce × persona per spese ed entrate, con il delta tra ogni coppia di anni
+    # consecutivi e il tasso di crescita annuo composto (CAGR) di ogni voce tra il primo e l'ultimo anno.
+    oggi = datetime.today()
+    db = get_db()
+    anni_disponibili = leggi_anni_disponibili(db) or [oggi.year]
+
+    mode = request.args.get('mode', 'reale')
+    is_forecast_view = (mode == 'forecast')
+    anno_a = request.args.get('anno_a', default=min(anni_disponibili[0], oggi.year), type=int)
+    anno_da = request.args.get('anno_da', default=max(anni_disponibili[-1], anno_a - 4), type=int)
+    if anno_da > anno_a: anno_da, anno_a = anno_a, anno_da
+    anno_da = max(anno_da, anno_a - NUMERO_MASSIMO_ANNI_CONFRONTO + 1)
+    anni = list(range(anno_da, anno_a + 1))
+
+    # Fine (esclusa) del periodo letto per ogni anno e fattore per riportare il periodo a 12 mesi
+    fattori = {anno: 1 for anno in anni}
+    if is_forecast_view:
+        # Anni passati interi; l'anno in corso fino a oggi, proiettato sulla media dei mesi trascorsi
+        limiti = {anno: f"{anno + 1:04d}-01-01" for anno in anni}
+        if oggi.year in limiti:
+            limiti[oggi.year] = (oggi + timedelta(days=1)).strftime('%Y-%m-%d')
+            fattori[oggi.year] = 12 / oggi.month
+        periodo_str = f"Forecast {oggi.year} (su media di {oggi.month} mesi)" if oggi.year in anni else "anni interi"
+    elif anno_a == oggi.year:
+        # Periodi identici: ogni anno fino al giorno e mese di oggi
+        # (le date sono confrontate come testo: il "giorno dopo" può non esistere, es. '2025-02-30', e funziona lo stesso)
+        limiti = {anno: f"{anno:04d}-{oggi.month:02d}-{oggi.day + 1:02d}" for anno in anni}
+        periodo_str = f"fino al {oggi.day} {MESI_ITALIANI[oggi.month]}"
+    else:
+        limiti = {anno: f"{anno + 1:04d}-01-01" for anno in anni}
+        periodo_str = "anni interi"
+
+    def costruisci_matrice(tabella):
+        persone = ['Giacomo', 'Erica', 'Totale']
+        matrice = {}
+        totali = {anno: {p: 0 for p in persone} for anno in anni}
+        for row in leggi_totali_per_anno(db, tabella, limiti):
+            valori = matrice.setdefault(row['voce'], {anno: {p: 0 for p in persone} for anno in anni})
+            # Come in totali_per_persona: una persona non prevista conta solo nel totale
+            if row['persona'] in PERSONE_VALIDE:
+                valori[row['anno']][row['persona']] += row['totale']
+                totali[row['anno']][row['persona']] += row['totale']
+            valori[row['anno']]['Totale'] += row['totale']
+            totali[row['anno']]['Totale'] += row['totale']
+        righe = [{'voce': voce, 'valori': valori} for voce, valori in sorted(matrice.items())]
+        righe_e_totale = righe + [{'voce': 'Totale', 'valori': totali}]
+        for riga in righe_e_totale:
+            for anno in anni:
+                for p in persone:
+                    riga['valori'][anno][p] *= fattori[anno]
+            riga['delta'] = {anno: {p: calcola_delta(riga['valori'][anno][p], riga['valori'][anno - 1][p]) for p in persone} for anno in anni[1:]}
+            riga['cagr'] = {}
+            for p in persone:
+                primo, ultimo = riga['valori'][anno_da][p], riga['valori'][anno_a][p]
+                riga['cagr'][p] = ((ultimo / primo) ** (1 / (anno_a - anno_da)) - 1) * 100 if anno_a > anno_da and primo > 0 and ultimo > 0 else None
+        return {'righe': righe, 'totale': righe_e_totale[-1]}
+
+    return render_template('confronto_anni.html',
+                           titolo_pagina=f"Confronto {anno_da}-{anno_a}",
+                           spese=costruisci_matrice('spese'),
+                           entrate=costruisci_matrice('entrate'),
+                           anni=anni,
+                           anno_da=anno_da,
+                           anno_a=anno_a,
+                           anni_disponibili=anni_disponibili,
+                           periodo_str=periodo_str,
+                           is_forecast_view=is_forecast_view,
+                           mode=mode)
+
+# --- API JSON in sola lettura (v1) ---
+# Gli stessi dati delle pagine, per i grafici caricati dopo la pagina, il service worker e script esterni.
+# Formato compatto: ogni tabella è {"colonne": [...], "righe": [[...], ...]}, senza ripetere le chiavi in ogni riga.
+# Gli importi sono interi in centesimi (le medie possono avere decimali). Le risposte hanno ETag come le pagine.
+# Una modifica incompatibile del formato richiede un nuovo prefisso (/api/v2), lasciando invariato /api/v1.
+def tabella_compatta(colonne, righe):
+    return {'colonne': list(colonne), 'righe': [list(riga) for riga in righe]}
+
+def errore_api(messaggio, codice):
+    return jsonify(errore=messaggio), codice
+
+def mesi_api_report(report_type=None):
+    # Stessi valori predefiniti del form delle statistiche
+    oggi = datetime.today()
+    anno_da, mese_da = request.args.get('anno_da', default=oggi.year, type=int), request.args.get('mese_da', default=1, type=int)
+    anno_a, mese_a = request.args.get('anno_a', default=oggi.year, type=int), request.args.get('mese_a', default=oggi.month, type=int)
+    datetime(anno_da, mese_da, 1); datetime(anno_a, mese_a, 1)
+    return (anno_da, mese_da), mese_successivo(anno_a, mese_a)
+
+@app.route('/api/v1/mesi/<int:anno>/<int:mese>')
+@con_etag(mesi_pagina_mese)
+def api_mese(anno, mese):
+    try: datetime(anno, mese, 1)
+    except ValueError: return errore_api("Mese non valido.", 404)
+    db = get_db()
+    sommari = calcola_sommari_mese_numerici(db, anno, mese)
+    return jsonify(
+        anno=anno, mese=mese,
+        sommario=tabella_compatta(('persona', 'entrate', 'spese', 'risparmio'), [
+            ('Giacomo', sommari['entrate_giacomo'], sommari['spese_giacomo'], sommari['risparmio_giacomo']),
+            ('Erica', sommari['entrate_erica'], sommari['spese_erica'], sommari['risparmio_erica']),
+            ('Totale', sommari['totale_entrate_mese'], sommari['totale_spese_mese'], sommari['totale_risparmio_mese'])]),
+        spese=tabella_compatta(('categoria', 'giacomo', 'erica', 'totale'),
+                               ((r['categoria'], r['importo_giacomo'], r['importo_erica'], r['importo_totale_categoria']) for r in _get_dati_tabella_spese(db, anno, mese))),
+        entrate=tabella_compatta(('tipo_entrata', 'giacomo', 'erica', 'totale'),
+                                 ((r['tipo_entrata'], r['importo_giacomo'], r['importo_erica'], r['importo_totale']) for r in _get_dati_tabella_entrate(db, anno, mese))))
+
+def report_compatto(report_type, dati_stat):
+    if report_type == 'risparmi':
+        medie = dati_stat['medie_risparmi']
+        return {'mesi': tabella_compatta(('anno', 'mese', 'giacomo', 'erica', 'totale'),
+                                         ((r['anno'], r['mese'], r['risparmio_giacomo'], r['risparmio_erica'], r['risparmio_totale']) for r in dati_stat['lista_risparmi_mensili'])),
+                'medie': [medie['giacomo'], medie['erica'], medie['totale']] if medie else None}
+    if report_type == 'spese_categoria':
+        return {'categorie': tabella_compatta(('categoria', 'giacomo', 'erica', 'totale', 'media_mensile'),
+                                              ((r['categoria'], r['spesa_giacomo'], r['spesa_erica'], r['spesa_totale'], r['media_mensile']) for r in dati_stat['dettaglio_spese_categoria']))}
+    if report_type == 'entrate_tipo':
+        medie = dati_stat['medie_entrate']
+        return {'tipi': tabella_compatta(('tipo_entrata', 'giacomo', 'erica', 'totale'),
+                                         ((r['tipo'], r['entrata_giacomo'], r['entrata_erica'], r['entrata_totale']) for r in dati_stat['dettaglio_entrate_tipo'])),
+                'mesi': tabella_compatta(('anno', 'mese', 'giacomo', 'erica', 'totale'), dati_stat['entrate_mensili']),
+                'medie': [medie['giacomo'], medie['erica'], medie['totale']] if medie else None}
+    if report_type == 'rapporto_entrate_spese':
+        forecast = dati_stat['forecast_report']
+        colonne = ('media_entrate', 'media_spese', 'media_risparmio', 'forecast_entrate', 'forecast_spese', 'forecast_risparmio', 'rapporto_percentuale')
+        return {'periodo_mesi': forecast['periodo_mesi'] if forecast else 0,
+                'persone': tabella_compatta(('persona',) + colonne,
+                                            ((persona, *(forecast[chiave][c] for c in colonne)) for persona, chiave in (('Giacomo', 'giacomo'), ('Erica', 'erica'), ('Totale', 'totale'))) if forecast else ())}
+    if report_type == 'top_spender':
+        colonne = ('data', 'categoria', 'descrizione', 'importo_cent', 'pagato_da', 'perc_su_entrate', 'perc_su_spese')
+        return {'totale_entrate': dati_stat['totale_entrate_periodo'], 'totale_spese': dati_stat['totale_spese_periodo'],
+                **{nome: tabella_compatta(colonne, ([r[c] for c in colonne] for r in dati_stat[chiave]))
+                   for nome, chiave in (('totale', 'top_spese_totali'), ('giacomo', 'top_spese_giacomo'), ('erica', 'top_spese_erica'))}}
+
+@app.route('/api/v1/statistiche/<report_type>')
+@con_etag(mesi_api_report)
+def api_report(report_type):
+    if report_type not in TIPI_REPORT_STATISTICHE: return errore_api(f"Report sconosciuto: '{report_type}'.", 404)
+    try:
+        (anno_da, mese_da), (anno_fine, mese_fine) = mesi_api_report()
+    except ValueError:
+        return errore_api("Periodo non valido.", 400)
+    start_date, end_date_exclusive = datetime(anno_da, mese_da, 1), datetime(anno_fine, mese_fine, 1)
+    if start_date >= end_date_exclusive: return errore_api("Il periodo 'da' deve precedere il periodo 'a'.", 400)
+    top_n = request.args.get('top_n', default=TOP_N_DISPONIBILI[0], type=int)
+    if top_n not in TOP_N_DISPONIBILI: top_n = TOP_N_DISPONIBILI[0]
+
+    dati_stat = dati_report_vuoti("")
+    calcola_dati_report(get_db(), report_type, start_date, end_date_exclusive, top_n, dati_stat)
+    ultimo_mese = end_date_exclusive - timedelta(days=1)
+    return jsonify(report=report_type, da=[anno_da, mese_da], a=[ultimo_mese.year, ultimo_mese.month],
+                   **report_compatto(report_type, dati_stat))
+
 if __name__ == '__main__':
     print("Avvio applicazione...")
     # init_db()
@@ -1,70 +1,163 @@
 import csv
 import sqlite3
 import argparse
+import hashlib
+import time
 from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import lru_cache
+from itertools import islice
 
 DATABASE = 'spese.db'
+DIMENSIONE_BLOCCO = 5000
+PERSONE_VALIDE = ['Giacomo', 'Erica']
+
+# Per ogni tipo importabile: tabella di destinazione e colonne di voce e persona
+TIPI_IMPORTAZIONE = {
+    'spesa': {'tabella': 'spese', 'colonna_voce': 'categoria', 'colonna_persona': 'pagato_da', 'etichetta': 'SPESE'},
+    'entrata': {'tabella': 'entrate', 'colonna_voce': 'tipo_entrata', 'colonna_persona': 'ricevuto_da', 'etichetta': 'ENTRATE'},
+}
+
+def euro_a_centesimi(testo):
+    """Converte un importo in euro scritto come testo ('12,5', '12.50', '1200') in centesimi interi.
+    Usa Decimal per non passare da un float: '0,29' diventa esattamente 29. Solleva ValueError se il testo non è un numero."""
+    try:
+        euro = Decimal(str(testo).strip().replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f"Importo non valido: '{testo}'")
+    if not euro.is_finite():
+        raise ValueError(f"Importo non valido: '{testo}'")
+    return int((euro * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def centesimi_a_testo(centesimi):
+    """Importo in centesimi come testo in euro con due decimali e il punto ('1250' -> '12.50')."""
+    segno = '-' if centesimi < 0 else ''
+    euro, cent = divmod(abs(centesimi), 100)
+    return f"{segno}{euro}.{cent:02d}"
+
+# Nei file le date si ripetono molto: memorizzare il risultato evita di rifare strptime a ogni riga
+@lru_cache(maxsize=4096)
+def controlla_data(data_str):
+    datetime.strptime(data_str, '%Y-%m-%d')
+
+def valida_riga(row, colonna_voce, colonna_persona):
+    """Valida una riga del CSV e restituisce la tupla (data, descrizione, voce, importo_cent, persona).
+    Solleva ValueError se la riga non è valida."""
+    data_str = row.get('data')
+    importo_str = row.get('importo')
+    voce = row.get(colonna_voce)
+    persona = row.get(colonna_persona)
+
+    controlla_data(data_str)
+
+    # Controlla che importo non sia nullo prima di convertirlo
+    if importo_str is None:
+        raise ValueError("La colonna 'importo' è mancante o vuota.")
+    importo_cent = euro_a_centesimi(importo_str)
+
+    if importo_cent <= 0:
+        raise ValueError("L'importo deve essere positivo.")
+
+    if not voce or not voce.strip():
+        raise ValueError(f"La colonna '{colonna_voce}' non può essere vuota.")
+
+    if persona not in PERSONE_VALIDE:
+        raise ValueError(f"Valore non valido per '{colonna_persona}': '{persona}'")
+
+    return (data_str, row.get('descrizione') or '', voce, importo_cent, persona)
+
+def calcola_impronta(data_str, importo_cent, voce, descrizione, persona, occorrenza=1):
+    """Hash del contenuto di una riga, salvato nella colonna 'impronta' (con indice unico).
+    'occorrenza' distingue righe identiche nello stesso file (es. due caffè uguali nello stesso giorno):
+    la seconda copia di un file sovrapposto ritrova le stesse occorrenze e viene saltata.
+    L'importo entra nel testo in euro con due decimali, come prima del passaggio ai centesimi."""
+    testo = f"{data_str}|{centesimi_a_testo(importo_cent)}|{voce}|{descrizione}|{persona}|{occorrenza}"
+    return hashlib.sha1(testo.encode('utf-8')).hexdigest()
+
+def aggiungi_impronte(righe):
+    """Aggiunge a ogni tupla valida la sua impronta, numerando le righe identiche."""
+    occorrenze = {}
+    for data_str, descrizione, voce, importo_cent, persona in righe:
+        chiave = (data_str, importo_cent, voce, descrizione, persona)
+        occorrenze[chiave] = occorrenze.get(chiave, 0) + 1
+        yield (data_str, descrizione, voce, importo_cent, persona, calcola_impronta(*chiave, occorrenze[chiave]))
+
+def leggi_righe_valide(csvfile, colonna_voce, colonna_persona, conteggi):
+    """Legge il CSV in streaming e restituisce solo le righe valide, aggiornando i conteggi."""
+    reader = csv.DictReader(csvfile, delimiter=';')
+    for row in reader:
+        conteggi['lette'] += 1
+
+        # Salta le righe vuote o malformate
+        if not row or not row.get('data'):
+            print(f"INFO alla riga {conteggi['lette'] + 1}: Trovata riga vuota o malformata. Riga saltata.")
+            continue
+
+        try:
+            yield valida_riga(row, colonna_voce, colonna_persona)
+        except (ValueError, TypeError) as e:
+            print(f"ERRORE alla riga {conteggi['lette'] + 1}: {e} -> Dati: {row}")
+
+def in_blocchi(righe, dimensione):
+    iteratore = iter(righe)
+    while True:
+        blocco = list(islice(iteratore, dimensione))
+        if not blocco:
+            return
+        yield blocco
+
+def sospendi_indici(con, tabella):
+    """Elimina gli indici secondari della tabella e ne restituisce le definizioni per ricrearli.
+    Gli indici unici (es. quello sull'impronta) restano, perché servono al controllo dei duplicati."""
+    indici = con.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%'", (tabella,)).fetchall()
+    for nome, _ in indici:
+        con.execute(f"DROP INDEX {nome}")
+    return indici
+
+def ripristina_indici(con, indici):
+    for _, sql in indici:
+        con.execute(sql)
+
+def importa(tipo, file_path, dimensione_blocco=DIMENSIONE_BLOCCO, ricostruisci_indici=False):
+    """Importa un file CSV in blocchi con executemany, tutto in un'unica transazione.
+    Le righe già presenti nel database (stessa impronta) vengono saltate: reimportare
+    lo stesso file, o un estratto conto sovrapposto, non crea duplicati.
+    Con ricostruisci_indici=True gli indici secondari vengono eliminati prima del caricamento
+    e ricreati alla fine (conviene solo per file molto grandi)."""
+    config = TIPI_IMPORTAZIONE[tipo]
+    tabella, colonna_voce, colonna_persona = config['tabella'], config['colonna_voce'], config['colonna_persona']
+    query_insert = (f"INSERT INTO {tabella} (data, descrizione, {colonna_voce}, importo_cent, {colonna_persona}, impronta) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (impronta) DO NOTHING")
 
-def import_spese(file_path):
-    """Importa i dati delle spese da un file CSV nel database."""
     con = sqlite3.connect(DATABASE)
-    cur = con.cursor()
-    
-    righe_inserite = 0
-    righe_lette = 0
+    conteggi = {'lette': 0, 'inserite': 0, 'duplicate': 0}
 
-    print(f"\n--- Inizio importazione SPESE dal file: {file_path} ---")
+    print(f"\n--- Inizio importazione {config['etichetta']} dal file: {file_path} ---")
+    inizio = time.perf_counter()
 
     try:
         with open(file_path, mode='r', encoding='utf-8-sig') as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=';')
-            
-            for row in reader:
-                righe_lette += 1
-                
-                # --- NUOVO CONTROLLO: Salta le righe vuote o malformate ---
-                if not row or not row.get('data'):
-                    print(f"INFO alla riga {righe_lette + 1}: Trovata riga vuota o malformata. Riga saltata.")
-                    continue
-                
-                data_str = row.get('data')
-                importo_str = row.get('importo')
-                categoria = row.get('categoria')
-                pagato_da = row.get('pagato_da')
-
-                try:
-                    datetime.strptime(data_str, '%Y-%m-%d')
-                    
-                    # Controlla che importo non sia nullo prima di usare .replace()
-                    if importo_str is None:
-                        raise ValueError("La colonna 'importo' è mancante o vuota.")
-                    importo = float(importo_str.replace(',', '.'))
-
-                    if importo <= 0:
-                        raise ValueError("L'importo deve essere positivo.")
-                        
-                    if not categoria or not categoria.strip():
-                        raise ValueError("La categoria non può essere vuota.")
-                        
-                    if pagato_da not in ['Giacomo', 'Erica']:
-                        raise ValueError(f"Valore non valido per 'pagato_da': '{pagato_da}'")
-
-                except (ValueError, TypeError) as e:
-                    print(f"ERRORE alla riga {righe_lette + 1}: {e} -> Dati: {row}")
-                    continue
-
-                descrizione = row.get('descrizione', '')
-                
-                cur.execute(
-                    "INSERT INTO spese (data, descrizione, categoria, importo, pagato_da) VALUES (?, ?, ?, ?, ?)",
-                    (data_str, descrizione, categoria, importo, pagato_da)
-                )
-                righe_inserite += 1
+            con.execute("BEGIN")
+            indici = sospendi_indici(con, tabella) if ricostruisci_indici else []
+
+            righe_valide = aggiungi_impronte(leggi_righe_valide(csvfile, colonna_voce, colonna_persona, conteggi))
+            for blocco in in_blocchi(righe_valide, dimensione_blocco):
+                # rowcount conta solo le righe effettivamente inserite: le altre erano duplicate
+                inserite = con.executemany(query_insert, blocco).rowcount
+                conteggi['inserite'] += inserite
+                conteggi['duplicate'] += len(blocco) - inserite
+
+            if indici:
+                print(f"Ricostruzione di {len(indici)} indici...")
+                ripristina_indici(con, indici)
 
         con.commit()
-        print(f"--- Importazione SPESE completata ---")
-        print(f"Righe lette: {righe_lette}")
-        print(f"Righe inserite con successo: {righe_inserite}")
+        durata = time.perf_counter() - inizio
+        print(f"--- Importazione {config['etichetta']} completata ---")
+        print(f"Righe lette: {conteggi['lette']}")
+        print(f"Righe inserite con successo: {conteggi['inserite']}")
+        print(f"Righe saltate perché già presenti: {conteggi['duplicate']}")
+        print(f"Tempo impiegato: {durata:.2f} s ({conteggi['lette'] / durata if durata > 0 else 0:.0f} righe/s)")
 
     except FileNotFoundError:
         print(f"ERRORE: File non trovato all'indirizzo '{file_path}'.")
@@ -74,69 +167,22 @@ def import_spese(file_path):
     finally:
         con.close()
 
+def import_spese(file_path):
+    """Importa i dati delle spese da un file CSV nel database."""
+    importa('spesa', file_path)
 
 def import_entrate(file_path):
-    # Logica identica per le entrate
-    con = sqlite3.connect(DATABASE)
-    cur = con.cursor()
-    righe_inserite = 0
-    righe_lette = 0
-    print(f"\n--- Inizio importazione ENTRATE dal file: {file_path} ---")
-    try:
-        with open(file_path, mode='r', encoding='utf-8-sig') as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=';')
-            for row in reader:
-                righe_lette += 1
-                
-                # --- NUOVO CONTROLLO: Salta le righe vuote o malformate ---
-                if not row or not row.get('data'):
-                    print(f"INFO alla riga {righe_lette + 1}: Trovata riga vuota o malformata. Riga saltata.")
-                    continue
-
-                data_str = row.get('data')
-                importo_str = row.get('importo')
-                tipo_entrata = row.get('tipo_entrata')
-                ricevuto_da = row.get('ricevuto_da')
-                try:
-                    datetime.strptime(data_str, '%Y-%m-%d')
-                    
-                    if importo_str is None:
-                        raise ValueError("La colonna 'importo' è mancante o vuota.")
-                    importo = float(importo_str.replace(',', '.'))
-                    
-                    if importo <= 0: raise ValueError("L'importo deve essere positivo.")
-                    if not tipo_entrata or not tipo_entrata.strip(): raise ValueError("Il tipo_entrata non può essere vuoto.")
-                    if ricevuto_da not in ['Giacomo', 'Erica']: raise ValueError(f"Valore non valido per 'ricevuto_da': '{ricevuto_da}'")
-                except (ValueError, TypeError) as e:
-                    print(f"ERRORE alla riga {righe_lette + 1}: {e} -> Dati: {row}")
-                    continue
-                descrizione = row.get('descrizione', '')
-                cur.execute(
-                    "INSERT INTO entrate (data, tipo_entrata, descrizione, importo, ricevuto_da) VALUES (?, ?, ?, ?, ?)",
-                    (data_str, tipo_entrata, descrizione, importo, ricevuto_da)
-                )
-                righe_inserite += 1
-        con.commit()
-        print(f"--- Importazione ENTRATE completata ---")
-        print(f"Righe lette: {righe_lette}")
-        print(f"Righe inserite con successo: {righe_inserite}")
-    except FileNotFoundError:
-        print(f"ERRORE: File non trovato all'indirizzo '{file_path}'.")
-    except Exception as e:
-        print(f"ERRORE CRITICO durante l'importazione: {e}")
-        con.rollback()
-    finally:
-        con.close()
+    """Importa i dati delle entrate da un file CSV nel database."""
+    importa('entrata', file_path)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Script per importare dati di spese o entrate da file CSV nel database spese.db.")
     parser.add_argument('--tipo', required=True, choices=['spesa', 'entrata'], help="Il tipo di dati da importare: 'spesa' o 'entrata'.")
     parser.add_argument('--file', required=True, help="Il percorso del file CSV da importare.")
-    
+    parser.add_argument('--blocco', type=int, default=DIMENSIONE_BLOCCO, help=f"Numero di righe inserite per ogni executemany (default: {DIMENSIONE_BLOCCO}).")
+    parser.add_argument('--ricostruisci-indici', action='store_true', help="Elimina gli indici secondari prima del caricamento e li ricrea alla fine (utile per file molto grandi).")
+
     args = parser.parse_args()
-    
-    if args.tipo == 'spesa':
-        import_spese(args.file)
-    elif args.tipo == 'entrata':
-        import_entrate(args.file)
\ No newline at end of file
+
+    importa(args.tipo, args.file, dimensione_blocco=args.blocco, ricostruisci_indici=args.ricostruisci_indici)
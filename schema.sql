@@ -5,9 +5,10 @@ CREATE TABLE spese (
     data TEXT NOT NULL,
     descrizione TEXT NOT NULL,
     categoria TEXT NOT NULL,
-    importo REAL NOT NULL,
+    importo_cent INTEGER NOT NULL,      -- Importo in centesimi di euro (es. 12,50 € -> 1250)
     pagato_da TEXT NOT NULL,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    impronta TEXT                       -- Hash del contenuto della riga (NULL per le righe inserite dall'app finché aggiorna_db.py non lo calcola)
 );
 
 -- NUOVA TABELLA PER LE ENTRATE
@@ -18,7 +19,214 @@ CREATE TABLE entrate (
     data TEXT NOT NULL,                 -- Data dell'entrata
     tipo_entrata TEXT NOT NULL,         -- Es. "Stipendio", "Bonus", "Regalo", "Vendita", "Extra"
     descrizione TEXT,                   -- Motivazione o dettaglio aggiuntivo (opzionale)
-    importo REAL NOT NULL,              -- Importo dell'entrata (sempre positivo)
+    importo_cent INTEGER NOT NULL,      -- Importo dell'entrata in centesimi di euro (sempre positivo)
     ricevuto_da TEXT NOT NULL,          -- Chi ha ricevuto l'entrata: "Giacomo" o "Erica"
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-);
\ No newline at end of file
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    impronta TEXT                       -- Hash del contenuto della riga (NULL per le righe inserite dall'app finché aggiorna_db.py non lo calcola)
+);
+
+-- INDICI PER LE QUERY MENSILI (filtri per intervallo su 'data')
+CREATE INDEX idx_spese_data_pagato_da ON spese (data, pagato_da);
+CREATE INDEX idx_spese_data_categoria ON spese (data, categoria);
+CREATE INDEX idx_entrate_data_ricevuto_da ON entrate (data, ricevuto_da);
+CREATE INDEX idx_entrate_data_tipo_entrata ON entrate (data, tipo_entrata);
+-- Classifica Top Spender: contiene tutte le colonne usate per ordinare, la query non legge la tabella
+CREATE INDEX idx_spese_data_importo ON spese (data, importo_cent, pagato_da);
+
+-- Liste paginate per chiave (data DESC, id DESC): dettagli di una voce e registro di una persona
+CREATE INDEX idx_spese_categoria_data ON spese (categoria, data);
+CREATE INDEX idx_spese_pagato_da_data ON spese (pagato_da, data);
+CREATE INDEX idx_entrate_tipo_entrata_data ON entrate (tipo_entrata, data);
+
+-- INDICI UNICI SULL'IMPRONTA (evitano di importare due volte la stessa riga)
+CREATE UNIQUE INDEX idx_spese_impronta ON spese (impronta);
+CREATE UNIQUE INDEX idx_entrate_impronta ON entrate (impronta);
+
+-- RIEPILOGO MENSILE (totali per mese, voce e persona, mantenuto dai trigger)
+-- voce = categoria per le spese, tipo_entrata per le entrate
+-- persona = pagato_da per le spese, ricevuto_da per le entrate
+DROP TABLE IF EXISTS riepilogo_mensile;
+
+CREATE TABLE riepilogo_mensile (
+    tabella TEXT NOT NULL,              -- 'spese' o 'entrate'
+    anno INTEGER NOT NULL,
+    mese INTEGER NOT NULL,
+    voce TEXT NOT NULL,
+    persona TEXT NOT NULL,
+    totale_cent INTEGER NOT NULL DEFAULT 0,  -- Somma degli importi in centesimi
+    num_transazioni INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (tabella, anno, mese, voce, persona)
+) WITHOUT ROWID;
+
+CREATE TRIGGER trg_spese_riepilogo_insert AFTER INSERT ON spese BEGIN
+    INSERT INTO riepilogo_mensile (tabella, anno, mese, voce, persona, totale_cent, num_transazioni)
+    VALUES ('spese', CAST(substr(NEW.data, 1, 4) AS INTEGER), CAST(substr(NEW.data, 6, 2) AS INTEGER), NEW.categoria, NEW.pagato_da, NEW.importo_cent, 1)
+    ON CONFLICT (tabella, anno, mese, voce, persona) DO UPDATE SET totale_cent = totale_cent + excluded.totale_cent, num_transazioni = num_transazioni + 1;
+END;
+
+CREATE TRIGGER trg_spese_riepilogo_delete AFTER DELETE ON spese BEGIN
+    UPDATE riepilogo_mensile SET totale_cent = totale_cent - OLD.importo_cent, num_transazioni = num_transazioni - 1
+    WHERE tabella = 'spese' AND anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND mese = CAST(substr(OLD.data, 6, 2) AS INTEGER) AND voce = OLD.categoria AND persona = OLD.pagato_da;
+    DELETE FROM riepilogo_mensile WHERE tabella = 'spese' AND anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND mese = CAST(substr(OLD.data, 6, 2) AS INTEGER) AND voce = OLD.categoria AND persona = OLD.pagato_da AND num_transazioni <= 0;
+END;
+
+CREATE TRIGGER trg_spese_riepilogo_update AFTER UPDATE OF data, categoria, importo_cent, pagato_da ON spese BEGIN
+    UPDATE riepilogo_mensile SET totale_cent = totale_cent - OLD.importo_cent, num_transazioni = num_transazioni - 1
+    WHERE tabella = 'spese' AND anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND mese = CAST(substr(OLD.data, 6, 2) AS INTEGER) AND voce = OLD.categoria AND persona = OLD.pagato_da;
+    DELETE FROM riepilogo_mensile WHERE tabella = 'spese' AND anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND mese = CAST(substr(OLD.data, 6, 2) AS INTEGER) AND voce = OLD.categoria AND persona = OLD.pagato_da AND num_transazioni <= 0;
+    INSERT INTO riepilogo_mensile (tabella, anno, mese, voce, persona, totale_cent, num_transazioni)
+    VALUES ('spese', CAST(substr(NEW.data, 1, 4) AS INTEGER), CAST(substr(NEW.data, 6, 2) AS INTEGER), NEW.categoria, NEW.pagato_da, NEW.importo_cent, 1)
+    ON CONFLICT (tabella, anno, mese, voce, persona) DO UPDATE SET totale_cent = totale_cent + excluded.totale_cent, num_transazioni = num_transazioni + 1;
+END;
+
+CREATE TRIGGER trg_entrate_riepilogo_insert AFTER INSERT ON entrate BEGIN
+    INSERT INTO riepilogo_mensile (tabella, anno, mese, voce, persona, totale_cent, num_transazioni)
+    VALUES ('entrate', CAST(substr(NEW.data, 1, 4) AS INTEGER), CAST(substr(NEW.data, 6, 2) AS INTEGER), NEW.tipo_entrata, NEW.ricevuto_da, NEW.importo_cent, 1)
+    ON CONFLICT (tabella, anno, mese, voce, persona) DO UPDATE SET totale_cent = totale_cent + excluded.totale_cent, num_transazioni = num_transazioni + 1;
+END;
+
+CREATE TRIGGER trg_entrate_riepilogo_delete AFTER DELETE ON entrate BEGIN
+    UPDATE riepilogo_mensile SET totale_cent = totale_cent - OLD.importo_cent, num_transazioni = num_transazioni - 1
+    WHERE tabella = 'entrate' AND anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND mese = CAST(substr(OLD.data, 6, 2) AS INTEGER) AND voce = OLD.tipo_entrata AND persona = OLD.ricevuto_da;
+    DELETE FROM riepilogo_mensile WHERE tabella = 'entrate' AND anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND mese = CAST(substr(OLD.data, 6, 2) AS INTEGER) AND voce = OLD.tipo_entrata AND persona = OLD.ricevuto_da AND num_transazioni <= 0;
+END;
+
+CREATE TRIGGER trg_entrate_riepilogo_update AFTER UPDATE OF data, tipo_entrata, importo_cent, ricevuto_da ON entrate BEGIN
+    UPDATE riepilogo_mensile SET totale_cent = totale_cent - OLD.importo_cent, num_transazioni = num_transazioni - 1
+    WHERE tabella = 'entrate' AND anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND mese = CAST(substr(OLD.data, 6, 2) AS INTEGER) AND voce = OLD.tipo_entrata AND persona = OLD.ricevuto_da;
+    DELETE FROM riepilogo_mensile WHERE tabella = 'entrate' AND anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND mese = CAST(substr(OLD.data, 6, 2) AS INTEGER) AND voce = OLD.tipo_entrata AND persona = OLD.ricevuto_da AND num_transazioni <= 0;
+    INSERT INTO riepilogo_mensile (tabella, anno, mese, voce, persona, totale_cent, num_transazioni)
+    VALUES ('entrate', CAST(substr(NEW.data, 1, 4) AS INTEGER), CAST(substr(NEW.data, 6, 2) AS INTEGER), NEW.tipo_entrata, NEW.ricevuto_da, NEW.importo_cent, 1)
+    ON CONFLICT (tabella, anno, mese, voce, persona) DO UPDATE SET totale_cent = totale_cent + excluded.totale_cent, num_transazioni = num_transazioni + 1;
+END;
+
+-- VERSIONI PER MESE (incrementate dai trigger a ogni scrittura; usate per gli ETag delle pagine)
+DROP TABLE IF EXISTS versioni_mese;
+
+CREATE TABLE versioni_mese (
+    anno INTEGER NOT NULL,
+    mese INTEGER NOT NULL,
+    versione INTEGER NOT NULL DEFAULT 0,
+    modificato_il TEXT NOT NULL,        -- Data e ora (UTC) dell'ultima scrittura nel mese
+    PRIMARY KEY (anno, mese)
+) WITHOUT ROWID;
+
+CREATE TRIGGER trg_spese_versione_insert AFTER INSERT ON spese BEGIN
+    INSERT INTO versioni_mese (anno, mese, versione, modificato_il) VALUES (CAST(substr(NEW.data, 1, 4) AS INTEGER), CAST(substr(NEW.data, 6, 2) AS INTEGER), 1, datetime('now'))
+    ON CONFLICT (anno, mese) DO UPDATE SET versione = versione + 1, modificato_il = excluded.modificato_il;
+END;
+
+CREATE TRIGGER trg_spese_versione_delete AFTER DELETE ON spese BEGIN
+    INSERT INTO versioni_mese (anno, mese, versione, modificato_il) VALUES (CAST(substr(OLD.data, 1, 4) AS INTEGER), CAST(substr(OLD.data, 6, 2) AS INTEGER), 1, datetime('now'))
+    ON CONFLICT (anno, mese) DO UPDATE SET versione = versione + 1, modificato_il = excluded.modificato_il;
+END;
+
+-- Una modifica può spostare la spesa in un altro mese: cambiano entrambi
+CREATE TRIGGER trg_spese_versione_update AFTER UPDATE ON spese BEGIN
+    INSERT INTO versioni_mese (anno, mese, versione, modificato_il) VALUES (CAST(substr(OLD.data, 1, 4) AS INTEGER), CAST(substr(OLD.data, 6, 2) AS INTEGER), 1, datetime('now'))
+    ON CONFLICT (anno, mese) DO UPDATE SET versione = versione + 1, modificato_il = excluded.modificato_il;
+    INSERT INTO versioni_mese (anno, mese, versione, modificato_il) VALUES (CAST(substr(NEW.data, 1, 4) AS INTEGER), CAST(substr(NEW.data, 6, 2) AS INTEGER), 1, datetime('now'))
+    ON CONFLICT (anno, mese) DO UPDATE SET versione = versione + 1, modificato_il = excluded.modificato_il;
+END;
+
+CREATE TRIGGER trg_entrate_versione_insert AFTER INSERT ON entrate BEGIN
+    INSERT INTO versioni_mese (anno, mese, versione, modificato_il) VALUES (CAST(substr(NEW.data, 1, 4) AS INTEGER), CAST(substr(NEW.data, 6, 2) AS INTEGER), 1, datetime('now'))
+    ON CONFLICT (anno, mese) DO UPDATE SET versione = versione + 1, modificato_il = excluded.modificato_il;
+END;
+
+CREATE TRIGGER trg_entrate_versione_delete AFTER DELETE ON entrate BEGIN
+    INSERT INTO versioni_mese (anno, mese, versione, modificato_il) VALUES (CAST(substr(OLD.data, 1, 4) AS INTEGER), CAST(substr(OLD.data, 6, 2) AS INTEGER), 1, datetime('now'))
+    ON CONFLICT (anno, mese) DO UPDATE SET versione = versione + 1, modificato_il = excluded.modificato_il;
+END;
+
+CREATE TRIGGER trg_entrate_versione_update AFTER UPDATE ON entrate BEGIN
+    INSERT INTO versioni_mese (anno, mese, versione, modificato_il) VALUES (CAST(substr(OLD.data, 1, 4) AS INTEGER), CAST(substr(OLD.data, 6, 2) AS INTEGER), 1, datetime('now'))
+    ON CONFLICT (anno, mese) DO UPDATE SET versione = versione + 1, modificato_il = excluded.modificato_il;
+    INSERT INTO versioni_mese (anno, mese, versione, modificato_il) VALUES (CAST(substr(NEW.data, 1, 4) AS INTEGER), CAST(substr(NEW.data, 6, 2) AS INTEGER), 1, datetime('now'))
+    ON CONFLICT (anno, mese) DO UPDATE SET versione = versione + 1, modificato_il = excluded.modificato_il;
+END;
+
+-- ANNI CON DATI (elenco degli anni per i menu, mantenuto dai trigger invece di scorrere tutte le righe)
+DROP TABLE IF EXISTS anni_dati;
+
+CREATE TABLE anni_dati (
+    anno INTEGER PRIMARY KEY,
+    num_transazioni INTEGER NOT NULL    -- Spese più entrate dell'anno: a zero l'anno sparisce dall'elenco
+);
+
+CREATE TRIGGER trg_spese_anni_insert AFTER INSERT ON spese BEGIN
+    INSERT INTO anni_dati (anno, num_transazioni) VALUES (CAST(substr(NEW.data, 1, 4) AS INTEGER), 1)
+    ON CONFLICT (anno) DO UPDATE SET num_transazioni = num_transazioni + 1;
+END;
+
+CREATE TRIGGER trg_spese_anni_delete AFTER DELETE ON spese BEGIN
+    UPDATE anni_dati SET num_transazioni = num_transazioni - 1 WHERE anno = CAST(substr(OLD.data, 1, 4) AS INTEGER);
+    DELETE FROM anni_dati WHERE anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND num_transazioni <= 0;
+END;
+
+CREATE TRIGGER trg_spese_anni_update AFTER UPDATE OF data ON spese WHEN substr(OLD.data, 1, 4) <> substr(NEW.data, 1, 4) BEGIN
+    UPDATE anni_dati SET num_transazioni = num_transazioni - 1 WHERE anno = CAST(substr(OLD.data, 1, 4) AS INTEGER);
+    DELETE FROM anni_dati WHERE anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND num_transazioni <= 0;
+    INSERT INTO anni_dati (anno, num_transazioni) VALUES (CAST(substr(NEW.data, 1, 4) AS INTEGER), 1)
+    ON CONFLICT (anno) DO UPDATE SET num_transazioni = num_transazioni + 1;
+END;
+
+CREATE TRIGGER trg_entrate_anni_insert AFTER INSERT ON entrate BEGIN
+    INSERT INTO anni_dati (anno, num_transazioni) VALUES (CAST(substr(NEW.data, 1, 4) AS INTEGER), 1)
+    ON CONFLICT (anno) DO UPDATE SET num_transazioni = num_transazioni + 1;
+END;
+
+CREATE TRIGGER trg_entrate_anni_delete AFTER DELETE ON entrate BEGIN
+    UPDATE anni_dati SET num_transazioni = num_transazioni - 1 WHERE anno = CAST(substr(OLD.data, 1, 4) AS INTEGER);
+    DELETE FROM anni_dati WHERE anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND num_transazioni <= 0;
+END;
+
+CREATE TRIGGER trg_entrate_anni_update AFTER UPDATE OF data ON entrate WHEN substr(OLD.data, 1, 4) <> substr(NEW.data, 1, 4) BEGIN
+    UPDATE anni_dati SET num_transazioni = num_transazioni - 1 WHERE anno = CAST(substr(OLD.data, 1, 4) AS INTEGER);
+    DELETE FROM anni_dati WHERE anno = CAST(substr(OLD.data, 1, 4) AS INTEGER) AND num_transazioni <= 0;
+    INSERT INTO anni_dati (anno, num_transazioni) VALUES (CAST(substr(NEW.data, 1, 4) AS INTEGER), 1)
+    ON CONFLICT (anno) DO UPDATE SET num_transazioni = num_transazioni + 1;
+END;
+
+-- RICERCA NELLE DESCRIZIONI (indici FTS5 "external content": il testo resta nelle tabelle, l'indice è tenuto allineato dai trigger)
+DROP TABLE IF EXISTS spese_fts;
+DROP TABLE IF EXISTS entrate_fts;
+
+CREATE VIRTUAL TABLE spese_fts USING fts5(descrizione, content='spese', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3');
+CREATE VIRTUAL TABLE entrate_fts USING fts5(descrizione, content='entrate', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3');
+
+CREATE TRIGGER trg_spese_fts_insert AFTER INSERT ON spese BEGIN
+    INSERT INTO spese_fts (rowid, descrizione) VALUES (NEW.id, NEW.descrizione);
+END;
+
+CREATE TRIGGER trg_spese_fts_delete AFTER DELETE ON spese BEGIN
+    INSERT INTO spese_fts (spese_fts, rowid, descrizione) VALUES ('delete', OLD.id, OLD.descrizione);
+END;
+
+CREATE TRIGGER trg_spese_fts_update AFTER UPDATE OF descrizione ON spese BEGIN
+    INSERT INTO spese_fts (spese_fts, rowid, descrizione) VALUES ('delete', OLD.id, OLD.descrizione);
+    INSERT INTO spese_fts (rowid, descrizione) VALUES (NEW.id, NEW.descrizione);
+END;
+
+CREATE TRIGGER trg_entrate_fts_insert AFTER INSERT ON entrate BEGIN
+    INSERT INTO entrate_fts (rowid, descrizione) VALUES (NEW.id, NEW.descrizione);
+END;
+
+CREATE TRIGGER trg_entrate_fts_delete AFTER DELETE ON entrate BEGIN
+    INSERT INTO entrate_fts (entrate_fts, rowid, descrizione) VALUES ('delete', OLD.id, OLD.descrizione);
+END;
+
+CREATE TRIGGER trg_entrate_fts_update AFTER UPDATE OF descrizione ON entrate BEGIN
+    INSERT INTO entrate_fts (entrate_fts, rowid, descrizione) VALUES ('delete', OLD.id, OLD.descrizione);
+    INSERT INTO entrate_fts (rowid, descrizione) VALUES (NEW.id, NEW.descrizione);
+END;
+
+-- ID DELLE TRANSAZIONI INVIATE DALLA CODA OFFLINE (un secondo invio della stessa transazione viene ignorato)
+DROP TABLE IF EXISTS transazioni_sincronizzate;
+
+CREATE TABLE transazioni_sincronizzate (
+    id_client TEXT PRIMARY KEY,         -- Identificativo generato dal browser quando la transazione è stata messa in coda
+    tabella TEXT NOT NULL,              -- 'spese' o 'entrate'
+    id_transazione INTEGER NOT NULL,    -- id della riga inserita
+    ricevuta_il DATETIME DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID;
@@ -1,5 +1,6 @@
 // service-worker.js
-const CACHE_NAME = 'gestione-spese-cache-v1';
+// Cambiare la versione quando cambiano le pagine o le risorse in cache: la vecchia cache viene eliminata all'attivazione.
+const CACHE_NAME = 'gestione-spese-cache-v2';
 
 // Lista delle pagine e delle risorse principali da salvare subito.
 const urlsToCache = [
@@ -11,6 +12,12 @@ const urlsToCache = [
   'https://cdn.jsdelivr.net/npm/chart.js'
 ];
 
+// Coda delle transazioni aggiunte senza rete (IndexedDB), inviata in blocco a /sincronizza_transazioni.
+const DB_CODA = 'gestione-spese-coda';
+const STORE_CODA = 'transazioni';
+const TAG_SINCRONIZZAZIONE = 'sincronizza-transazioni';
+const MASSIMO_PER_INVIO = 500;  // come NUMERO_MASSIMO_TRANSAZIONI_PER_RICHIESTA in app.py
+
 // Evento di installazione: apre la cache e aggiunge le risorse di base.
 self.addEventListener('install', function(event) {
   event.waitUntil(
@@ -19,12 +26,55 @@ self.addEventListener('install', function(event) {
         console.log('Cache aperta e file di base aggiunti');
         return cache.addAll(urlsToCache);
       })
+      .then(function() { return self.skipWaiting(); })
+  );
+});
+
+// Evento di attivazione: elimina le cache delle versioni precedenti.
+self.addEventListener('activate', function(event) {
+  event.waitUntil(
+    caches.keys()
+      .then(function(nomi) {
+        return Promise.all(nomi.filter(nome => nome !== CACHE_NAME).map(nome => caches.delete(nome)));
+      })
+      .then(function() { return self.clients.claim(); })
   );
 });
 
 // Evento fetch: intercetta ogni richiesta dalla pagina.
-// Prova prima a cercare nella cache. Se non trova nulla, va in rete.
+// - POST di una nuova transazione: se la rete non risponde, la transazione va in coda.
+// - Pagine: prima la rete (aggiornando la cache), la cache solo se offline.
+// - Altre risorse: prima la cache, poi la rete.
 self.addEventListener('fetch', function(event) {
+  const url = new URL(event.request.url);
+
+  if (event.request.method === 'POST' && url.pathname === '/aggiungi_transazione') {
+    event.respondWith(inviaOMettiInCoda(event.request));
+    return;
+  }
+  if (event.request.method !== 'GET') {
+    return;
+  }
+
+  if (event.request.mode === 'navigate') {
+    event.respondWith(
+      fetch(event.request)
+        .then(function(response) {
+          if (response.ok) {
+            const copia = response.clone();
+            caches.open(CACHE_NAME).then(cache => cache.put(event.request, copia));
+          }
+          // Se c'è rete si prova anche a svuotare la coda
+          event.waitUntil(inviaCoda());
+          return response;
+        })
+        .catch(function() {
+          return caches.match(event.request).then(response => response || caches.match('/'));
+        })
+    );
+    return;
+  }
+
   event.respondWith(
     caches.match(event.request)
       .then(function(response) {
@@ -37,4 +87,116 @@ self.addEventListener('fetch', function(event) {
       }
     )
   );
-});
\ No newline at end of file
+});
+
+// Background Sync (dove supportato): il browser risveglia il service worker quando torna la rete.
+self.addEventListener('sync', function(event) {
+  if (event.tag === TAG_SINCRONIZZAZIONE) {
+    event.waitUntil(inviaCoda());
+  }
+});
+
+// Le pagine chiedono l'invio della coda all'evento 'online' e all'apertura.
+self.addEventListener('message', function(event) {
+  if (event.data && event.data.tipo === 'sincronizza') {
+    event.waitUntil(inviaCoda());
+  }
+});
+
+function inviaOMettiInCoda(request) {
+  const copia = request.clone();
+  return fetch(request).catch(function() {
+    return copia.formData().then(function(formData) {
+      const transazione = Object.fromEntries(formData.entries());
+      delete transazione.risposta;
+      transazione.id_client = self.crypto.randomUUID();
+      return aggiungiACoda(transazione);
+    }).then(function(numeroInCoda) {
+      if (self.registration.sync) {
+        self.registration.sync.register(TAG_SINCRONIZZAZIONE).catch(() => {});
+      }
+      const messaggio = `Sei offline: transazione salvata, verrà inviata alla riconnessione (${numeroInCoda} in coda).`;
+      return new Response(JSON.stringify({ status: 'in_coda', messaggio: messaggio, in_coda: numeroInCoda }),
+                          { headers: { 'Content-Type': 'application/json' } });
+    });
+  });
+}
+
+// --- IndexedDB ---
+
+function apriCoda() {
+  return new Promise(function(resolve, reject) {
+    const richiesta = indexedDB.open(DB_CODA, 1);
+    richiesta.onupgradeneeded = () => richiesta.result.createObjectStore(STORE_CODA, { keyPath: 'id_client' });
+    richiesta.onsuccess = () => resolve(richiesta.result);
+    richiesta.onerror = () => reject(richiesta.error);
+  });
+}
+
+function operazioneCoda(modalita, operazione) {
+  return apriCoda().then(function(db) {
+    return new Promise(function(resolve, reject) {
+      const tx = db.transaction(STORE_CODA, modalita);
+      const risultato = operazione(tx.objectStore(STORE_CODA));
+      tx.oncomplete = () => { db.close(); resolve(risultato.result); };
+      tx.onerror = () => { db.close(); reject(tx.error); };
+    });
+  });
+}
+
+function aggiungiACoda(transazione) {
+  return operazioneCoda('readwrite', store => store.put(transazione))
+    .then(() => operazioneCoda('readonly', store => store.count()));
+}
+
+function togliDallaCoda(idClient) {
+  return operazioneCoda('readwrite', function(store) {
+    let ultima;
+    idClient.forEach(id => { ultima = store.delete(id); });
+    return ultima || {};
+  });
+}
+
+// Invia la coda in un'unica richiesta (o in blocchi da MASSIMO_PER_INVIO se è molto lunga).
+// Le transazioni restano in coda finché il server non le ha ricevute: un nuovo invio non crea doppioni.
+let invioInCorso = null;
+
+function inviaCoda() {
+  if (!invioInCorso) {
+    invioInCorso = inviaBlocchi(0).finally(() => { invioInCorso = null; });
+  }
+  return invioInCorso;
+}
+
+function inviaBlocchi(inserite) {
+  return operazioneCoda('readonly', store => store.getAll(undefined, MASSIMO_PER_INVIO)).then(function(transazioni) {
+    if (!transazioni.length) {
+      return avvisaPagine(inserite);
+    }
+    return fetch('/sincronizza_transazioni', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ transazioni: transazioni })
+    })
+      .then(function(response) {
+        if (!response.ok) { throw new Error('Sincronizzazione non riuscita: ' + response.status); }
+        return response.json();
+      })
+      .then(function(dati) {
+        dati.risultati.filter(r => r.esito === 'errore').forEach(r => console.log('Transazione scartata:', r.id_client, r.messaggio));
+        // Tolte tutte quelle inviate: inserite, già presenti o rifiutate perché non valide
+        return togliDallaCoda(transazioni.map(t => t.id_client))
+          .then(() => inviaBlocchi(inserite + dati.inserite));
+      });
+  }).catch(function(errore) {
+    console.log('Coda non inviata, nuovo tentativo alla prossima connessione:', errore);
+    return avvisaPagine(inserite);
+  });
+}
+
+function avvisaPagine(inserite) {
+  if (!inserite) { return; }
+  return self.clients.matchAll({ type: 'window' }).then(function(pagine) {
+    pagine.forEach(pagina => pagina.postMessage({ tipo: 'sincronizzate', inserite: inserite }));
+  });
+}
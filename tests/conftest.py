@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as applicazione
+
+
+@pytest.fixture
+def app_test(tmp_path, monkeypatch):
+    # Database nuovo da schema.sql per ogni test
+    monkeypatch.setattr(applicazione, 'DATABASE', str(tmp_path / 'spese.db'))
+    monkeypatch.setitem(applicazione.app.config, 'FILE_QUERY_LENTE', str(tmp_path / 'query_lente.log'))
+    monkeypatch.setitem(applicazione.app.config, 'TESTING', True)
+    applicazione.init_db()
+    return applicazione
+
+
+@pytest.fixture
+def client(app_test):
+    return app_test.app.test_client()
+
+
+def inserisci(app_test, tabella, data, voce, importo_cent, persona, descrizione=''):
+    colonna_voce, colonna_persona = app_test.COLONNE_RIEPILOGO[tabella]
+    db = app_test.apri_connessione()
+    try:
+        db.execute(f"INSERT INTO {tabella} (data, descrizione, {colonna_voce}, importo_cent, {colonna_persona}) VALUES (?, ?, ?, ?, ?)",
+                   (data, descrizione, voce, importo_cent, persona))
+        db.commit()
+    finally:
+        db.close()
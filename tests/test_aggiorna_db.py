@@ -0,0 +1,34 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import import_dati
+from conftest import inserisci
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'aggiorna_db.py')
+
+
+def esegui_migrazione(cartella):
+    risultato = subprocess.run([sys.executable, SCRIPT], cwd=cartella, capture_output=True, text=True)
+    assert risultato.returncode == 0, risultato.stderr
+
+
+def test_migrazione_ripetibile_con_riga_app_reimportata(app_test, tmp_path, monkeypatch):
+    esegui_migrazione(tmp_path)
+    # Riga inserita dall'app (impronta NULL), poi la stessa riga importata da un CSV
+    inserisci(app_test, 'spese', '2025-01-05', 'Alimenti', 1000, 'Giacomo', 'pane')
+    file_csv = tmp_path / 'spese.csv'
+    file_csv.write_text("data;importo;categoria;descrizione;pagato_da\n2025-01-05;10,00;Alimenti;pane;Giacomo\n", encoding='utf-8')
+    monkeypatch.setattr(import_dati, 'DATABASE', app_test.DATABASE)
+    import_dati.importa('spesa', str(file_csv))
+
+    esegui_migrazione(tmp_path)
+    esegui_migrazione(tmp_path)
+
+    con = sqlite3.connect(app_test.DATABASE)
+    impronte = [riga[0] for riga in con.execute("SELECT impronta FROM spese ORDER BY id")]
+    con.close()
+    assert len(impronte) == 2
+    assert None not in impronte
+    assert len(set(impronte)) == 2
@@ -0,0 +1,36 @@
+import pytest
+
+
+def spesa(**campi):
+    transazione = {'tipo_transazione': 'spesa', 'data': '2025-03-10', 'importo': '12,50',
+                   'categoria_spesa_select': 'Alimenti', 'descrizione_spesa': 'Spesa', 'pagato_da': 'Giacomo'}
+    transazione.update(campi)
+    return transazione
+
+
+@pytest.mark.parametrize('campi', [
+    {'categoria_spesa_select': ['Alimenti']},
+    {'categoria_spesa_select': 5},
+    {'descrizione_spesa': {'testo': 'Spesa'}},
+    {'pagato_da': ['Giacomo']},
+    {'data': 20250310},
+])
+def test_campi_non_di_testo_sono_un_errore_della_transazione(client, campi):
+    risposta = client.post('/aggiungi_transazioni', json={'transazioni': [spesa(), spesa(**campi)]})
+
+    assert risposta.status_code == 200
+    dati = risposta.get_json()
+    assert dati['status'] == 'parziale'
+    assert dati['inserite'] == 1
+    assert [r['esito'] for r in dati['risultati']] == ['inserita', 'errore']
+
+
+def test_campi_non_di_testo_nella_sincronizzazione(client):
+    transazioni = [dict(spesa(), id_client='a'), dict(spesa(categoria_spesa_select=['Alimenti']), id_client='b')]
+
+    risposta = client.post('/sincronizza_transazioni', json={'transazioni': transazioni})
+
+    assert risposta.status_code == 200
+    dati = risposta.get_json()
+    assert dati['inserite'] == 1
+    assert {r['id_client']: r['esito'] for r in dati['risultati']}['b'] == 'errore'
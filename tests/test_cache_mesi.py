@@ -0,0 +1,33 @@
+from datetime import datetime
+
+from conftest import inserisci
+
+
+class Oggi15Marzo(datetime):
+    @classmethod
+    def today(cls):
+        return cls(2026, 3, 15, 12, 0)
+
+
+def test_scritture_di_altri_processi_aggiornano_il_mese(app_test, client):
+    inserisci(app_test, 'spese', '2025-03-10', 'Alimenti', 1111, 'Giacomo')
+    assert '11,11' in client.get('/2025/3').get_data(as_text=True)
+
+    # Come import_dati.py: scrittura diretta sul database, senza invalida_mesi()
+    inserisci(app_test, 'spese', '2025-03-11', 'Alimenti', 2222, 'Giacomo')
+
+    pagina = client.get('/2025/3').get_data(as_text=True)
+    # I riquadri dei sommari vengono dalla cache dei mesi, non dai frammenti HTML
+    assert 'id="summary-spese-totale">Totale: 33,33' in pagina
+
+
+def test_scritture_di_altri_processi_aggiornano_l_anno_chiuso(app_test, client, monkeypatch):
+    monkeypatch.setattr(app_test, 'datetime', Oggi15Marzo)
+    inserisci(app_test, 'spese', '2025-01-10', 'Alimenti', 1111, 'Giacomo')
+    inserisci(app_test, 'spese', '2026-01-10', 'Alimenti', 5000, 'Giacomo')
+    assert '11,11' in client.get('/delta').get_data(as_text=True)
+
+    inserisci(app_test, 'spese', '2025-02-11', 'Alimenti', 2222, 'Giacomo')
+
+    pagina = client.get('/delta').get_data(as_text=True)
+    assert '33,33' in pagina
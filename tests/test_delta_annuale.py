@@ -0,0 +1,27 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import inserisci
+
+
+class Oggi29Febbraio(datetime):
+    @classmethod
+    def today(cls):
+        return cls(2028, 2, 29, 12, 0)
+
+
+@pytest.mark.parametrize('url', ['/delta', '/delta/2028'])
+def test_delta_il_29_febbraio(app_test, client, monkeypatch, url):
+    monkeypatch.setattr(app_test, 'datetime', Oggi29Febbraio)
+    inserisci(app_test, 'spese', '2027-02-28', 'Alimenti', 1000, 'Giacomo')
+    inserisci(app_test, 'spese', '2027-03-01', 'Alimenti', 99900, 'Giacomo')
+    inserisci(app_test, 'spese', '2028-02-29', 'Alimenti', 1500, 'Giacomo')
+
+    risposta = client.get(url)
+
+    assert risposta.status_code == 200
+    pagina = risposta.get_data(as_text=True)
+    assert 'fino al 29 Febbraio' in pagina
+    # Il 1° marzo dell'anno precedente resta fuori dal confronto
+    assert '999' not in pagina
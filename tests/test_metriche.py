@@ -0,0 +1,43 @@
+import sqlite3
+
+from conftest import inserisci
+
+
+def test_senza_metriche_e_query_lente_la_connessione_non_e_misurata(app_test, monkeypatch):
+    monkeypatch.setitem(app_test.app.config, 'METRICHE', False)
+    monkeypatch.setitem(app_test.app.config, 'SOGLIA_QUERY_LENTA_MS', None)
+
+    db = app_test.apri_connessione()
+    try:
+        assert type(db) is sqlite3.Connection
+        assert type(db.execute('SELECT 1')) is sqlite3.Cursor
+    finally:
+        db.close()
+
+
+def test_le_righe_lette_iterando_sul_cursore_sono_contate(app_test):
+    for giorno in (10, 11, 12):
+        inserisci(app_test, 'spese', f'2025-03-{giorno}', 'Alimenti', 1000, 'Giacomo')
+    misure = {'query': 0, 'sql_secondi': 0.0, 'righe': 0}
+    token = app_test._misure_richiesta.set(misure)
+    db = app_test.apri_connessione()
+    try:
+        misure['query'] = misure['righe'] = 0  # esclude i PRAGMA dell'apertura
+        assert [row['importo_cent'] for row in db.execute('SELECT importo_cent FROM spese')] == [1000, 1000, 1000]
+    finally:
+        db.close()
+        app_test._misure_richiesta.reset(token)
+
+    assert misure['query'] == 1
+    assert misure['righe'] == 3
+
+
+def test_report_type_del_form_statistiche_nelle_metriche(app_test, client, monkeypatch):
+    monkeypatch.setattr(app_test, '_istogrammi', {})
+    for report_type in ('risparmi', 'entrate_tipo'):
+        risposta = client.post('/statistiche', data={'anno_da': 2025, 'mese_da': 1, 'anno_a': 2025, 'mese_a': 6, 'report_type': report_type})
+        assert risposta.status_code == 200
+
+    metriche = client.get('/metrics').get_data(as_text=True)
+    assert 'gestione_spese_richiesta_secondi_count{route="statistiche",report_type="risparmi"} 1' in metriche
+    assert 'gestione_spese_richiesta_secondi_count{route="statistiche",report_type="entrate_tipo"} 1' in metriche
@@ -0,0 +1,23 @@
+import pytest
+
+from conftest import inserisci
+
+
+@pytest.mark.parametrize('tabella, url, campi, colonna_persona', [
+    ('spese', '/modifica_spesa/1/salva', {'categoria_spesa_select': 'Alimenti', 'pagato_da': 'Ospite'}, 'pagato_da'),
+    ('entrate', '/modifica_entrata/1/salva', {'tipo_entrata_val': 'Stipendio', 'ricevuto_da': 'Ospite'}, 'ricevuto_da'),
+])
+def test_modifica_con_persona_non_valida_rifiutata(app_test, client, tabella, url, campi, colonna_persona):
+    voce = campi.get('categoria_spesa_select') or campi['tipo_entrata_val']
+    inserisci(app_test, tabella, '2025-03-10', voce, 1000, 'Giacomo')
+
+    risposta = client.post(url, data=dict(campi, data='2025-03-10', importo='20'))
+
+    assert risposta.status_code == 302
+    assert risposta.headers['Location'].endswith(url.removesuffix('/salva'))
+    db = app_test.apri_connessione()
+    try:
+        riga = db.execute(f'SELECT importo_cent, {colonna_persona} AS persona FROM {tabella} WHERE id = 1').fetchone()
+    finally:
+        db.close()
+    assert (riga['importo_cent'], riga['persona']) == (1000, 'Giacomo')
@@ -0,0 +1,17 @@
+import pytest
+
+from conftest import inserisci
+
+
+@pytest.mark.parametrize('url', ['/confronto_anni?anno_da=2024&anno_a=2025', '/delta/2025', '/delta/2025?mode=forecast'])
+def test_persona_non_prevista_conta_solo_nel_totale(app_test, client, url):
+    inserisci(app_test, 'spese', '2024-03-10', 'Alimenti', 1000, 'Giacomo')
+    inserisci(app_test, 'spese', '2025-03-10', 'Alimenti', 1000, 'Giacomo')
+    # Righe scritte prima del controllo sulla persona nelle modifiche: il totale delle spese 2025 è 35 €
+    inserisci(app_test, 'spese', '2025-03-11', 'Alimenti', 2500, 'Ospite')
+    inserisci(app_test, 'entrate', '2025-03-12', 'Stipendio', 5000, 'Ospite')
+
+    risposta = client.get(url)
+
+    assert risposta.status_code == 200
+    assert '35 €' in risposta.get_data(as_text=True)
@@ -0,0 +1,28 @@
+import threading
+
+from conftest import inserisci
+
+
+def test_apertura_durante_gli_aggiornamenti_della_replica(app_test, monkeypatch):
+    monkeypatch.setitem(app_test.app.config, 'REPLICA_IN_MEMORIA', True)
+    inserisci(app_test, 'spese', '2025-03-10', 'Alimenti', 1000, 'Giacomo')
+    replica = app_test.ReplicaInMemoria()
+    fine = threading.Event()
+
+    def aggiorna_di_continuo():
+        while not fine.is_set():
+            replica.aggiorna()
+
+    aggiornamenti = threading.Thread(target=aggiorna_di_continuo)
+    aggiornamenti.start()
+    try:
+        for _ in range(2000):
+            db = replica.apri()
+            try:
+                # Su una copia già chiusa la connessione aprirebbe un database vuoto, senza la tabella
+                assert db.execute('SELECT COUNT(*) FROM spese').fetchone()[0] == 1
+            finally:
+                db.close()
+    finally:
+        fine.set()
+        aggiornamenti.join()